@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import logging
+from time import perf_counter
+
+from metrolinkTimes.batchPredictor import BatchPredictor
+from metrolinkTimes.feedLog import readFeedLog
+from metrolinkTimes.metrolinkTimes import GraphUpdater
+from metrolinkTimes.tfgmMetrolinksAPI import parseData
+from metrolinkTimes.tramGraph import TramGraph
+
+statuses = ["tramsHere", "tramsDeparted", "tramsApproaching"]
+
+
+def getPredictions(graph):
+    predictions = []
+    for platform in graph.platforms:
+        for status in statuses:
+            for tram in getattr(platform, status):
+                predictions.append(tram.predictions)
+    return predictions
+
+
+def timePredictions(graph, repeats):
+    times = []
+    for i in range(repeats):
+        # Predict every tram, not just those whose predictions could have
+        # changed
+        graph.repredictAll = True
+        startTime = perf_counter()
+        graph.predictTramTimes(statuses)
+        times.append(perf_counter() - startTime)
+    return min(times), getPredictions(graph)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the batch & per-tram prediction backends")
+    parser.add_argument("log", help="feed log written by recordFeed")
+    parser.add_argument(
+        "--repeats", type=int, default=20,
+        help="times to predict every tram with each backend")
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+
+    if not BatchPredictor.isAvailable():
+        print("numpy isn't installed so there's no batch backend to compare")
+        return
+
+    # Build up tram locations & averages from the recorded feed
+    graph = TramGraph()
+    gu = GraphUpdater(graph, None)
+    for fetchTime, payload in readFeedLog(args.log):
+        gu.update(parseData(json.loads(payload)))
+
+    trams = len(getPredictions(graph))
+
+    batchPredictor = graph.batchPredictor
+    graph.batchPredictor = None
+    loopTime, loopPredictions = timePredictions(graph, args.repeats)
+
+    graph.batchPredictor = batchPredictor
+    batchTime, batchPredictions = timePredictions(graph, args.repeats)
+
+    print("Predicting {} trams".format(trams))
+    print("Per-tram loop {:.2f}ms".format(loopTime * 1000))
+    print("Batch {:.2f}ms ({:.1f}x)".format(
+        batchTime * 1000, loopTime / batchTime))
+    print("Predictions match: {}".format(loopPredictions == batchPredictions))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,19 @@
 from tornado.ioloop import IOLoop
 
+from metrolinkTimes.config import Config
 from metrolinkTimes.metrolinkTimes import Application
 
 
 def main():
     mlApplication = Application
+    config = Config()
+    if config.get("workers", 1) > 1:
+        # The IOLoop's started in each process after they're forked
+        mlApplication.runWorkers(config)
+        return
+
     io_loop = IOLoop.current()
-    io_loop.run_sync(mlApplication.run)
+    io_loop.run_sync(lambda: mlApplication.run(config))
 
 
 if __name__ == '__main__':
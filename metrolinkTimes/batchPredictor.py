@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class BatchPredictor:
+    # Predicts arrival times for every tram in a group at once. Averages
+    # don't change while predictions are being made, so along a path each
+    # arrival is a fixed offset from when the tram sets off. The paths of all
+    # the trams are laid end to end & their offsets found with a few array
+    # operations
+    def __init__(self, graph):
+        self.graph = graph
+
+        # Platforms after the start of a path & the edges between them
+        self.pathArrays = {}
+
+        self.statsVersion = None
+        self.transitMeans = None
+        self.dwellMeans = None
+        self.updateTimes = None
+        self.detours = {}
+
+    @staticmethod
+    def isAvailable():
+        return np is not None
+
+    def refresh(self):
+        graph = self.graph
+
+        if self.statsVersion != graph.statsVersion:
+            self.statsVersion = graph.statsVersion
+
+            transitMeans = []
+            for start, end in graph.edges:
+                averageTransit, isDirectAverage = graph.getAverageTransit(
+                    start, end)
+                transitMeans.append(
+                    np.nan if averageTransit is None else averageTransit)
+            self.transitMeans = np.array(transitMeans, dtype=np.float64)
+
+            dwellMeans = []
+            for node in range(len(graph.platforms)):
+                averageDwell, isDirectAverage = graph.getAverageDwell(node)
+                dwellMeans.append(
+                    np.nan if averageDwell is None else averageDwell)
+            self.dwellMeans = np.array(dwellMeans, dtype=np.float64)
+
+        self.updateTimes = np.fromiter(
+            (platform.updateTime for platform in graph.platforms),
+            dtype=np.float64, count=len(graph.platforms))
+
+        # Detours depend on the Exchange Square PIDs
+        self.detours = {}
+
+    def getPathArrays(self, path):
+        start = path[0]
+        end = path[-1]
+        if (start, end) not in self.pathArrays:
+            edges = [
+                self.graph.edgeIndex[path[i], path[i+1]]
+                for i in range(len(path) - 1)]
+            self.pathArrays[start, end] = (
+                np.array(path[1:], dtype=np.intp),
+                np.array(edges, dtype=np.intp))
+        return self.pathArrays[start, end]
+
+    def getDetour(self, start, end, path):
+        if (start, end) not in self.detours:
+            self.detours[start, end] = self.graph.getDetour(start, end, path)
+        return self.detours[start, end]
+
+    def getDwell(self, node):
+        averageDwell = self.dwellMeans[node]
+        if np.isnan(averageDwell):
+            return None
+        return float(averageDwell)
+
+    def predictPath(self, start, end, departTime):
+        # Follows TramGraph.predictTram, but yields each path to be predicted
+        # along & is sent back the platforms, arrival times & whether the
+        # whole path could be predicted
+        path = self.graph.getPath(start, end)
+        if path is None:
+            return {}, False
+
+        if len(path) < 2:
+            return {}, True
+
+        valid, marketSt = self.getDetour(start, end, path)
+        if not valid:
+            return {}, False
+        if marketSt is not None:
+            predictions, cont = yield from self.predictPath(
+                start, marketSt, departTime)
+            if cont:
+                averageDwell = self.getDwell(marketSt)
+                if (averageDwell is None) or (len(predictions) == 0):
+                    return predictions, False
+
+                leaveMarketSt = max(predictions.values()) + averageDwell
+                predicted, cont = yield from self.predictPath(
+                    marketSt, end, leaveMarketSt)
+                predictions.update(predicted)
+            return predictions, cont
+
+        platforms, times, cont = yield (path, departTime)
+        return dict(zip(platforms, times)), cont
+
+    def predictTram(self, startPlatform, departTime, tram):
+        # Follows TramGraph.getTramPredictions
+        route = self.graph.getRoute(startPlatform, tram.dest, tram.via)
+        if route is None:
+            return None
+        destPlatform, viaPlatform = route
+
+        if viaPlatform is not None:
+            predicted, cont = yield from self.predictPath(
+                startPlatform, viaPlatform, departTime)
+            if cont:
+                averageDwell = self.getDwell(viaPlatform)
+                if averageDwell is None:
+                    averageDwell = 0
+
+                departVia = predicted.get(
+                    viaPlatform, departTime) + averageDwell
+                more, cont = yield from self.predictPath(
+                    viaPlatform, destPlatform, departVia)
+                predicted.update(more)
+        else:
+            predicted, cont = yield from self.predictPath(
+                startPlatform, destPlatform, departTime)
+
+        return predicted
+
+    def predictLegs(self, legs):
+        # Predicts along every (path, departure time) leg at once
+        nodes = []
+        edges = []
+        for path, departTime in legs:
+            pathNodes, pathEdges = self.getPathArrays(path)
+            nodes.append(pathNodes)
+            edges.append(pathEdges)
+        lengths = np.array([len(pathNodes) for pathNodes in nodes])
+        starts = np.cumsum(lengths) - lengths
+        ends = starts + lengths - 1
+        nodes = np.concatenate(nodes)
+        edges = np.concatenate(edges)
+        departTimes = np.array(
+            [departTime for path, departTime in legs], dtype=np.float64)
+
+        # Each arrival is the transit time from the previous platform plus
+        # the time the tram waits there, if it isn't where the tram started
+        dwells = self.dwellMeans[nodes]
+        steps = self.transitMeans[edges]
+        steps[1:] += dwells[:-1]
+        steps[starts] = self.transitMeans[edges[starts]]
+
+        # Predictions stop before an edge with no transit time & after a
+        # platform with no dwell time
+        missing = np.isnan(steps)
+        steps[missing] = 0
+        missingSoFar = np.cumsum(missing)
+        missingSoFar -= np.repeat(
+            missingSoFar[starts] - missing[starts], lengths)
+        counts = np.add.reduceat(missingSoFar == 0, starts)
+        conts = (missingSoFar[ends] == 0) & ~np.isnan(dwells[ends])
+
+        offsets = np.cumsum(steps)
+        offsets -= np.repeat(offsets[starts] - steps[starts], lengths)
+
+        # If next stop's predicted arrival is < now, base later predictions
+        # off of now. This moves every arrival along the path by the same
+        # amount
+        firstArrivals = departTimes + offsets[starts]
+        shifts = np.maximum(self.updateTimes[nodes[starts]] - firstArrivals, 0)
+        times = np.repeat(departTimes + shifts, lengths) + offsets
+
+        nodes = nodes.tolist()
+        times = times.tolist()
+        results = []
+        for start, count, cont in zip(
+                starts.tolist(), counts.tolist(), conts.tolist()):
+            results.append((
+                nodes[start:start + count],
+                times[start:start + count],
+                cont))
+        return results
+
+    def predict(self, requests):
+        # requests are (start platform, departure time, tram) triples.
+        # Returns predictions in the same order
+        self.refresh()
+
+        predictions = [None] * len(requests)
+        pending = [
+            (i, self.predictTram(start, departTime, tram), None)
+            for i, (start, departTime, tram) in enumerate(requests)]
+
+        # Trams that go via somewhere need more than one leg predicting so
+        # we go round until every tram is done
+        while pending:
+            legs = []
+            waiting = []
+            for i, tramPrediction, result in pending:
+                try:
+                    legs.append(tramPrediction.send(result))
+                except StopIteration as stop:
+                    predictions[i] = stop.value
+                    continue
+                waiting.append((i, tramPrediction))
+
+            if len(legs) == 0:
+                break
+            pending = [
+                (i, tramPrediction, result)
+                for (i, tramPrediction), result in zip(
+                    waiting, self.predictLegs(legs))]
+
+        return predictions
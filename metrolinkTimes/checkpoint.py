@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+import io
+import logging
+import os
+import pickle
+import zlib
+from datetime import datetime, timedelta
+
+from metrolinkTimes.epoch import toEpoch
+
+checkpointMagic = b"MLTC"
+checkpointVersion = 2
+
+
+class StateUnpickler(pickle.Unpickler):
+    # Checkpoints only hold plain data so there's never a reason to load
+    # anything else from one
+    def find_class(self, module, name):
+        raise pickle.UnpicklingError(
+            "Checkpoint contains {}.{}".format(module, name))
+
+
+class Checkpointer:
+    def __init__(self, path, interval=60, clock=datetime.now):
+        self.path = path
+        self.interval = timedelta(seconds=interval)
+        self.clock = clock
+        self.lastSaved = None
+
+    def save(self, graph):
+        state = graph.getState()
+        state["savedAt"] = toEpoch(self.clock())
+        data = checkpointMagic + zlib.compress(pickle.dumps(
+            (checkpointVersion, state), protocol=pickle.HIGHEST_PROTOCOL))
+
+        # Write a new file & move it into place so a crash can't leave a
+        # partly written checkpoint. It's synced first so it can't be moved
+        # into place before what's in it is on disk
+        tmpPath = "{}.tmp".format(self.path)
+        try:
+            with open(tmpPath, "wb") as checkpointFile:
+                checkpointFile.write(data)
+                checkpointFile.flush()
+                os.fsync(checkpointFile.fileno())
+            os.replace(tmpPath, self.path)
+        except OSError as e:
+            logging.error("Unable to save checkpoint: {}".format(e))
+
+    def maybeSave(self, graph):
+        now = self.clock()
+        if (self.lastSaved is None) or (now - self.lastSaved >= self.interval):
+            self.save(graph)
+            self.lastSaved = now
+
+    def load(self, graph, maxAge=300, statsMaxAge=86400):
+        # Trams will have moved on if we've been down for long so where they
+        # were is only restored if the checkpoint is younger than maxAge.
+        # Averages are restored if it's younger than statsMaxAge
+        try:
+            with open(self.path, "rb") as checkpointFile:
+                data = checkpointFile.read()
+        except FileNotFoundError:
+            logging.info("No checkpoint at {}".format(self.path))
+            return False
+        except OSError as e:
+            logging.error("Unable to read checkpoint: {}".format(e))
+            return False
+
+        try:
+            if not data.startswith(checkpointMagic):
+                raise ValueError("Not a checkpoint")
+            version, state = StateUnpickler(io.BytesIO(zlib.decompress(
+                data[len(checkpointMagic):]))).load()
+            if version != checkpointVersion:
+                raise ValueError(
+                    "Unknown checkpoint version {}".format(version))
+        except Exception as e:
+            logging.error("Unable to load checkpoint: {}".format(e))
+            return False
+
+        age = toEpoch(self.clock()) - state["savedAt"]
+        if age > statsMaxAge:
+            logging.warning("Ignoring checkpoint from {}s ago".format(age))
+            return False
+
+        try:
+            graph.setState(state, tracking=age <= maxAge)
+        except Exception as e:
+            logging.error("Unable to restore checkpoint: {}".format(e))
+            return False
+
+        logging.info("Restored checkpoint from {}s ago".format(age))
+        return True
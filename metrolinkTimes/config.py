@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+import json
+import logging
+import os
+
+confPath = "/etc/metrolinkTimes/metrolinkTimes.conf"
+
+
+def isNumber(value):
+    return (isinstance(value, (int, float))
+            and not isinstance(value, bool))
+
+
+def isPort(value):
+    return isNumber(value) and isinstance(value, int) and (0 < value < 65536)
+
+
+def isPositive(value):
+    return isNumber(value) and value > 0
+
+
+def isString(value):
+    return isinstance(value, str) and (value != "")
+
+
+def isBool(value):
+    return isinstance(value, bool)
+
+
+# What each setting must be, & a description for when it isn't
+validators = {
+    "Ocp-Apim-Subscription-Key": (isString, "a TfGM API key"),
+    "Access-Control-Allow-Origin": (isString, "an origin"),
+    "port": (isPort, "a port number"),
+    "apiScheme": (lambda value: value in ["http", "https"], "http or https"),
+    "apiHost": (isString, "a host name"),
+    "apiPort": (lambda value: value is None or isPort(value), "a port number"),
+    "connectTimeout": (isPositive, "a positive number of seconds"),
+    "requestTimeout": (isPositive, "a positive number of seconds"),
+    "pollInterval": (isPositive, "a positive number of seconds"),
+    "pollDeadline": (isPositive, "a positive number of seconds"),
+    "pollMaxBackoff": (isPositive, "a positive number of seconds"),
+    "configCheckInterval": (isPositive, "a positive number of seconds"),
+    "recordFeed": (isString, "a file path"),
+    "incrementalUpdates": (isBool, "true or false"),
+    "batchPredictions": (isBool, "true or false"),
+    "statsWindow": (
+        lambda value: isinstance(value, int) and isPositive(value),
+        "a positive whole number"),
+    "statsDecay": (
+        lambda value: value is None or (isPositive(value) and value <= 1),
+        "a number between 0 and 1"),
+    "checkpoint": (isString, "a file path"),
+    "checkpointInterval": (isPositive, "a positive number of seconds"),
+    "checkpointMaxAge": (isPositive, "a positive number of seconds"),
+    "checkpointStatsMaxAge": (isPositive, "a positive number of seconds"),
+    "liveMaxCycleAge": (isPositive, "a positive number of seconds"),
+    "readyMaxFetchAge": (isPositive, "a positive number of seconds"),
+    "readyMaxUpdateAge": (isPositive, "a positive number of seconds"),
+    "readyMaxErrorStreak": (
+        lambda value: isinstance(value, int) and isNumber(value)
+        and value >= 0,
+        "a whole number"),
+    "readyMaxWithoutAverages": (
+        lambda value: isNumber(value) and (0 <= value <= 100),
+        "a percentage"),
+    "workers": (
+        lambda value: isinstance(value, int) and isPositive(value),
+        "a positive whole number"),
+}
+
+requiredKeys = ["Ocp-Apim-Subscription-Key"]
+
+
+def validate(conf):
+    if not isinstance(conf, dict):
+        raise ValueError("Config must be a JSON object")
+
+    for key in requiredKeys:
+        if key not in conf:
+            raise ValueError("Config is missing {}".format(key))
+
+    for key, value in conf.items():
+        if key not in validators:
+            logging.warning("Unknown config key {}".format(key))
+            continue
+        isValid, description = validators[key]
+        if not isValid(value):
+            raise ValueError("Config {} must be {}, not {}".format(
+                key, description, json.dumps(value)))
+
+
+class Config:
+    # Settings from the config file, loaded once & shared. A reload
+    # replaces every setting at once so readers never see a mix of old &
+    # new settings, & a config that fails to load or validate is ignored
+    def __init__(self, path=confPath):
+        self.path = path
+        self.listeners = []
+        self.fileState = self.getFileState()
+        self.conf = self.read()
+
+    def read(self):
+        with open(self.path) as conf_file:
+            conf = json.load(conf_file)
+        validate(conf)
+        return conf
+
+    def getFileState(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    def get(self, key, default=None):
+        return self.conf.get(key, default)
+
+    def __getitem__(self, key):
+        return self.conf[key]
+
+    def __contains__(self, key):
+        return key in self.conf
+
+    def onReload(self, listener):
+        # listener is called with the config after each successful reload
+        self.listeners.append(listener)
+
+    def reload(self):
+        self.fileState = self.getFileState()
+        try:
+            conf = self.read()
+        except (OSError, ValueError) as e:
+            logging.error("Unable to reload config: {}".format(e))
+            return False
+
+        self.conf = conf
+        logging.info("Reloaded config from {}".format(self.path))
+        for listener in self.listeners:
+            try:
+                listener(self)
+            except Exception as e:
+                logging.error("{}".format(e))
+        return True
+
+    def checkForChanges(self):
+        if self.getFileState() != self.fileState:
+            return self.reload()
+        return False
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+import gzip
+import json
+from datetime import datetime, timedelta
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Bodies smaller than this gain little or grow when compressed
+minCompressSize = 512
+gzipLevel = 6
+brotliQuality = 5
+
+
+def dt_handler(obj):
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    elif isinstance(obj, timedelta):
+        return obj.total_seconds()
+
+    raise TypeError
+
+
+def json_encode(value):
+    return json.dumps(
+        value,
+        ensure_ascii=False,
+        indent=2,
+        sort_keys=True,
+        default=dt_handler)
+
+
+def json_encode_compact(value):
+    return json.dumps(
+        value,
+        ensure_ascii=False,
+        separators=(",", ":"),
+        default=dt_handler)
+
+
+def encodeJSON(value):
+    return json_encode(value).encode("utf-8")
+
+
+def encodeCompactJSON(value):
+    return json_encode_compact(value).encode("utf-8")
+
+
+def encodeMsgpack(value):
+    return msgpack.packb(value, default=dt_handler)
+
+
+# {representation: (Content-Type, encoder)}. Pretty JSON is what's always
+# been served so it's what clients get unless they ask for something else
+representations = {
+    "json": ("application/json; charset=UTF-8", encodeJSON),
+    "compactJSON": ("application/json; charset=UTF-8", encodeCompactJSON)
+}
+if msgpack is not None:
+    representations["msgpack"] = ("application/msgpack", encodeMsgpack)
+
+# Media types clients can ask for by name. Anything else, such as the */*
+# or text/html sent by browsers & curl, gets pretty JSON. Minified JSON has
+# to be asked for with application/json; indent=0 so clients that just ask
+# for JSON get what they always have
+mediaTypes = {
+    "application/json": "json",
+    "application/msgpack": "msgpack",
+    "application/x-msgpack": "msgpack",
+    "application/vnd.msgpack": "msgpack"
+}
+
+# Content codings in the order we prefer them when a client accepts several
+# equally
+codings = ["br", "gzip"]
+if brotli is None:
+    codings.remove("br")
+
+
+def parseQualities(header):
+    # [(value, q, {param: value})] from an Accept style header, highest q
+    # first. Values with equal q keep the order the client gave them in
+    ret = []
+    for item in header.split(","):
+        params = item.split(";")
+        value = params[0].strip().lower()
+        if value == "":
+            continue
+        q = 1.0
+        otherParams = {}
+        for param in params[1:]:
+            name, _, paramValue = param.partition("=")
+            name = name.strip().lower()
+            if name == "q":
+                try:
+                    q = float(paramValue)
+                except ValueError:
+                    q = 0.0
+            else:
+                otherParams[name] = paramValue.strip().strip('"')
+        ret.append((value, q, otherParams))
+
+    ret.sort(key=lambda item: -item[1])
+    return ret
+
+
+def negotiateRepresentation(accept):
+    if accept is None:
+        return "json"
+
+    for mediaType, q, params in parseQualities(accept):
+        if q <= 0:
+            continue
+        representation = mediaTypes.get(mediaType)
+        if (representation == "json") and (params.get("indent") == "0"):
+            representation = "compactJSON"
+        if representation in representations:
+            return representation
+        if representation is None:
+            # A type we don't have a specific representation for
+            return "json"
+
+    return "json"
+
+
+def negotiateCoding(acceptEncoding):
+    if acceptEncoding is None:
+        return None
+
+    qualities = {}
+    for coding, q, params in parseQualities(acceptEncoding):
+        qualities.setdefault(coding, q)
+
+    best = None
+    bestQ = 0
+    for coding in codings:
+        q = qualities.get(coding, qualities.get("*", 0))
+        if q > bestQ:
+            best = coding
+            bestQ = q
+    return best
+
+
+def encode(value, representation):
+    return representations[representation][1](value)
+
+
+def contentType(representation):
+    return representations[representation][0]
+
+
+def compress(body, coding):
+    # Returns the coding actually used along with the body
+    if (coding is None) or (len(body) < minCompressSize):
+        return None, body
+    if coding == "br":
+        return coding, brotli.compress(body, quality=brotliQuality)
+    return coding, gzip.compress(body, compresslevel=gzipLevel)
@@ -0,0 +1,18 @@
+#!/usr/bin/env python3
+
+from datetime import datetime, timedelta
+
+# Times are kept as seconds since the epoch while updating the graph & only
+# turned back into datetimes when snapshots are published. Predicted times
+# are made from averages so aren't whole seconds until they're published
+epoch = datetime(1970, 1, 1)
+
+
+def toEpoch(time):
+    return (time - epoch) // timedelta(seconds=1)
+
+
+def fromEpoch(seconds):
+    if seconds is None:
+        return None
+    return epoch + timedelta(seconds=seconds)
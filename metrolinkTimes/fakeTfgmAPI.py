@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import json
+import random
+from datetime import datetime, timedelta
+
+import networkx as nx
+import tornado.web
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.web import RequestHandler
+
+from metrolinkTimes.feedLog import readFeedLog
+from metrolinkTimes.tramGraph import TramGraph
+
+# Stations trams are sent between in the simulated feed
+terminii = [
+    "Altrincham",
+    "Ashton-Under-Lyne",
+    "Bury",
+    "East Didsbury",
+    "Eccles",
+    "Etihad Campus",
+    "Manchester Airport",
+    "Piccadilly",
+    "Rochdale Town Centre",
+    "The Trafford Centre",
+    "Victoria"
+]
+
+
+class SimulatedFeed:
+    def __init__(self, trams=60, seed=None):
+        self.rng = random.Random(seed)
+        self.DG = TramGraph().DG
+        self.stationPlatforms = {}
+        for node in nx.nodes(self.DG):
+            self.stationPlatforms.setdefault(
+                self.DG.nodes[node]["stationName"], []).append(node)
+
+        # Stagger platform update times like the real feed
+        self.updateOffsets = {}
+        for node in nx.nodes(self.DG):
+            self.updateOffsets[node] = self.rng.randrange(15)
+
+        now = datetime.utcnow()
+        self.trams = [
+            self.newTram(now - timedelta(seconds=self.rng.randrange(3600)))
+            for i in range(trams)]
+
+    def newTram(self, startTime):
+        while True:
+            start, dest = self.rng.sample(terminii, 2)
+            try:
+                path = nx.shortest_path(
+                    self.DG,
+                    self.rng.choice(self.stationPlatforms[start]),
+                    self.rng.choice(self.stationPlatforms[dest]))
+                break
+            except nx.NetworkXNoPath:
+                continue
+
+        stops = []
+        tramTime = startTime
+        for node in path:
+            arriveTime = tramTime
+            departTime = arriveTime + timedelta(
+                seconds=self.rng.randint(20, 40))
+            stops.append((node, arriveTime, departTime))
+            tramTime = departTime + timedelta(
+                seconds=self.rng.randint(70, 110))
+
+        return {
+            "dest": dest,
+            "carriages": self.rng.choice(["Single", "Double"]),
+            "stops": stops
+        }
+
+    def getPayload(self):
+        now = datetime.utcnow()
+
+        for i in range(len(self.trams)):
+            if self.trams[i]["stops"][-1][2] < now:
+                self.trams[i] = self.newTram(now)
+
+        updateTimes = {}
+        for node in nx.nodes(self.DG):
+            offset = (now.second + self.updateOffsets[node]) % 15
+            updateTimes[node] = (now - timedelta(seconds=offset)).replace(
+                microsecond=0)
+
+        pids = {node: [] for node in nx.nodes(self.DG)}
+        for tram in self.trams:
+            for node, arriveTime, departTime in tram["stops"]:
+                updateTime = updateTimes[node]
+                if departTime < updateTime:
+                    continue
+
+                if arriveTime <= updateTime:
+                    wait = 0
+                    status = "Arrived"
+                    if departTime - updateTime < timedelta(seconds=10):
+                        status = "Departing"
+                else:
+                    wait = int((arriveTime - updateTime).total_seconds() // 60)
+                    status = "Due"
+                    if wait > 20:
+                        break
+
+                dest = tram["dest"]
+                if self.DG.nodes[node]["stationName"] == dest:
+                    dest = "Terminates Here"
+                pids[node].append((wait, dest, tram["carriages"], status))
+
+        value = []
+        for pidID, node in enumerate(nx.nodes(self.DG)):
+            pid = {
+                "Id": pidID,
+                "Line": "",
+                "TLAREF": "",
+                "PIDREF": "",
+                "StationLocation": self.DG.nodes[node]["stationName"],
+                "AtcoCode": self.DG.nodes[node]["platformID"],
+                "Direction": "",
+                "MessageBoard": "<no message>",
+                "LastUpdated": updateTimes[node].strftime(
+                    "%Y-%m-%dT%H:%M:%SZ")
+            }
+
+            trams = sorted(pids[node])
+            for i in range(4):
+                if i < len(trams):
+                    wait, dest, carriages, status = trams[i]
+                    pid["Dest{}".format(i)] = dest
+                    pid["Carriages{}".format(i)] = carriages
+                    pid["Status{}".format(i)] = status
+                    pid["Wait{}".format(i)] = str(wait)
+                else:
+                    pid["Dest{}".format(i)] = ""
+                    pid["Carriages{}".format(i)] = ""
+                    pid["Status{}".format(i)] = ""
+                    pid["Wait{}".format(i)] = ""
+            value.append(pid)
+
+        return json.dumps({
+            "@odata.context": "Metrolinks",
+            "value": value
+        }).encode("utf-8")
+
+
+class RecordedFeed:
+    def __init__(self, logPath):
+        self.logPath = logPath
+        self.restart()
+
+    def restart(self):
+        self.records = readFeedLog(self.logPath)
+        self.fetchTime, self.payload = next(self.records)
+        self.next = next(self.records, None)
+        self.startTime = datetime.utcnow()
+        self.offset = self.fetchTime
+
+    def getPayload(self):
+        # Play the log back in real time, looping when it runs out
+        feedTime = self.offset + (datetime.utcnow() - self.startTime)
+        while (self.next is not None) and (self.next[0] <= feedTime):
+            self.fetchTime, self.payload = self.next
+            self.next = next(self.records, None)
+
+        payload = self.payload
+        if self.next is None:
+            self.restart()
+
+        return payload.encode("utf-8")
+
+
+class Faults:
+    def __init__(self, latency=0.0, jitter=0.0, errorRate=0.0,
+                 truncateRate=0.0, stallRate=0.0, stallTime=600.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.errorRate = errorRate
+        self.truncateRate = truncateRate
+        self.stallRate = stallRate
+        self.stallTime = stallTime
+
+    def asDict(self):
+        return dict(vars(self))
+
+
+class MetrolinksHandler(RequestHandler):
+    def initialize(self, feed, faults):
+        self.feed = feed
+        self.faults = faults
+
+    async def get(self):
+        faults = self.faults
+        delay = faults.latency + random.uniform(0, faults.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        if random.random() < faults.stallRate:
+            # Hold the connection open without responding
+            await asyncio.sleep(faults.stallTime)
+            return
+
+        if random.random() < faults.errorRate:
+            raise tornado.web.HTTPError(random.choice([429, 500, 503]))
+
+        body = self.feed.getPayload()
+        self.set_header("Content-Type", "application/json; charset=utf-8")
+
+        if random.random() < faults.truncateRate:
+            # Promise the whole body but hang up part way through it
+            self.set_header("Content-Length", len(body))
+            self.write(body[:random.randrange(len(body))])
+            await self.flush()
+            self.request.connection.close()
+            return
+
+        self.write(body)
+
+
+class FaultsHandler(RequestHandler):
+    def initialize(self, feed, faults):
+        self.faults = faults
+
+    def get(self):
+        self.write(self.faults.asDict())
+
+    def post(self):
+        for name in self.faults.asDict():
+            arg = self.get_query_argument(name, None)
+            if arg is not None:
+                setattr(self.faults, name, float(arg))
+        self.write(self.faults.asDict())
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serve a stand-in for the TfGM Metrolinks API")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--feed", help="feed log to play back instead of simulating trams")
+    parser.add_argument("--trams", type=int, default=60,
+                        help="number of simulated trams")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="seconds to wait before responding")
+    parser.add_argument("--jitter", type=float, default=0.0,
+                        help="up to this many extra seconds of latency")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="fraction of requests that get an error status")
+    parser.add_argument("--truncate-rate", type=float, default=0.0,
+                        help="fraction of responses cut off part way")
+    parser.add_argument("--stall-rate", type=float, default=0.0,
+                        help="fraction of requests that never get a response")
+    parser.add_argument("--stall-time", type=float, default=600.0,
+                        help="seconds a stalled connection is held open")
+    args = parser.parse_args()
+
+    if args.feed is not None:
+        feed = RecordedFeed(args.feed)
+    else:
+        feed = SimulatedFeed(trams=args.trams, seed=args.seed)
+
+    faults = Faults(
+        latency=args.latency,
+        jitter=args.jitter,
+        errorRate=args.error_rate,
+        truncateRate=args.truncate_rate,
+        stallRate=args.stall_rate,
+        stallTime=args.stall_time)
+
+    handlerArgs = {"feed": feed, "faults": faults}
+    application = tornado.web.Application([
+        (r"/odata/Metrolinks/?", MetrolinksHandler, handlerArgs),
+        (r"/faults/?", FaultsHandler, handlerArgs),
+    ])
+
+    server = HTTPServer(application)
+    server.listen(args.port)
+    IOLoop.current().start()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+
+import gzip
+import json
+import logging
+import zlib
+from datetime import datetime
+
+
+class FeedRecorder:
+    def __init__(self, logPath):
+        self.logPath = logPath
+
+    def record(self, fetchTime, body):
+        line = json.dumps({
+            "fetchTime": fetchTime.isoformat(),
+            "payload": body
+        }) + "\n"
+
+        # Each record is written as its own gzip member so the log can be
+        # appended to without rewriting it and a crash can only damage the
+        # last record
+        try:
+            with open(self.logPath, "ab") as logFile:
+                logFile.write(gzip.compress(line.encode("utf-8")))
+        except OSError as e:
+            logging.error("Unable to record feed: {}".format(e))
+
+
+def readFeedLog(logPath):
+    with gzip.open(logPath, "rt", encoding="utf-8") as logFile:
+        try:
+            for line in logFile:
+                record = json.loads(line)
+                yield (
+                    datetime.fromisoformat(record["fetchTime"]),
+                    record["payload"])
+        except (EOFError, zlib.error, json.JSONDecodeError):
+            logging.warning(
+                "Ignoring truncated record at end of {}".format(logPath))
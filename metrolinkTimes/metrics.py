@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+from contextlib import contextmanager
+from time import perf_counter
+
+timeBuckets = [
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5,
+    5, 10]
+sizeBuckets = [4 ** i for i in range(4, 13)]
+
+
+def formatLabels(labelNames, labelValues, extra=None):
+    labels = list(zip(labelNames, labelValues))
+    if extra is not None:
+        labels.append(extra)
+    if len(labels) == 0:
+        return ""
+    return "{{{}}}".format(",".join(
+        '{}="{}"'.format(name, str(value).replace('"', '\\"'))
+        for name, value in labels))
+
+
+class Histogram:
+    def __init__(self, name, help, buckets, labelNames=()):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.labelNames = labelNames
+        self.series = {}
+
+    def observe(self, value, *labelValues):
+        if labelValues not in self.series:
+            self.series[labelValues] = {
+                "buckets": [0] * len(self.buckets),
+                "sum": 0,
+                "count": 0
+            }
+        series = self.series[labelValues]
+
+        for i in range(len(self.buckets)):
+            if value <= self.buckets[i]:
+                series["buckets"][i] += 1
+        series["sum"] += value
+        series["count"] += 1
+
+    def render(self):
+        lines = [
+            "# HELP {} {}".format(self.name, self.help),
+            "# TYPE {} histogram".format(self.name)
+        ]
+        for labelValues, series in sorted(self.series.items()):
+            for bucket, count in zip(self.buckets, series["buckets"]):
+                lines.append("{}_bucket{} {}".format(
+                    self.name,
+                    formatLabels(self.labelNames, labelValues, ("le", bucket)),
+                    count))
+            lines.append("{}_bucket{} {}".format(
+                self.name,
+                formatLabels(self.labelNames, labelValues, ("le", "+Inf")),
+                series["count"]))
+            labels = formatLabels(self.labelNames, labelValues)
+            lines.append("{}_sum{} {}".format(
+                self.name, labels, series["sum"]))
+            lines.append("{}_count{} {}".format(
+                self.name, labels, series["count"]))
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help, labelNames=()):
+        self.name = name
+        self.help = help
+        self.labelNames = labelNames
+        self.series = {}
+
+    def inc(self, *labelValues):
+        self.series[labelValues] = self.series.get(labelValues, 0) + 1
+
+    def render(self):
+        lines = [
+            "# HELP {} {}".format(self.name, self.help),
+            "# TYPE {} counter".format(self.name)
+        ]
+        for labelValues, value in sorted(self.series.items()):
+            lines.append("{}{} {}".format(
+                self.name, formatLabels(self.labelNames, labelValues), value))
+        return lines
+
+
+class Gauge:
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def render(self):
+        return [
+            "# HELP {} {}".format(self.name, self.help),
+            "# TYPE {} gauge".format(self.name),
+            "{} {}".format(self.name, self.value)
+        ]
+
+
+# Metrics recorded by the process updating the graph
+updaterMetricNames = [
+    "stageTime", "upstreamLatency", "upstreamBytes", "tramsAt",
+    "tramsDeparted", "tramsStarting", "nodesNoAvDwell", "edgesNoAvTrans"]
+
+
+class Metrics:
+    def __init__(self):
+        self.stageTime = Histogram(
+            "metrolinktimes_update_stage_seconds",
+            "Time spent in each stage of an update",
+            timeBuckets,
+            ("stage",))
+        self.upstreamLatency = Histogram(
+            "metrolinktimes_upstream_latency_seconds",
+            "Time taken to fetch data from TfGM",
+            timeBuckets)
+        self.upstreamBytes = Histogram(
+            "metrolinktimes_upstream_payload_bytes",
+            "Size of payloads fetched from TfGM",
+            sizeBuckets)
+        self.requestLatency = Histogram(
+            "metrolinktimes_request_latency_seconds",
+            "Time taken to serve requests",
+            timeBuckets,
+            ("handler", "code"))
+        self.responseBytes = Histogram(
+            "metrolinktimes_response_bytes",
+            "Size of responses served",
+            sizeBuckets,
+            ("handler",))
+        self.responseCache = Counter(
+            "metrolinktimes_response_cache_total",
+            "Responses served from the response cache or built",
+            ("handler", "result"))
+
+        self.tramsAt = Gauge(
+            "metrolinktimes_trams_at",
+            "Trams at platforms")
+        self.tramsDeparted = Gauge(
+            "metrolinktimes_trams_departed",
+            "Trams that have departed platforms")
+        self.tramsStarting = Gauge(
+            "metrolinktimes_trams_starting",
+            "Trams yet to start at platforms")
+        self.nodesNoAvDwell = Gauge(
+            "metrolinktimes_platforms_without_average_dwell",
+            "Platforms without an average dwell time")
+        self.edgesNoAvTrans = Gauge(
+            "metrolinktimes_edges_without_average_transit",
+            "Edges without an average transit time")
+        self.subscribers = Gauge(
+            "metrolinktimes_stream_subscribers",
+            "Clients streaming updates")
+
+    def useUpdaterMetrics(self, updaterMetrics):
+        # Processes serving snapshots from another process show its update
+        # metrics alongside their own request metrics
+        for name in updaterMetricNames:
+            setattr(self, name, getattr(updaterMetrics, name))
+
+    @contextmanager
+    def time(self, stage):
+        startTime = perf_counter()
+        try:
+            yield
+        finally:
+            self.stageTime.observe(perf_counter() - startTime, stage)
+
+    def render(self):
+        lines = []
+        for metric in [
+           self.stageTime,
+           self.upstreamLatency,
+           self.upstreamBytes,
+           self.requestLatency,
+           self.responseBytes,
+           self.responseCache,
+           self.tramsAt,
+           self.tramsDeparted,
+           self.tramsStarting,
+           self.nodesNoAvDwell,
+           self.edgesNoAvTrans,
+           self.subscribers]:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
@@ -1,18 +1,35 @@
 #!/usr/bin/python3
 import asyncio
-import json
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from sys import exit
 from os import path
 import logging
+import os
+import signal
 
 import tornado.web
 from tornado.web import RequestHandler
+from tornado.websocket import WebSocketClosedError, WebSocketHandler
 from tornado import escape
 from tornado.httpserver import HTTPServer
-
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.locks import Event
+from tornado.netutil import bind_sockets
+from tornado.process import fork_processes
+
+from metrolinkTimes.checkpoint import Checkpointer
+from metrolinkTimes.config import Config
+from metrolinkTimes import encoding
+from metrolinkTimes.metrics import Metrics
+from metrolinkTimes.pollScheduler import PollScheduler
+from metrolinkTimes.responseCache import ResponseCache
+from metrolinkTimes.sharedSnapshot import (
+    SharedSnapshotReader, SharedSnapshotWriter, createSharedFile)
+from metrolinkTimes.subscriptions import Subscriptions
 from metrolinkTimes.tfgmMetrolinksAPI import TFGMMetrolinksAPI
 from metrolinkTimes.tramGraph import TramGraph
+from metrolinkTimes.updateStatus import UpdateStatus
 
 logFormat = '%(asctime)s %(levelname)s %(pathname)s %(lineno)s %(message)s'
 logLevel = logging.ERROR
@@ -26,164 +43,131 @@ else:
     logging.basicConfig(format=logFormat,
                         level=logLevel)
 
-
-def dt_handler(obj):
-    if isinstance(obj, datetime):
-        return obj.isoformat()
-    elif isinstance(obj, timedelta):
-        return obj.total_seconds()
-
-    raise TypeError
-
-
-def json_encode(value):
-    return json.dumps(
-        value,
-        ensure_ascii=False,
-        indent=2,
-        sort_keys=True,
-        default=dt_handler)
-
-
-escape.json_encode = json_encode
+escape.json_encode = encoding.json_encode
 
 
 class GraphUpdater:
-    def __init__(self, graph):
-        self.api = TFGMMetrolinksAPI()
+    def __init__(self, graph, api, clock=datetime.now, scheduler=None,
+                 metrics=None, checkpointer=None, subscriptions=None,
+                 sharedSnapshot=None, status=None):
+        self.api = api
         self.graph = graph
-        self.stationMappings = {
-            "Ashton-under-Lyne": "Ashton-Under-Lyne",
-            "Deansgate Castlefield": "Deansgate - Castlefield",
-            "Deansgate": "Deansgate - Castlefield",
-            "Ashton": "Ashton-Under-Lyne",
-            "MCUK": "MediaCityUK",
-            "Newton Heath": "Newton Heath and Moston",
-            "Victoria Millgate Siding": "Victoria",
-            "Rochdale Stn": "Rochdale Railway Station",
-            "Trafford Centre": "The Trafford Centre",
-            "intu Trafford Centre": "The Trafford Centre",
-            "Wythen. Town": "Wythenshawe Town Centre"
-        }
-
-    def update(self):
-        data = self.api.getData()
-
+        self.clock = clock
+        self.scheduler = scheduler
+        if self.scheduler is None:
+            self.scheduler = PollScheduler()
+        self.metrics = metrics
+        if self.metrics is None:
+            self.metrics = Metrics()
+        self.checkpointer = checkpointer
+        self.subscriptions = subscriptions
+        self.sharedSnapshot = sharedSnapshot
+        self.status = status
+        if self.status is None:
+            self.status = UpdateStatus(self.clock())
+        # Updates run in their own thread so they don't hold up requests
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def runStage(self, stage, *args):
+        with self.metrics.time(stage):
+            getattr(self.graph, stage)(*args)
+
+    def update(self, data):
         if data is None:
             # Internet down?
             return
 
-        tramsVia = []
-
-        for station in data:
-            for platform in data[station]:
-                nodeID = "{}_{}".format(station, platform)
-                if nodeID not in self.graph.getNodes():
-                    logging.error("ERROR: Unknown platfrom {}".format(nodeID))
-                    continue
+        with self.metrics.time("update"):
+            self.updateGraph(data)
 
-                pidTramData = []
-                message = None
-                updateTime = None
+        if self.checkpointer is not None:
+            with self.metrics.time("checkpoint"):
+                self.checkpointer.maybeSave(self.graph)
 
-                apiPID = data[station][platform][0]
-                if not (apiPID["MessageBoard"].startswith("^F0")
-                        or (apiPID["MessageBoard"] == "<no message>")):
-                    message = apiPID["MessageBoard"]
-
-                # This seems to be how flashing is encoded. We'll get rid of it
-                if message is not None:
-                    message = message.replace("^$", "")
-
-                updateTime = datetime.strptime(
-                    apiPID["LastUpdated"],
-                    "%Y-%m-%dT%H:%M:%SZ")
-
-                if self.graph.getLastUpdateTime(nodeID) == updateTime:
-                    return
-
-                for i in range(4):
-                    if apiPID["Dest{}".format(i)] != "":
-                        stationName = apiPID["Dest{}".format(i)]
-                        # TODO: Shift this & station mappings to tramGraph
-                        validDests = (list(self.graph.getStations())
-                                      + [
-                                            "Terminates Here",
-                                            "See Tram Front",
-                                            "Not in Service"])
-                        viaName = None
-
-                        if " via " in stationName:
-                            splitName = stationName.split(" via ")
-                            stationName = splitName[0]
-                            viaName = splitName[1]
-                        if stationName in self.stationMappings:
-                            stationName = self.stationMappings[stationName]
-                        if viaName in self.stationMappings:
-                            viaName = self.stationMappings[viaName]
-                            if viaName not in tramsVia:
-                                tramsVia.append(viaName)
-                        if stationName not in validDests:
-                            logging.error(
-                                "Unknown station {}".format(stationName))
-                            continue
-                        if (viaName is not None) and (
-                          viaName not in validDests):
-                            logging.error("Unknown station {}".format(viaName))
-                            viaName = None
-
-                        pidTramData.append({
-                            "dest": stationName,
-                            "via": viaName,
-                            "carriages": apiPID["Carriages{}".format(i)],
-                            "status": apiPID["Status{}".format(i)],
-                            "wait": int(apiPID["Wait{}".format(i)])
-                        })
+    def updateGraph(self, data):
+        with self.metrics.time("updatePlatformPIDs"):
+            tramsVia = self.updatePlatformPIDs(data)
 
-                self.graph.updatePlatformPID(
-                    nodeID,
-                    pidTramData,
-                    message,
-                    updateTime)
+        if not self.graph.startUpdate():
+            # Nothing has changed since the last update
+            return
 
-        self.graph.decodePIDs()
-        self.graph.clearOldDeparted()
-        self.graph.locateDepartingTrams()
-        self.graph.locateTramsAt()
-        self.graph.clearNodePredictions()
+        self.runStage("decodePIDs")
+        self.runStage("clearOldDeparted")
+        self.runStage("locateDepartingTrams")
+        self.runStage("locateTramsAt")
+        self.runStage("clearNodePredictions")
 
         # We need to predict trams at definitively known locations first
         # so we can use these predictions to verify if trams are actually
         # starting at other stops
-        self.graph.predictTramTimes(["tramsHere", "tramsDeparted"])
+        self.runStage("predictTramTimes", ["tramsHere", "tramsDeparted"])
+
+        self.runStage("debounceNew")
 
-        self.graph.debounceNew()
+        self.runStage("gatherTramPredictions", ["tramsHere", "tramsDeparted"])
 
-        self.graph.gatherTramPredictions(["tramsHere", "tramsDeparted"])
+        self.runStage("locateApproachingTrams")
+        self.runStage("predictTramTimes", ["tramsApproaching"])
+        self.runStage("gatherTramPredictions", ["tramsApproaching"])
+        self.runStage("locateApproachingTrams", True)
 
-        self.graph.locateApproachingTrams()
-        self.graph.predictTramTimes(["tramsApproaching"])
-        self.graph.gatherTramPredictions(["tramsApproaching"])
-        self.graph.locateApproachingTrams()
+        self.runStage("clearNodePredictions")
+        self.runStage("gatherTramPredictions", ["tramsHere",
+                                                "tramsDeparted",
+                                                "tramsApproaching"])
 
-        self.graph.clearNodePredictions()
-        self.graph.gatherTramPredictions(["tramsHere",
-                                          "tramsDeparted",
-                                          "tramsApproaching"])
+        self.graph.setLocalUpdateTime(self.clock())
 
         # This might not be needed. Could just look like doubling up because of
         # routes being run on day of testing
-        self.graph.finalisePredictions()
+        self.runStage("finalisePredictions")
+
+        with self.metrics.time("stats"):
+            self.updateStats(self.graph.getSnapshot(), tramsVia)
+
+    def updatePlatformPIDs(self, data):
+        decoder = self.graph.getPIDDecoder()
+        tramsVia = []
+
+        for station in data:
+            for platform in data[station]:
+                node = self.graph.getPlatformIndex(station, platform)
+                if node is None:
+                    logging.error("ERROR: Unknown platfrom {}_{}".format(
+                        station, platform))
+                    continue
+
+                apiPID = data[station][platform][0]
+                updateTime = decoder.decodeTime(apiPID["LastUpdated"])
 
-        self.graph.setLocalUpdateTime(datetime.now())
+                if self.graph.getLastUpdateTime(node) == updateTime:
+                    continue
+
+                message = decoder.decodeMessage(apiPID["MessageBoard"])
+                pidTramData = decoder.decodeTrams(apiPID)
+                for dest, via, carriages, status, wait in pidTramData:
+                    if via is not None:
+                        via = self.graph.getStationName(via)
+                        if via not in tramsVia:
+                            tramsVia.append(via)
+
+                self.graph.updatePlatformPID(
+                    node,
+                    pidTramData,
+                    message,
+                    updateTime)
+
+        return tramsVia
 
-        tramsAts = self.graph.getTramsHeres()
+    def updateStats(self, snapshot, tramsVia):
+        tramsAts = snapshot.getTramsHeres()
         tramsAt = 0
 
-        tramsDeparteds = self.graph.getTramsDeparteds()
+        tramsDeparteds = snapshot.getTramsDeparteds()
         tramsDeparted = 0
 
-        tramsStartings = self.graph.getTramsStarting()
+        tramsStartings = snapshot.getTramsStarting()
         tramsStarting = 0
         platformsStarting = 0
         stationsStarting = set()
@@ -200,10 +184,17 @@ class GraphUpdater:
                 platformsStarting += 1
                 stationsStarting.add(self.graph.DG.nodes[node]["stationName"])
 
-        logging.info("Len nodes without average: {}".format(
-            len(self.graph.nodesNoAvDwell())))
-        logging.info("Len edges without average: {}".format(
-            len(self.graph.edgesNoAvTrans())))
+        nodesNoAvDwell = len(snapshot.nodesNoAvDwell())
+        edgesNoAvTrans = len(snapshot.edgesNoAvTrans())
+
+        self.metrics.tramsAt.set(tramsAt)
+        self.metrics.tramsDeparted.set(tramsDeparted)
+        self.metrics.tramsStarting.set(tramsStarting)
+        self.metrics.nodesNoAvDwell.set(nodesNoAvDwell)
+        self.metrics.edgesNoAvTrans.set(edgesNoAvTrans)
+
+        logging.info("Len nodes without average: {}".format(nodesNoAvDwell))
+        logging.info("Len edges without average: {}".format(edgesNoAvTrans))
         logging.info("trams at stations: {}".format(tramsAt))
         logging.info("trams departed stations: {}".format(tramsDeparted))
         logging.info("trams yet to start at stations: {}".format(
@@ -219,18 +210,139 @@ class GraphUpdater:
 
     async def updateLoop(self):
         while True:
-            self.update()
-            await asyncio.sleep(1)
+            startTime = self.clock()
+            self.status.startCycle(startTime)
+            try:
+                data = await asyncio.wait_for(
+                    self.api.getDataAsync(), self.scheduler.deadline)
+            except asyncio.TimeoutError:
+                logging.error("Timed out fetching data from TfGM")
+                data = None
+            self.status.recordFetch(self.clock(), data is not None)
+
+            await IOLoop.current().run_in_executor(
+                self.executor, self.update, data)
+
+            if self.subscriptions is not None:
+                # Streamed updates are sent from the IOLoop
+                with self.metrics.time("publish"):
+                    self.subscriptions.publish(self.graph.getSnapshot())
+                self.metrics.subscribers.set(
+                    self.subscriptions.countSubscribers())
+
+            now = self.clock()
+            self.status.finishCycle(now)
+
+            if self.sharedSnapshot is not None:
+                # Workers serve the snapshot & show our metrics & status
+                with self.metrics.time("share"):
+                    self.sharedSnapshot.publish(
+                        self.graph.getSnapshot(), (self.metrics, self.status))
+            cycleTime = now - startTime
+            if cycleTime.total_seconds() > self.scheduler.deadline:
+                logging.warning("Update took {}".format(cycleTime))
+
+            self.scheduler.recordPoll(
+                now, data is not None, self.graph.getNewestUpdateTime())
+            await asyncio.sleep(self.scheduler.nextDelay(now, cycleTime))
 
 
 class BaseHandler(RequestHandler):
-    def initialize(self, graph):
+    def initialize(self, graph, clock, metrics, responseCache, config,
+                   subscriptions, status):
         self.graph = graph
+        self.clock = clock
+        self.metrics = metrics
+        self.responseCache = responseCache
+        self.config = config
+        self.subscriptions = subscriptions
+        self.status = status
+        self.responseBytes = 0
+
+        # Tornado sets the default headers before initialize is called so
+        # they're set again now we have the config
+        self.set_default_headers()
+
+    def getArg(self, name, default):
+        arg = self.get_query_arguments(name)
+        if arg == []:
+            arg = default
+        else:
+            arg = arg[0]
+
+        return arg
+
+    def getPlatformFlags(self):
+        # Query strings controlling what's returned for each platform
+        return (
+            self.getArg("predictions", "true").lower() == "true",
+            self.getArg("tramPredictions", "true").lower() != "false",
+            self.getArg("message", "true").lower() == "true",
+            self.getArg("meta", "false").lower() == "true")
+
+    def negotiate(self):
+        # The representation & compression asked for in the request headers
+        return (
+            encoding.negotiateRepresentation(
+                self.request.headers.get("Accept")),
+            encoding.negotiateCoding(
+                self.request.headers.get("Accept-Encoding")))
+
+    def writeEncoded(self, representation, coding, body):
+        self.set_header(
+            "Content-Type", encoding.contentType(representation))
+        self.set_header("Vary", "Accept, Accept-Encoding")
+        if coding is not None:
+            self.set_header("Content-Encoding", coding)
+        self.write(body)
+
+    def writeData(self, data):
+        representation, coding = self.negotiate()
+        coding, body = encoding.compress(
+            encoding.encode(data, representation), coding)
+        self.writeEncoded(representation, coding, body)
+
+    def writeCached(self, key, build):
+        # Responses are built, encoded & compressed once per snapshot for
+        # each set of arguments, representation & compression
+        handler = type(self).__name__
+        snapshot = self.graph.getSnapshot()
+        representation, coding = self.negotiate()
+        key = (handler,) + key
+        response = self.responseCache.get(
+            snapshot.generation, key + (representation, coding))
+        if response is None:
+            self.metrics.responseCache.inc(handler, "miss")
+            # The uncompressed body is kept for the other compressions
+            plainKey = key + (representation, None)
+            plain = self.responseCache.get(snapshot.generation, plainKey)
+            if plain is None:
+                plain = (
+                    None, encoding.encode(build(snapshot), representation))
+                self.responseCache.set(snapshot.generation, plainKey, plain)
+            response = encoding.compress(plain[1], coding)
+            self.responseCache.set(
+                snapshot.generation, key + (representation, coding),
+                response)
+        else:
+            self.metrics.responseCache.inc(handler, "hit")
+
+        self.writeEncoded(representation, *response)
+
+    def flush(self, include_footers=False):
+        self.responseBytes += sum(len(chunk) for chunk in self._write_buffer)
+        return super().flush(include_footers)
+
+    def on_finish(self):
+        handler = type(self).__name__
+        self.metrics.requestLatency.observe(
+            self.request.request_time(), handler, self.get_status())
+        self.metrics.responseBytes.observe(self.responseBytes, handler)
 
     def set_default_headers(self, *args, **kwargs):
-        with open("/etc/metrolinkTimes/metrolinkTimes.conf") as conf_file:
-            origin = json.load(conf_file).get(
-                "Access-Control-Allow-Origin", "*")
+        if not hasattr(self, "config"):
+            return
+        origin = self.config.get("Access-Control-Allow-Origin", "*")
         self.set_header("Access-Control-Allow-Origin", origin)
         self.set_header("Access-Control-Allow-Headers", "x-requested-with")
         self.set_header("Access-Control-Allow-Methods", "GET, OPTIONS")
@@ -238,28 +350,45 @@ class BaseHandler(RequestHandler):
 
 class MainHandler(BaseHandler):
     def get(self):
-        self.write({"paths": [
+        self.writeData({"paths": [
+            "batch/",
             "debug/",
             "health/",
-            "station/"
+            "metrics/",
+            "station/",
+            "stream/",
+            "trams/"
         ]})
 
 
 class DebugHandler(BaseHandler):
     def get(self):
-        def getArg(name, default):
-            arg = self.get_query_arguments(name)
-            if arg == []:
-                arg = default
-            else:
-                arg = arg[0]
+        meta = self.getArg("meta", "false").lower() == "true"
+        self.writeCached((meta,), lambda snapshot: self.build(snapshot, meta))
 
-            return arg
+    def build(self, snapshot, meta):
+        here = snapshot.getTramsHeres()
+        dep = snapshot.getTramsDeparteds()
+        start = snapshot.getTramsStarting()
 
-        here = self.graph.getTramsHeres()
-        dep = self.graph.getTramsDeparteds()
-        start = self.graph.getTramsStarting()
+        ret = {
+            "missingAverages": {
+                "platforms": snapshot.nodesNoAvDwell(),
+                "edges": snapshot.edgesNoAvTrans()
+            },
+            "trams": {
+                "here": {k: here[k] for k in here if here[k]},
+                "departed": {k: dep[k] for k in dep if dep[k]},
+                "starting": {k: start[k] for k in start if start[k]}
+            }
+        }
+
+        if meta:
+            ret["stations"] = self.buildStations(snapshot)
+
+        return ret
 
+    def buildStations(self, snapshot):
         stations = {}
         for stationName in self.graph.getStations():
             stations[stationName] = {}
@@ -269,57 +398,149 @@ class DebugHandler(BaseHandler):
                 stations[stationName][platID] = {
                     "x": self.graph.getMapPos(nodeID)[0],
                     "y": self.graph.getMapPos(nodeID)[1],
-                    "averageDwellTime": self.graph.getAverageDwell(nodeID),
+                    "averageDwellTime": snapshot.getAverageDwell(nodeID),
                     "predecessors": {}
                     }
 
                 for pNode in self.graph.getNodePreds(nodeID):
                     stations[stationName][platID]["predecessors"][pNode] = {
-                        "averageTransit": self.graph.getAverageTransit(pNode, nodeID)
+                        "averageTransit": snapshot.getAverageTransit(
+                            pNode, nodeID)
                         }
 
-
-        ret = {
-            "missingAverages": {
-                "platforms": self.graph.nodesNoAvDwell(),
-                "edges": self.graph.edgesNoAvTrans()
-            },
-            "trams": {
-                "here": {k: here[k] for k in here if here[k] != []},
-                "departed": {k: dep[k] for k in dep if dep[k] != []},
-                "starting": {k: start[k] for k in start if start[k] != []}
-            }
-        }
-
-        if getArg("meta", "false").lower() == "true":
-            ret["stations"] = stations
-
-        self.write(ret)
+        return stations
 
 
 class StationHandler(BaseHandler):
     def get(self):
         ret = ["{}/".format(station) for station in self.graph.getStations()]
-        self.write({"stations": ret})
+        self.writeData({"stations": ret})
 
 
-class StationNameHandler(BaseHandler):
-    def get(self, stationName):
-        def getArg(name, default):
-            arg = self.get_query_arguments(name)
-            if arg == []:
-                arg = default
-            else:
-                arg = arg[0]
+def getAverageDwellTime(graph, snapshot, nodeID, tramPredictions):
+    # The platform's own average, the one its predictions are made with.
+    # Averages borrowed from other platforms at the station aren't shown
+    averageDwell, isDirectAverage = snapshot.getAverageDwell(nodeID)
+    if not isDirectAverage:
+        return None
+    return averageDwell
+
+
+def getPredecessors(graph, snapshot, nodeID, tramPredictions):
+    pred = {}
+    for pNodeID in graph.getNodePreds(nodeID):
+        pred[pNodeID] = {
+            "transitTimes": snapshot.getTransit(pNodeID, nodeID)
+            }
+
+        (pred[pNodeID]["averageTransitTime"],
+            isDirectAverage) = snapshot.getAverageTransit(
+                pNodeID, nodeID)
+    return pred
+
+
+# The data that can be returned for a platform & how to get it from a
+# snapshot. Each is only worked out if it's asked for
+platformFields = {
+    "updateTime": lambda graph, snapshot, nodeID, tramPredictions: (
+        snapshot.getLastUpdateTime(nodeID)),
+    "predictions": lambda graph, snapshot, nodeID, tramPredictions: (
+        snapshot.getPlatformPredictions(nodeID, tramPredictions)),
+    "here": lambda graph, snapshot, nodeID, tramPredictions: (
+        snapshot.getTramsHeres()[nodeID]),
+    "departed": lambda graph, snapshot, nodeID, tramPredictions: (
+        snapshot.getTramsDeparteds()[nodeID]),
+    "message": lambda graph, snapshot, nodeID, tramPredictions: (
+        snapshot.getMessage(nodeID)),
+    "mapPos": lambda graph, snapshot, nodeID, tramPredictions: {
+        "x": graph.getMapPos(nodeID)[0],
+        "y": graph.getMapPos(nodeID)[1]
+        },
+    "dwellTimes": lambda graph, snapshot, nodeID, tramPredictions: (
+        snapshot.getDwellTimes()[nodeID]),
+    "averageDwellTime": getAverageDwellTime,
+    "predecessors": getPredecessors
+}
+
+
+def getPlatformData(graph, snapshot, nodeID, flags):
+    # The data for a platform shared by the station & platform handlers
+    predictions, tramPredictions, message, meta = flags
+    fields = ["updateTime"]
+
+    if predictions:
+        fields.extend(["predictions", "here"])
+
+    if message:
+        fields.append("message")
+
+    if meta:
+        fields.extend([
+            "mapPos", "dwellTimes", "averageDwellTime", "predecessors"])
+
+    return {
+        field: platformFields[field](graph, snapshot, nodeID, tramPredictions)
+        for field in fields}
+
+
+def parseFields(fields):
+    # Turns "a.b,a.c,d" into {"a": {"b": None, "c": None}, "d": None}. None
+    # means all of a field
+    tree = {}
+    for fieldPath in fields:
+        node = tree
+        parts = fieldPath.split(".")
+        for part in parts[:-1]:
+            if node.get(part, {}) is None:
+                # All of this field has already been asked for
+                break
+            node = node.setdefault(part, {})
+        else:
+            node[parts[-1]] = None
+    return tree
+
+
+def projectFields(value, tree):
+    # The parts of value named in tree, from parseFields. Lists have each of
+    # their items projected
+    if tree is None:
+        return value
+    if isinstance(value, dict):
+        return {
+            key: projectFields(value[key], subTree)
+            for key, subTree in tree.items() if key in value}
+    if isinstance(value, (list, tuple)):
+        return [projectFields(item, tree) for item in value]
+    return value
+
+
+def getQueryPlatformIDs(handler):
+    # The platforms named by station= & platform= in the query string
+    try:
+        return handler.graph.getPlatformIDs(
+            handler.get_query_arguments("station"),
+            handler.get_query_arguments("platform"))
+    except ValueError as e:
+        raise tornado.web.HTTPError(400, "{}".format(e))
 
-            return arg
 
+class StationNameHandler(BaseHandler):
+    def get(self, stationName):
         if stationName not in self.graph.getStations():
             raise tornado.web.HTTPError(404)
 
+        verbose = self.getArg("verbose", "false").lower() == "true"
+        departed = self.getArg("departed", "false").lower() == "true"
+        flags = self.getPlatformFlags()
+        self.writeCached(
+            (stationName, verbose, departed, flags),
+            lambda snapshot: self.build(
+                snapshot, stationName, verbose, departed, flags))
+
+    def build(self, snapshot, stationName, verbose, departed, flags):
         ret = {}
 
-        if getArg("verbose", "false").lower() != "true":
+        if not verbose:
             stationPlatforms = self.graph.getStationPlatforms(stationName)
             ret["platforms"] = [
                 "{}/".format(platID) for platID in stationPlatforms]
@@ -327,161 +548,426 @@ class StationNameHandler(BaseHandler):
             ret["platforms"] = {}
             for platID in self.graph.getStationPlatforms(stationName):
                 nodeID = "{}_{}".format(stationName, platID)
-                ret["platforms"][platID] = {
-                    "updateTime": self.graph.getLastUpdateTime(nodeID),
-                }
-
-                if getArg("predictions", "true").lower() == "true":
-                    predictions = self.graph.getNodePredictions()[nodeID]
-                    if getArg("tramPredictions", "true").lower() == "false":
-                        for tram in predictions:
-                            del(tram["predictions"])
-                    ret["platforms"][platID]["predictions"] = predictions
-                    ret["platforms"][platID]["here"] = (
-                        self.graph.getTramsHeres()[nodeID])
-
-                if getArg("message", "true").lower() == "true":
-                    ret["platforms"][platID]["message"] = (
-                        self.graph.getMessage(nodeID))
-
-                if getArg("meta", "false").lower() == "true":
-                    dwellTimes = self.graph.getDwellTimes()[nodeID]
-                    averageDwell = timedelta()
-                    for dwellTime in dwellTimes:
-                        averageDwell = averageDwell + dwellTime
-                    if len(dwellTimes) > 0:
-                        averageDwell = averageDwell/len(dwellTimes)
-                    else:
-                        averageDwell = None
-
-                    pred = {}
-                    for pNodeID in self.graph.getNodePreds(nodeID):
-                        pred[pNodeID] = {
-                            "transitTimes": self.graph.getTransit(
-                                pNodeID, nodeID)
-                            }
-
-                        (pred[pNodeID]["averageTransitTime"],
-                            isDirectAverage) = self.graph.getAverageTransit(
-                                pNodeID,
-                                nodeID)
-
-                    ret["platforms"][platID]["mapPos"] = {
-                        "x": self.graph.getMapPos(nodeID)[0],
-                        "y": self.graph.getMapPos(nodeID)[1]
-                        }
-                    ret["platforms"][platID]["dwellTimes"] = dwellTimes
-                    ret["platforms"][platID]["averageDwellTime"] = averageDwell
-                    ret["platforms"][platID]["predecessors"] = pred
+                ret["platforms"][platID] = getPlatformData(
+                    self.graph, snapshot, nodeID, flags)
 
-            if getArg("departed", "false").lower() == "true":
+            if departed:
                 ret["platforms"][platID]["departed"] = (
-                    self.graph.getTramsDeparteds()[nodeID])
+                    snapshot.getTramsDeparteds()[nodeID])
 
-        self.write(ret)
+        return ret
 
 
 class StationNamePlatHandler(BaseHandler):
     def get(self, stationName, platID):
-        def getArg(name, default):
-            arg = self.get_query_arguments(name)
-            if arg == []:
-                arg = default
-            else:
-                arg = arg[0]
-
-            return arg
-
         nodeID = "{}_{}".format(stationName, platID)
         if nodeID not in self.graph.getNodes():
             raise tornado.web.HTTPError(404)
 
-        ret = {
-            "updateTime": self.graph.getLastUpdateTime(nodeID),
-        }
+        departed = self.getArg("departed", "false").lower() == "true"
+        flags = self.getPlatformFlags()
+        self.writeCached(
+            (nodeID, departed, flags),
+            lambda snapshot: self.build(snapshot, nodeID, departed, flags))
+
+    def build(self, snapshot, nodeID, departed, flags):
+        ret = getPlatformData(self.graph, snapshot, nodeID, flags)
+
+        if departed:
+            ret["departed"] = snapshot.getTramsDeparteds()[nodeID]
+
+        return ret
+
+
+class BatchHandler(BaseHandler):
+    # The data for several stations & platforms at once
+    defaultFields = ["updateTime", "predictions", "here", "message"]
+
+    def get(self):
+        nodeIDs = getQueryPlatformIDs(self)
+
+        fields = [
+            field
+            for arg in self.get_query_arguments("fields")
+            for field in arg.split(",") if field != ""]
+        if len(fields) == 0:
+            fields = self.defaultFields
+        fields = tuple(sorted(set(fields)))
+
+        fieldTree = parseFields(fields)
+        for field in fieldTree:
+            if field not in platformFields:
+                raise tornado.web.HTTPError(
+                    400, "Unknown field {}".format(field))
+
+        self.writeCached(
+            (nodeIDs, fields),
+            lambda snapshot: self.build(snapshot, nodeIDs, fieldTree))
+
+    def build(self, snapshot, nodeIDs, fieldTree):
+        platforms = {}
+        for nodeID in nodeIDs:
+            platforms[nodeID] = {}
+            for field, subTree in fieldTree.items():
+                # Trams' predictions are only added to predicted arrivals if
+                # they're wanted
+                tramPredictions = (
+                    (subTree is None) or ("predictions" in subTree))
+                platforms[nodeID][field] = projectFields(
+                    platformFields[field](
+                        self.graph, snapshot, nodeID, tramPredictions),
+                    subTree)
+
+        return {"platforms": platforms}
+
+
+class TramsHandler(BaseHandler):
+    def get(self):
+        verbose = self.getArg("verbose", "false").lower() == "true"
+        self.writeCached(
+            (verbose,), lambda snapshot: self.build(snapshot, verbose))
+
+    def build(self, snapshot, verbose):
+        tramIDs = snapshot.getTramIDs()
+        if not verbose:
+            ret = ["{}/".format(tramID) for tramID in tramIDs]
+        else:
+            ret = {tramID: snapshot.getTram(tramID) for tramID in tramIDs}
+        return {"trams": ret}
+
+
+class TramIDHandler(BaseHandler):
+    def get(self, tramID):
+        tram = self.graph.getSnapshot().getTram(int(tramID))
+        if tram is None:
+            raise tornado.web.HTTPError(404)
+
+        self.writeData(tram)
 
-        if getArg("predictions", "true").lower() == "true":
-            predictions = self.graph.getNodePredictions()[nodeID]
-            if getArg("tramPredictions", "true").lower() == "false":
-                for tram in predictions:
-                    del(tram["predictions"])
-            ret["predictions"] = predictions
-            ret["here"] = self.graph.getTramsHeres()[nodeID]
-
-        if getArg("message", "true").lower() == "true":
-            ret["message"] = self.graph.getMessage(nodeID)
-
-        if getArg("meta", "false").lower() == "true":
-            dwellTimes = self.graph.getDwellTimes()[nodeID]
-            averageDwell = timedelta()
-            for dwellTime in dwellTimes:
-                averageDwell = averageDwell + dwellTime
-            if len(dwellTimes) > 0:
-                averageDwell = averageDwell/len(dwellTimes)
-            else:
-                averageDwell = None
-
-            pred = {}
-            for pNodeID in self.graph.getNodePreds(nodeID):
-                pred[pNodeID] = {
-                    "transitTimes": self.graph.getTransit(pNodeID, nodeID)
-                    }
 
-                (pred[pNodeID]["averageTransitTime"],
-                    isDirectAverage) = self.graph.getAverageTransit(
-                        pNodeID, nodeID)
+class StreamEventsHandler(BaseHandler):
+    # Streams updates as Server-Sent Events
+    async def get(self):
+        self.key = getQueryPlatformIDs(self)
+        self.closed = Event()
 
-            ret["mapPos"] = {
-                "x": self.graph.getMapPos(nodeID)[0],
-                "y": self.graph.getMapPos(nodeID)[1]
-                }
-            ret["dwellTimes"] = dwellTimes
-            ret["averageDwellTime"] = averageDwell
-            ret["predecessors"] = pred
+        self.set_header("Content-Type", "text/event-stream")
+        self.set_header("Cache-Control", "no-cache")
+        self.sendUpdate(self.subscriptions.subscribe(self.key, self))
+        await self.closed.wait()
 
-        if getArg("departed", "false").lower() == "true":
-            ret["departed"] = self.graph.getTramsDeparteds()[nodeID]
+    def sendUpdate(self, body):
+        self.write("data: {}\n\n".format(body))
+        self.flush()
 
-        self.write(ret)
+    def on_connection_close(self):
+        self.subscriptions.unsubscribe(self.key, self)
+        self.closed.set()
+
+
+class StreamSocketHandler(WebSocketHandler):
+    # Streams updates over a WebSocket
+    def initialize(self, graph, clock, metrics, responseCache, config,
+                   subscriptions, status):
+        self.graph = graph
+        self.config = config
+        self.subscriptions = subscriptions
+
+    def check_origin(self, origin):
+        allowedOrigin = self.config.get("Access-Control-Allow-Origin", "*")
+        return allowedOrigin in ["*", origin]
+
+    def prepare(self):
+        # Checked before the connection is upgraded so bad subscriptions get
+        # an HTTP error
+        self.key = getQueryPlatformIDs(self)
+
+    def open(self):
+        self.sendUpdate(self.subscriptions.subscribe(self.key, self))
+
+    def sendUpdate(self, body):
+        try:
+            self.write_message(body)
+        except WebSocketClosedError:
+            self.subscriptions.unsubscribe(self.key, self)
+
+    def on_close(self):
+        self.subscriptions.unsubscribe(self.key, self)
+
+
+def getAge(now, time, startTime):
+    # Seconds since time, or since we started if it's not happened yet
+    if time is None:
+        time = startTime
+    return (now - time).total_seconds()
 
 
 class HealthHandler(BaseHandler):
+    # Whether we're ready to serve predictions. Failing checks give a 503
+    # rather than stopping the service so whatever's watching us decides
+    # what to do
+    ready = True
+
     def get(self):
-        now = datetime.now()
-        lastUpdated = self.graph.getLocalUpdateTime()
-        updateDelta = now - lastUpdated
+        now = self.clock()
+        status = self.status
+        snapshot = self.graph.getSnapshot()
+        noAverages = 100 * len(snapshot.nodesNoAvDwell()) / len(
+            self.graph.getNodes())
+
+        # {name: (value, limit)}. The update loop finishing cycles shows
+        # we're alive. Getting data from TfGM & having averages to predict
+        # with show we're ready
+        checks = {
+            "cycleAge": (
+                getAge(now, status.lastCycleTime, status.startTime),
+                self.config.get("liveMaxCycleAge", 120))
+        }
+        if self.ready:
+            checks["fetchAge"] = (
+                getAge(now, status.lastFetchTime, status.startTime),
+                self.config.get("readyMaxFetchAge", 30))
+            checks["updateAge"] = (
+                getAge(now, snapshot.getLocalUpdateTime(), status.startTime),
+                self.config.get("readyMaxUpdateAge", 30))
+            checks["errorStreak"] = (
+                status.errorStreak,
+                self.config.get("readyMaxErrorStreak", 5))
+            checks["platformsWithoutAverages"] = (
+                noAverages,
+                self.config.get("readyMaxWithoutAverages", 100))
+
+        healthy = True
+        ret = {
+            "checks": {},
+            "startTime": status.startTime,
+            "cycleStartTime": status.cycleStartTime,
+            "lastCycleTime": status.lastCycleTime,
+            "lastFetchTime": status.lastFetchTime,
+            "lastErrorTime": status.lastErrorTime,
+            "lastUpdateTime": snapshot.getLocalUpdateTime(),
+            "errorStreak": status.errorStreak,
+            "cycleDurations": status.getCycleDurationPercentiles(),
+            "platformsWithoutAverages": noAverages
+        }
+        for name, (value, limit) in checks.items():
+            ok = value <= limit
+            healthy = healthy and ok
+            ret["checks"][name] = {"value": value, "limit": limit, "ok": ok}
+
+        logging.debug("DEBUG: health checks {}".format(ret["checks"]))
 
-        logging.debug("DEBUG: update delta {}".format(updateDelta))
+        ret["status"] = "ok" if healthy else "failing"
+        if not healthy:
+            self.set_status(503)
+        self.writeData(ret)
 
-        if updateDelta > timedelta(seconds=30):
-            exit(1)
 
-        self.write("ok")
+class HealthLiveHandler(HealthHandler):
+    # Whether the update loop is still running. Only this needs to pass
+    # for us to be left running
+    ready = False
+
+
+class MetricsHandler(BaseHandler):
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4")
+        self.write(self.metrics.render())
 
 
 class Application():
-    async def run():
-        graph = TramGraph()
-        gu = GraphUpdater(graph)
+    def makeGraph(config):
+        return TramGraph(
+            incremental=config.get("incrementalUpdates", True),
+            batchPredictions=config.get("batchPredictions", True),
+            statsWindow=config.get("statsWindow", 5),
+            statsDecay=config.get("statsDecay"))
+
+    def makeUpdater(config, graph, clock, metrics, subscriptions=None,
+                    sharedSnapshot=None, status=None):
+        api = TFGMMetrolinksAPI(clock=clock, metrics=metrics, config=config)
+        scheduler = PollScheduler()
+
+        def applyConfig(config):
+            # Settings that can change without a restart. The API client
+            # applies its own
+            scheduler.setLimits(
+                config.get("pollInterval", 1),
+                config.get("pollDeadline", 5),
+                config.get("pollMaxBackoff", 60))
+
+        applyConfig(config)
+        config.onReload(applyConfig)
+
+        checkpointer = None
+        if config.get("checkpoint") is not None:
+            checkpointer = Checkpointer(
+                config["checkpoint"],
+                interval=config.get("checkpointInterval", 60),
+                clock=clock)
+            checkpointer.load(
+                graph,
+                maxAge=config.get("checkpointMaxAge", 300),
+                statsMaxAge=config.get("checkpointStatsMaxAge", 86400))
+
+        return GraphUpdater(
+            graph, api, clock=clock, scheduler=scheduler, metrics=metrics,
+            checkpointer=checkpointer, subscriptions=subscriptions,
+            sharedSnapshot=sharedSnapshot, status=status)
+
+    def watchConfig(config):
+        # Reload the config when we're sent SIGHUP or the file changes
         loop = asyncio.get_event_loop()
-        ul = loop.create_task(gu.updateLoop())
+        loop.add_signal_handler(signal.SIGHUP, config.reload)
+        PeriodicCallback(
+            config.checkForChanges,
+            config.get("configCheckInterval", 5) * 1000).start()
 
-        handlerArgs = {"graph": graph}
+    def watchParent(parentPID):
+        # Forked processes stop if the process that started them has gone
+        def checkParent():
+            if os.getppid() != parentPID:
+                exit(0)
 
-        application = tornado.web.Application([
+        PeriodicCallback(checkParent, 1000).start()
+
+    def makeApplication(handlerArgs):
+        return tornado.web.Application([
            (r"/", MainHandler, handlerArgs),
+           (r"/batch/?", BatchHandler, handlerArgs),
            (r"/debug/?", DebugHandler, handlerArgs),
            (r"/health/?", HealthHandler, handlerArgs),
+           (r"/health/live/?", HealthLiveHandler, handlerArgs),
+           (r"/health/ready/?", HealthHandler, handlerArgs),
+           (r"/metrics/?", MetricsHandler, handlerArgs),
            (r"/station/?", StationHandler, handlerArgs),
            (r"/station/([^/]*)/?", StationNameHandler, handlerArgs),
            (r"/station/([^/]*)/([^/]*)/?", StationNamePlatHandler, handlerArgs
             ),
+           (r"/stream/events/?", StreamEventsHandler, handlerArgs),
+           (r"/stream/socket/?", StreamSocketHandler, handlerArgs),
+           (r"/trams/?", TramsHandler, handlerArgs),
+           (r"/tram/([0-9]+)/?", TramIDHandler, handlerArgs),
         ])
 
-        with open("/etc/metrolinkTimes/metrolinkTimes.conf") as conf_file:
-            port = json.load(conf_file).get("port", 5000)
+    def makeServer(handlerArgs):
+        return HTTPServer(Application.makeApplication(handlerArgs))
+
+    async def run(config=None):
+        if config is None:
+            config = Config()
+
+        clock = datetime.now
+        metrics = Metrics()
+        graph = Application.makeGraph(config)
+        subscriptions = Subscriptions(graph)
+        status = UpdateStatus(clock())
+        gu = Application.makeUpdater(
+            config, graph, clock, metrics, subscriptions=subscriptions,
+            status=status)
+        loop = asyncio.get_event_loop()
+        ul = loop.create_task(gu.updateLoop())
 
-        server = HTTPServer(application)
-        server.listen(port)
+        Application.watchConfig(config)
+
+        handlerArgs = {
+            "graph": graph,
+            "clock": clock,
+            "metrics": metrics,
+            "responseCache": ResponseCache(),
+            "config": config,
+            "subscriptions": subscriptions,
+            "status": status
+        }
+
+        server = Application.makeServer(handlerArgs)
+        server.listen(config.get("port", 5000))
 
         await ul
+
+    def runWorkers(config):
+        # One process polls TfGM & updates the graph, publishing each
+        # snapshot to shared memory. The others serve requests from those
+        # snapshots, sharing the port. Processes that die are restarted
+        graph = Application.makeGraph(config)
+        sharedFile = createSharedFile()
+
+        def forwardSignal(signum, frame):
+            # Pass SIGHUP on to the processes we've started so they reload
+            # the config
+            signal.signal(signum, signal.SIG_IGN)
+            os.killpg(0, signum)
+            signal.signal(signum, forwardSignal)
+
+        # SIGHUP is passed on to our process group, so start one of our own
+        # rather than sending it to whatever started us. A process that
+        # already leads its group, as a session leader must, keeps it
+        if os.getpgrp() != os.getpid():
+            os.setpgrp()
+        signal.signal(signal.SIGHUP, forwardSignal)
+        taskID = fork_processes(config["workers"] + 1)
+
+        # SIGHUP is handled by the IOLoop once it's running
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        parentPID = os.getppid()
+        if taskID == 0:
+            runTask = Application.runUpdater
+        else:
+            runTask = Application.runWorker
+
+        IOLoop.current().run_sync(
+            lambda: runTask(config, graph, sharedFile, parentPID))
+
+    async def runUpdater(config, graph, sharedFile, parentPID):
+        clock = datetime.now
+        metrics = Metrics()
+        gu = Application.makeUpdater(
+            config, graph, clock, metrics,
+            sharedSnapshot=SharedSnapshotWriter(sharedFile))
+
+        Application.watchConfig(config)
+        Application.watchParent(parentPID)
+
+        await gu.updateLoop()
+
+    async def runWorker(config, graph, sharedFile, parentPID):
+        clock = datetime.now
+        metrics = Metrics()
+        reader = SharedSnapshotReader(sharedFile)
+        subscriptions = Subscriptions(graph)
+        # Updated with the updater's status along with each snapshot
+        status = UpdateStatus(clock())
+
+        def checkForSnapshot():
+            if not reader.read():
+                return
+
+            updaterMetrics, updaterStatus = reader.extra
+            graph.setSnapshot(reader.snapshot)
+            metrics.useUpdaterMetrics(updaterMetrics)
+            status.copyFrom(updaterStatus)
+            subscriptions.publish(reader.snapshot)
+            metrics.subscribers.set(subscriptions.countSubscribers())
+
+        checkForSnapshot()
+        PeriodicCallback(checkForSnapshot, 100).start()
+
+        Application.watchConfig(config)
+        Application.watchParent(parentPID)
+
+        handlerArgs = {
+            "graph": graph,
+            "clock": clock,
+            "metrics": metrics,
+            "responseCache": ResponseCache(),
+            "config": config,
+            "subscriptions": subscriptions,
+            "status": status
+        }
+
+        server = Application.makeServer(handlerArgs)
+        server.add_sockets(
+            bind_sockets(config.get("port", 5000), reuse_port=True))
+
+        # Serve until we're stopped
+        await Event().wait()
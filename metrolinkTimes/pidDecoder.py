@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+import logging
+import sys
+from datetime import datetime
+
+from metrolinkTimes.epoch import toEpoch
+
+# Destinations shown on PIDs for trams that aren't going anywhere useful
+notInServiceDests = ["Terminates Here", "See Tram Front", "Not in Service"]
+
+stationMappings = {
+    "Ashton-under-Lyne": "Ashton-Under-Lyne",
+    "Deansgate Castlefield": "Deansgate - Castlefield",
+    "Deansgate": "Deansgate - Castlefield",
+    "Ashton": "Ashton-Under-Lyne",
+    "MCUK": "MediaCityUK",
+    "Newton Heath": "Newton Heath and Moston",
+    "Victoria Millgate Siding": "Victoria",
+    "Rochdale Stn": "Rochdale Railway Station",
+    "Trafford Centre": "The Trafford Centre",
+    "intu Trafford Centre": "The Trafford Centre",
+    "Wythen. Town": "Wythenshawe Town Centre"
+}
+
+pidSlots = [
+    ("Dest{}".format(i),
+     "Carriages{}".format(i),
+     "Status{}".format(i),
+     "Wait{}".format(i))
+    for i in range(4)]
+
+
+class PIDDecoder:
+    def __init__(self, stationIndex, maxCacheSize=10000):
+        # Every name we might see on a PID, mapped to the index of the
+        # station it means. Trams that aren't in service map to None
+        self.dests = {}
+        for station, index in stationIndex.items():
+            self.dests[station] = index
+        for dest in notInServiceDests:
+            self.dests[dest] = None
+        for name, station in stationMappings.items():
+            self.dests[name] = stationIndex[station]
+
+        self.maxCacheSize = maxCacheSize
+        self.destCache = {}
+        self.timeCache = {}
+
+    def decodeDest(self, rawDest):
+        # Returns (dest, via) or None if we don't know the destination or the
+        # tram isn't in service
+        if rawDest in self.destCache:
+            return self.destCache[rawDest]
+
+        if len(self.destCache) >= self.maxCacheSize:
+            self.destCache.clear()
+
+        stationName = rawDest
+        viaName = None
+        if " via " in stationName:
+            splitName = stationName.split(" via ")
+            stationName = splitName[0]
+            viaName = splitName[1]
+
+        decoded = None
+        if stationName not in self.dests:
+            logging.error("Unknown station {}".format(stationName))
+        else:
+            if (viaName is not None) and (viaName not in self.dests):
+                logging.error("Unknown station {}".format(viaName))
+            dest = self.dests[stationName]
+            if dest is not None:
+                decoded = (dest, self.dests.get(viaName))
+
+        self.destCache[rawDest] = decoded
+        return decoded
+
+    def decodeTime(self, rawTime):
+        if rawTime not in self.timeCache:
+            if len(self.timeCache) >= self.maxCacheSize:
+                self.timeCache.clear()
+            self.timeCache[rawTime] = toEpoch(datetime.strptime(
+                rawTime, "%Y-%m-%dT%H:%M:%SZ"))
+        return self.timeCache[rawTime]
+
+    def decodeMessage(self, rawMessage):
+        if rawMessage.startswith("^F0") or (rawMessage == "<no message>"):
+            return None
+
+        # This seems to be how flashing is encoded. We'll get rid of it
+        return rawMessage.replace("^$", "")
+
+    def decodeTrams(self, apiPID):
+        # Trams are (dest, via, carriages, status, wait) tuples
+        trams = []
+        for destKey, carriagesKey, statusKey, waitKey in pidSlots:
+            rawDest = apiPID[destKey]
+            if rawDest == "":
+                continue
+
+            decoded = self.decodeDest(rawDest)
+            if decoded is None:
+                continue
+
+            trams.append((
+                decoded[0],
+                decoded[1],
+                sys.intern(apiPID[carriagesKey]),
+                apiPID[statusKey],
+                int(apiPID[waitKey])))
+        return trams
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+import logging
+import random
+from collections import deque
+from datetime import timedelta
+from statistics import median
+
+
+class PollScheduler:
+    def __init__(self, minInterval=1, deadline=5, maxBackoff=60,
+                 freshOffset=0.5):
+        self.setLimits(minInterval, deadline, maxBackoff)
+        self.freshOffset = timedelta(seconds=freshOffset)
+
+        self.failures = 0
+        self.newestUpdateTime = None
+        # Gaps between successive changes to the newest update time TfGM
+        # gives us
+        self.cadences = deque(maxlen=20)
+        # How long after its update time we first saw fresh data. This
+        # includes any difference between our clock & TfGM's
+        self.lags = deque(maxlen=20)
+
+    def setLimits(self, minInterval, deadline, maxBackoff):
+        self.minInterval = timedelta(seconds=minInterval)
+        self.deadline = deadline
+        self.maxBackoff = maxBackoff
+
+    def getCadence(self):
+        if len(self.cadences) == 0:
+            return None
+        return median(self.cadences)
+
+    def recordPoll(self, pollTime, success, newestUpdateTime):
+        if not success:
+            self.failures += 1
+            return
+
+        self.failures = 0
+
+        if newestUpdateTime is None:
+            return
+
+        if ((self.newestUpdateTime is not None)
+           and (newestUpdateTime > self.newestUpdateTime)):
+            self.cadences.append(newestUpdateTime - self.newestUpdateTime)
+
+        if ((self.newestUpdateTime is None)
+           or (newestUpdateTime > self.newestUpdateTime)):
+            self.newestUpdateTime = newestUpdateTime
+            self.lags.append(pollTime - newestUpdateTime)
+
+    def backoffDelay(self):
+        delay = min(
+            self.maxBackoff,
+            self.minInterval.total_seconds() * (2 ** self.failures))
+        # Jitter so we don't hit TfGM in lockstep with anyone else
+        return random.uniform(delay / 2, delay)
+
+    def nextDelay(self, now, cycleTime):
+        if self.failures > 0:
+            return self.backoffDelay()
+
+        cadence = self.getCadence()
+        if cadence is None:
+            return max(
+                0, (self.minInterval - cycleTime).total_seconds())
+
+        # Aim to poll just after we expect the next update to be visible
+        nextFresh = (self.newestUpdateTime + cadence + min(self.lags)
+                     + self.freshOffset)
+
+        if nextFresh + cadence < now:
+            # We've overrun. Don't try to catch up on the updates we've
+            # missed, just poll for the latest one
+            logging.warning("Update cycle overran by {} update(s)".format(
+                int((now - nextFresh) / cadence)))
+
+        # If fresh data is late, keep polling but not too often
+        earliest = now + max(timedelta(), self.minInterval - cycleTime)
+        return (max(nextFresh, earliest) - now).total_seconds()
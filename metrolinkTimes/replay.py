@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import logging
+from time import perf_counter
+
+from metrolinkTimes.feedLog import readFeedLog
+from metrolinkTimes.metrolinkTimes import GraphUpdater
+from metrolinkTimes.tfgmMetrolinksAPI import parseData
+from metrolinkTimes.tramGraph import TramGraph
+
+
+class SimulatedClock:
+    def __init__(self, time=None):
+        self.time = time
+
+    def set(self, time):
+        self.time = time
+
+    def now(self):
+        return self.time
+
+
+def replay(logPath, incremental=True):
+    clock = SimulatedClock()
+    graph = TramGraph(incremental=incremental)
+    gu = GraphUpdater(graph, None, clock=clock.now)
+
+    cycles = 0
+    failed = 0
+    cycleTimes = []
+
+    for fetchTime, payload in readFeedLog(logPath):
+        clock.set(fetchTime)
+        try:
+            data = parseData(json.loads(payload))
+        except Exception as e:
+            logging.error("{}".format(e))
+            data = None
+            failed += 1
+
+        startTime = perf_counter()
+        gu.update(data)
+        cycleTimes.append(perf_counter() - startTime)
+        cycles += 1
+
+    return cycles, failed, cycleTimes
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replay a recorded TfGM feed through the update loop")
+    parser.add_argument("log", help="feed log written by recordFeed")
+    parser.add_argument(
+        "--full", action="store_true",
+        help="reprocess the whole network on every change")
+    args = parser.parse_args()
+
+    cycles, failed, cycleTimes = replay(
+        args.log, incremental=not args.full)
+
+    total = sum(cycleTimes)
+    print("Replayed {} payloads ({} unreadable) in {:.2f}s".format(
+        cycles, failed, total))
+    if cycles:
+        cycleTimes.sort()
+        print("Cycle time mean {:.1f}ms, median {:.1f}ms, max {:.1f}ms".format(
+            total / cycles * 1000,
+            cycleTimes[cycles // 2] * 1000,
+            cycleTimes[-1] * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,22 @@
+#!/usr/bin/env python3
+
+
+class ResponseCache:
+    # Encoded responses for the newest snapshot. Responses only change when
+    # a new snapshot is published so they're kept until then. Keys are made
+    # from the handler, its path arguments & its normalised query flags
+    def __init__(self):
+        self.generation = None
+        self.responses = {}
+
+    def get(self, generation, key):
+        if generation != self.generation:
+            return None
+        return self.responses.get(key)
+
+    def set(self, generation, key, response):
+        if generation != self.generation:
+            # Responses for older snapshots won't be asked for again
+            self.generation = generation
+            self.responses = {}
+        self.responses[key] = response
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+
+
+class RollingMean:
+    # The most recent times seen, kept in a ring buffer alongside their
+    # running total so the mean doesn't need recalculating. If decay is set
+    # the mean is an exponentially weighted moving average instead, with
+    # decay being the weight given to each new time
+    __slots__ = ("times", "next", "count", "total", "decay", "average")
+
+    def __init__(self, window=5, decay=None):
+        self.times = [0] * window
+        self.next = 0
+        self.count = 0
+        self.total = 0
+        self.decay = decay
+        self.average = None
+
+    def add(self, time):
+        if self.count == len(self.times):
+            self.total -= self.times[self.next]
+        else:
+            self.count += 1
+        self.times[self.next] = time
+        self.total += time
+        self.next = (self.next + 1) % len(self.times)
+
+        if self.decay is not None:
+            if self.average is None:
+                self.average = time
+            else:
+                self.average += self.decay * (time - self.average)
+
+    def mean(self):
+        if self.count == 0:
+            return None
+        if self.decay is not None:
+            return self.average
+        return self.total / self.count
+
+    def getTimes(self):
+        # Oldest first
+        if self.count < len(self.times):
+            return self.times[:self.count]
+        return self.times[self.next:] + self.times[:self.next]
+
+    def __len__(self):
+        return self.count
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+import mmap
+import os
+import pickle
+import struct
+import tempfile
+
+# The start of the shared file says where the newest snapshot is:
+# (sequence, version, offset, snapshot length, extra length). The sequence
+# is odd while the header's being changed. The version changes with the
+# snapshot, & carries on from where it was if the writer's restarted
+headerFormat = "<QQQQQ"
+headerSize = mmap.PAGESIZE
+minCapacity = 1 << 20
+
+
+def createSharedFile():
+    # An unnamed file, in memory if possible, shared with forked processes
+    # through its file descriptor
+    directory = None
+    if os.path.isdir("/dev/shm"):
+        directory = "/dev/shm"
+    sharedFile = tempfile.TemporaryFile(dir=directory)
+    # Sized now so readers can map it before anything's been published
+    os.ftruncate(sharedFile.fileno(), headerSize + 2 * minCapacity)
+    return sharedFile
+
+
+class SharedSnapshotWriter:
+    # Publishes snapshots to other processes. The file holds two slots &
+    # each snapshot is written to the slot that isn't being read from
+    # before the header is changed to point to it. The file is grown if a
+    # snapshot doesn't fit, with the new slots placed clear of the old ones.
+    #
+    # Anything else the readers need, such as metrics, is published with
+    # each snapshot as extra. If only the extra has changed it's written
+    # over the last one, after the snapshot that's already there. Readers
+    # part way through reading it see the sequence change & try again
+    def __init__(self, sharedFile):
+        self.fd = sharedFile.fileno()
+        self.map = mmap.mmap(self.fd, 0)
+        self.generation = None
+        self.snapshotData = None
+        self.version = struct.unpack_from(headerFormat, self.map, 0)[1]
+
+    def getCapacity(self):
+        return (len(self.map) - headerSize) // 2
+
+    def publish(self, snapshot, extra=None):
+        extraData = pickle.dumps(extra, protocol=pickle.HIGHEST_PROTOCOL)
+        sequence, _, offset, _, _ = struct.unpack_from(
+            headerFormat, self.map, 0)
+        capacity = self.getCapacity()
+
+        inPlace = (
+            (snapshot.generation == self.generation)
+            and (len(self.snapshotData) + len(extraData) <= capacity))
+        if not inPlace:
+            # Snapshots are only pickled once per generation
+            if snapshot.generation != self.generation:
+                self.snapshotData = pickle.dumps(
+                    snapshot, protocol=pickle.HIGHEST_PROTOCOL)
+                self.generation = snapshot.generation
+                self.version += 1
+            length = len(self.snapshotData) + len(extraData)
+
+            if length > capacity:
+                newCapacity = max(2 * capacity, 2 * length)
+                os.ftruncate(self.fd, headerSize + 2 * newCapacity)
+                self.map.close()
+                self.map = mmap.mmap(self.fd, 0)
+                offset = headerSize + newCapacity
+            elif offset == headerSize:
+                offset = headerSize + capacity
+            else:
+                offset = headerSize
+
+        struct.pack_into("<Q", self.map, 0, sequence + 1)
+        extraStart = offset + len(self.snapshotData)
+        if not inPlace:
+            self.map[offset:extraStart] = self.snapshotData
+        self.map[extraStart:extraStart + len(extraData)] = extraData
+
+        struct.pack_into(
+            headerFormat, self.map, 0, sequence + 1, self.version, offset,
+            len(self.snapshotData), len(extraData))
+        struct.pack_into("<Q", self.map, 0, sequence + 2)
+
+
+class SharedSnapshotReader:
+    # Reads the snapshots published by a SharedSnapshotWriter. They're
+    # unpickled straight from the shared memory, & only when their version
+    # changes
+    def __init__(self, sharedFile, retries=3):
+        self.fd = sharedFile.fileno()
+        self.retries = retries
+        self.map = None
+        self.sequence = 0
+        self.version = None
+        self.snapshot = None
+        self.extra = None
+
+    def remap(self):
+        if self.map is not None:
+            self.map.close()
+        self.map = mmap.mmap(self.fd, 0, access=mmap.ACCESS_READ)
+
+    def read(self):
+        # Returns whether anything new has been published since the last
+        # read
+        if self.map is None:
+            self.remap()
+
+        for attempt in range(self.retries):
+            (sequence, version, offset, snapshotLength,
+                extraLength) = struct.unpack_from(headerFormat, self.map, 0)
+            if (sequence == self.sequence) or (sequence % 2 == 1):
+                # Nothing new, or the writer is part way through publishing
+                return False
+
+            end = offset + snapshotLength + extraLength
+            if end > len(self.map):
+                # The file's grown
+                self.remap()
+                continue
+
+            try:
+                with memoryview(self.map) as view:
+                    snapshot = self.snapshot
+                    if version != self.version:
+                        with view[offset:offset + snapshotLength] as data:
+                            snapshot = pickle.loads(data)
+                    with view[offset + snapshotLength:end] as data:
+                        extra = pickle.loads(data)
+            except Exception:
+                # Overwritten while we were reading it
+                continue
+
+            if struct.unpack_from("<Q", self.map, 0)[0] != sequence:
+                continue
+
+            self.sequence = sequence
+            self.version = version
+            self.snapshot = snapshot
+            self.extra = extra
+            return True
+
+        return False
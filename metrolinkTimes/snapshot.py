@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+
+from datetime import timedelta
+
+from metrolinkTimes.epoch import fromEpoch
+
+
+def toTimedelta(seconds):
+    if seconds is None:
+        return None
+    return timedelta(seconds=seconds)
+
+
+class ReadOnlyDict(dict):
+    # Snapshots are shared by every request so nothing handed out from one
+    # can be changed. Still a dict so it can be written out as JSON
+    __slots__ = ()
+
+    def readOnly(self, *args, **kwargs):
+        raise TypeError("Snapshots are read only")
+
+    __setitem__ = readOnly
+    __delitem__ = readOnly
+    __ior__ = readOnly
+    clear = readOnly
+    pop = readOnly
+    popitem = readOnly
+    setdefault = readOnly
+    update = readOnly
+
+    def __reduce__(self):
+        return (ReadOnlyDict, (dict(self),))
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+class Snapshot:
+    # The state of the graph at the end of an update. Snapshots are built in
+    # the updater thread & never modified after being published so handlers
+    # can read them while the next update is running.
+    #
+    # Most trams are unchanged between updates so their converted forms are
+    # looked up by their contents & shared with the previous snapshot
+    # rather than being made again
+    def __init__(self, graph, generation, previous=None):
+        self.generation = generation
+        self.localUpdateTime = graph.getLocalUpdateTime()
+
+        self.nodeIDs = graph.nodeIDs
+        self.stationNames = graph.stationNames
+
+        # Trams' predictions are converted once, however many platforms
+        # they're predicted to arrive at
+        self.convertedPredictions = {}
+        # Predictions of each tram predicted to arrive anywhere. Trams are
+        # told apart by their records rather than their IDs, which they might
+        # not have
+        tramPredictions = []
+        tramIndexes = {}
+        self.previousShared = {}
+        if previous is not None:
+            self.previousShared = previous.shared
+        self.shared = {}
+
+        updateTimes = {}
+        messages = {}
+        predictions = {}
+        tramsHere = {}
+        tramsDeparted = {}
+        tramsStarting = {}
+        dwellTimes = {}
+        averageDwells = {}
+        for node, nodeID in enumerate(self.nodeIDs):
+            platform = graph.platforms[node]
+            updateTimes[nodeID] = fromEpoch(platform.updateTime)
+            messages[nodeID] = platform.message
+            # Predicted arrivals without the predictions of the tram
+            # arriving, with where to look them up
+            for pTram in platform.predictedArrivals:
+                if id(pTram.tram) not in tramIndexes:
+                    tramIndexes[id(pTram.tram)] = len(tramPredictions)
+                    tramPredictions.append(
+                        self.convertPredictions(pTram.tram.predictions))
+            predictions[nodeID] = tuple(
+                (self.convertPredictedArrival(pTram),
+                 tramIndexes[id(pTram.tram)])
+                for pTram in platform.predictedArrivals)
+            tramsHere[nodeID] = tuple(
+                self.convertTram(tram, False) for tram in platform.tramsHere)
+            tramsDeparted[nodeID] = tuple(
+                self.convertTram(tram) for tram in platform.tramsDeparted)
+            tramsStarting[nodeID] = tuple(
+                self.convertTram(tram) for tram in platform.tramsApproaching)
+            dwellTimes[nodeID] = self.convertTimes(
+                platform.dwellTimes.getTimes())
+            averageDwell, isDirectAverage = graph.getAverageDwell(node)
+            averageDwells[nodeID] = (
+                toTimedelta(averageDwell), isDirectAverage)
+
+        transitTimes = {}
+        averageTransits = {}
+        for edge, (start, end) in enumerate(graph.edges):
+            edgeID = (self.nodeIDs[start], self.nodeIDs[end])
+            transitTimes[edgeID] = self.convertTimes(
+                graph.transitTimes[edge].getTimes())
+            averageTransit, isDirectAverage = graph.getAverageTransit(
+                start, end)
+            averageTransits[edgeID] = (
+                toTimedelta(averageTransit), isDirectAverage)
+
+        self.updateTimes = ReadOnlyDict(updateTimes)
+        self.messages = ReadOnlyDict(messages)
+        self.predictions = ReadOnlyDict(predictions)
+        self.tramPredictions = tuple(tramPredictions)
+        # Predicted arrivals with each tram's predictions, made for each
+        # platform the first time they're asked for
+        self.expandedPredictions = {}
+        self.tramsHere = ReadOnlyDict(tramsHere)
+        self.tramsDeparted = ReadOnlyDict(tramsDeparted)
+        self.tramsStarting = ReadOnlyDict(tramsStarting)
+        self.dwellTimes = ReadOnlyDict(dwellTimes)
+        self.averageDwells = ReadOnlyDict(averageDwells)
+        self.transitTimes = ReadOnlyDict(transitTimes)
+        self.averageTransits = ReadOnlyDict(averageTransits)
+
+        trams = {}
+        for tramID, trajectory in graph.trajectories.items():
+            trams[tramID] = self.convertTrajectory(trajectory)
+        self.trams = ReadOnlyDict(trams)
+        # Trams we currently know the location of
+        self.tramIDs = tuple(sorted(graph.locatedTramIDs))
+
+        self.noAvDwell = tuple(graph.nodesNoAvDwell())
+        self.noAvTrans = tuple(graph.edgesNoAvTrans())
+
+        del(self.convertedPredictions)
+        del(self.previousShared)
+
+    def __getstate__(self):
+        # What's shared with the next snapshot is only needed while it's
+        # being built
+        state = self.__dict__.copy()
+        del(state["shared"])
+        del(state["expandedPredictions"])
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.shared = {}
+        self.expandedPredictions = {}
+
+    def share(self, key, make):
+        if key not in self.shared:
+            if key in self.previousShared:
+                self.shared[key] = self.previousShared[key]
+            else:
+                self.shared[key] = make()
+        return self.shared[key]
+
+    def convertTimes(self, times):
+        return self.share(
+            ("times", tuple(times)),
+            lambda: tuple(toTimedelta(time) for time in times))
+
+    def convertPredictions(self, predictions):
+        if predictions is None:
+            return None
+        if id(predictions) not in self.convertedPredictions:
+            self.convertedPredictions[id(predictions)] = (
+                predictions,
+                self.share(
+                    ("predictions", tuple(predictions.items())),
+                    lambda: ReadOnlyDict({
+                        self.nodeIDs[plat]: fromEpoch(round(time))
+                        for plat, time in predictions.items()})))
+        return self.convertedPredictions[id(predictions)][1]
+
+    def convertTram(self, tram, showWait=True):
+        predictions = self.convertPredictions(tram.predictions)
+        wait = tram.wait if showWait else None
+        # Converted predictions are kept alive by what's shared so their ids
+        # can't be reused while they're part of a key
+        key = (
+            "tram", tram.dest, tram.via, tram.carriages, wait, tram.located,
+            tram.arriveTime, tram.departTime, tram.dwellTime,
+            tram.averageDwell, id(predictions), tram.startsHere,
+            tram.debCount, tram.tramID)
+
+        def make():
+            ret = {
+                "id": tram.tramID,
+                "dest": self.stationNames[tram.dest],
+                "via": None,
+                "carriages": tram.carriages
+            }
+            if tram.via is not None:
+                ret["via"] = self.stationNames[tram.via]
+            if wait is not None:
+                ret["wait"] = wait
+            if tram.located:
+                ret["arriveTime"] = fromEpoch(tram.arriveTime)
+            if tram.departTime is not None:
+                ret["departTime"] = fromEpoch(tram.departTime)
+                ret["dwellTime"] = toTimedelta(tram.dwellTime)
+                ret["averageDwell"] = toTimedelta(tram.averageDwell)
+            if predictions is not None:
+                ret["predictions"] = predictions
+            if tram.startsHere:
+                ret["startsHere"] = True
+            if tram.debCount:
+                ret["debCount"] = tram.debCount
+            return ReadOnlyDict(ret)
+
+        return self.share(key, make)
+
+    def convertPredictedArrival(self, pTram):
+        tram = pTram.tram
+        key = (
+            "predictedArrival", tram.dest, pTram.via, tram.carriages,
+            pTram.platform, pTram.status, tram.wait,
+            pTram.predictedArriveTime, tram.tramID)
+
+        def make():
+            curLoc = {
+                "platform": self.nodeIDs[pTram.platform],
+                "status": pTram.status
+            }
+            if tram.wait is not None:
+                curLoc["pidWait"] = tram.wait
+            ret = {
+                "id": tram.tramID,
+                "dest": self.stationNames[tram.dest],
+                "via": None,
+                "carriages": tram.carriages,
+                "curLoc": ReadOnlyDict(curLoc),
+                "predictedArriveTime": fromEpoch(
+                    round(pTram.predictedArriveTime))
+            }
+            if pTram.via is not None:
+                ret["via"] = self.stationNames[pTram.via]
+            return ReadOnlyDict(ret)
+
+        return self.share(key, make)
+
+    def convertTrajectory(self, trajectory):
+        key = ("trajectory", trajectory.tramID, trajectory.version)
+
+        def make():
+            predictions = self.convertPredictions(trajectory.predictions)
+            curLoc = None
+            if trajectory.location is not None:
+                node, status = trajectory.location
+                curLoc = ReadOnlyDict({
+                    "platform": self.nodeIDs[node],
+                    "status": status
+                })
+            ret = {
+                "id": trajectory.tramID,
+                "dest": self.stationNames[trajectory.dest],
+                "via": None,
+                "carriages": trajectory.carriages,
+                "curLoc": curLoc,
+                "lastSeen": fromEpoch(trajectory.lastSeen),
+                "history": tuple(
+                    ReadOnlyDict({
+                        "platform": self.nodeIDs[node],
+                        "event": event,
+                        "time": fromEpoch(time)
+                    })
+                    for node, event, time in trajectory.events),
+                "predictions": predictions
+            }
+            if trajectory.via is not None:
+                ret["via"] = self.stationNames[trajectory.via]
+            return ReadOnlyDict(ret)
+
+        return self.share(key, make)
+
+    def getLastUpdateTime(self, nodeID):
+        return self.updateTimes[nodeID]
+
+    def getMessage(self, nodeID):
+        return self.messages[nodeID]
+
+    def getTramsStarting(self):
+        return self.tramsStarting
+
+    def getTramsHeres(self):
+        return self.tramsHere
+
+    def getTramsDeparteds(self):
+        return self.tramsDeparted
+
+    def getNodePredictions(self):
+        return ReadOnlyDict(
+            (nodeID, self.getPlatformPredictions(nodeID))
+            for nodeID in self.predictions)
+
+    def getPlatformPredictions(self, nodeID, tramPredictions=True):
+        if not tramPredictions:
+            return tuple(pTram for pTram, tram in self.predictions[nodeID])
+
+        if nodeID not in self.expandedPredictions:
+            self.expandedPredictions[nodeID] = tuple(
+                ReadOnlyDict(pTram, predictions=self.tramPredictions[tram])
+                for pTram, tram in self.predictions[nodeID])
+        return self.expandedPredictions[nodeID]
+
+    def getTram(self, tramID):
+        return self.trams.get(tramID)
+
+    def getTramIDs(self):
+        return self.tramIDs
+
+    def getDwellTimes(self):
+        return self.dwellTimes
+
+    def getAverageDwell(self, platform):
+        return self.averageDwells[platform]
+
+    def getTransit(self, inNode, outNode):
+        return self.transitTimes[inNode, outNode]
+
+    def getAverageTransit(self, start, end):
+        return self.averageTransits[start, end]
+
+    def nodesNoAvDwell(self):
+        return self.noAvDwell
+
+    def edgesNoAvTrans(self):
+        return self.noAvTrans
+
+    def getLocalUpdateTime(self):
+        return self.localUpdateTime
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+import logging
+
+from metrolinkTimes.encoding import json_encode_compact
+
+# What's pushed for each platform & how to get it from a snapshot
+pushedFields = {
+    "predictions": lambda snapshot, nodeID: (
+        snapshot.getPlatformPredictions(nodeID)),
+    "here": lambda snapshot, nodeID: snapshot.getTramsHeres()[nodeID],
+    "message": lambda snapshot, nodeID: snapshot.getMessage(nodeID)
+}
+
+
+class Subscriptions:
+    # Clients streaming updates for a set of platforms. Clients subscribed
+    # to the same platforms share a key, the sorted tuple of their IDs, &
+    # after each update the changes for a key are worked out & encoded once
+    # then sent to all of its clients.
+    #
+    # Subscribers are anything with a sendUpdate(body) method
+    def __init__(self, graph):
+        # The snapshot clients have been sent. Updates are the changes from
+        # this to the next snapshot published
+        self.snapshot = graph.getSnapshot()
+        self.subscribers = {}
+        # {key: encoded full state} for self.snapshot
+        self.fullStates = {}
+
+    def countSubscribers(self):
+        return sum(
+            len(subscribers) for subscribers in self.subscribers.values())
+
+    def subscribe(self, key, subscriber):
+        # Returns the current state of the platforms for the subscriber to
+        # start from
+        self.subscribers.setdefault(key, set()).add(subscriber)
+
+        if key not in self.fullStates:
+            self.fullStates[key] = json_encode_compact({
+                "generation": self.snapshot.generation,
+                "full": True,
+                "platforms": {
+                    nodeID: {
+                        field: getField(self.snapshot, nodeID)
+                        for field, getField in pushedFields.items()}
+                    for nodeID in key}
+            })
+        return self.fullStates[key]
+
+    def unsubscribe(self, key, subscriber):
+        subscribers = self.subscribers.get(key)
+        if subscribers is None:
+            return
+        subscribers.discard(subscriber)
+        if len(subscribers) == 0:
+            del(self.subscribers[key])
+
+    def getChanges(self, previous, snapshot, nodeID):
+        changes = {}
+        for field, getField in pushedFields.items():
+            value = getField(snapshot, nodeID)
+            if value != getField(previous, nodeID):
+                changes[field] = value
+        return changes
+
+    def publish(self, snapshot):
+        if snapshot.generation == self.snapshot.generation:
+            return
+
+        previous = self.snapshot
+        self.snapshot = snapshot
+        self.fullStates = {}
+
+        # Each platform is compared once however many keys include it
+        changes = {}
+        for key, subscribers in list(self.subscribers.items()):
+            platforms = {}
+            for nodeID in key:
+                if nodeID not in changes:
+                    changes[nodeID] = self.getChanges(
+                        previous, snapshot, nodeID)
+                if changes[nodeID]:
+                    platforms[nodeID] = changes[nodeID]
+
+            if len(platforms) == 0:
+                continue
+
+            body = json_encode_compact({
+                "generation": snapshot.generation,
+                "platforms": platforms
+            })
+            for subscriber in list(subscribers):
+                try:
+                    subscriber.sendUpdate(body)
+                except Exception as e:
+                    logging.error("{}".format(e))
+                    self.unsubscribe(key, subscriber)
@@ -3,40 +3,141 @@
 import http.client
 import json
 import logging
-from time import sleep
+from datetime import datetime
+from time import perf_counter, sleep
+
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+
+from metrolinkTimes.config import Config
+from metrolinkTimes.feedLog import FeedRecorder
+from metrolinkTimes.metrics import Metrics
+
+try:
+    import pycurl  # noqa: F401
+except ImportError:
+    pycurl = None
+
+
+def parseData(data):
+    retData = {}
+    for platform in data["value"]:
+        sl = platform["StationLocation"]
+        if sl not in retData:
+            retData[sl] = {}
+
+        ac = platform["AtcoCode"]
+        if platform["AtcoCode"] not in retData[sl]:
+            retData[sl][ac] = []
+
+        retData[sl][ac].append(platform)
+
+    return retData
 
 
 class TFGMMetrolinksAPI:
-    def __init__(self):
-        with open("/etc/metrolinkTimes/metrolinkTimes.conf") as conf_file:
-            self.conf = json.load(conf_file)
+    def __init__(self, clock=datetime.now, metrics=None, config=None):
+        self.config = config
+        if self.config is None:
+            self.config = Config()
+
+        self.clock = clock
+        self.metrics = metrics
+        if self.metrics is None:
+            self.metrics = Metrics()
+        self.recorder = None
+        self.path = "/odata/Metrolinks"
+        self.httpClient = None
+
+        self.applyConfig(self.config)
+        self.config.onReload(self.applyConfig)
+
+    def applyConfig(self, config):
+        recordFeed = config.get("recordFeed")
+        if recordFeed is None:
+            self.recorder = None
+        elif (self.recorder is None) or (self.recorder.logPath != recordFeed):
+            self.recorder = FeedRecorder(recordFeed)
+
+        self.scheme = config.get("apiScheme", "https")
+        self.host = config.get("apiHost", "api.tfgm.com")
+        self.port = config.get("apiPort")
+        # Requests outliving the poll deadline would still be running when
+        # the next poll starts, so they're given up on at the deadline too
+        pollDeadline = config.get("pollDeadline", 5)
+        self.connectTimeout = min(
+            config.get("connectTimeout", 5), pollDeadline)
+        self.requestTimeout = min(
+            config.get("requestTimeout", 10), pollDeadline)
+
+    def getHeaders(self):
+        return {
+            # Request headers
+            "Ocp-Apim-Subscription-Key": self.config[
+                "Ocp-Apim-Subscription-Key"],
+        }
+
+    def decodeBody(self, body, fetchTime):
+        self.metrics.stageTime.observe(fetchTime, "fetch")
+        self.metrics.upstreamLatency.observe(fetchTime)
+        self.metrics.upstreamBytes.observe(len(body))
+
+        body = body.decode("utf-8")
+        if self.recorder is not None:
+            with self.metrics.time("record"):
+                self.recorder.record(self.clock(), body)
+
+        with self.metrics.time("parse"):
+            return parseData(json.loads(body))
 
     def getData(self):
         try:
-            headers = {
-                # Request headers
-                "Ocp-Apim-Subscription-Key": self.conf[
-                    "Ocp-Apim-Subscription-Key"],
-            }
-            conn = http.client.HTTPSConnection('api.tfgm.com')
-            conn.request("GET", "/odata/Metrolinks", "{body}", headers)
+            startTime = perf_counter()
+            if self.scheme == "http":
+                conn = http.client.HTTPConnection(
+                    self.host, port=self.port, timeout=self.requestTimeout)
+            else:
+                conn = http.client.HTTPSConnection(
+                    self.host, port=self.port, timeout=self.requestTimeout)
+            conn.request("GET", self.path, "{body}", self.getHeaders())
             response = conn.getresponse()
-            data = json.loads(response.read().decode("utf-8"))
+            body = response.read()
             conn.close()
 
-            retData = {}
-            for platform in data["value"]:
-                sl = platform["StationLocation"]
-                if sl not in retData:
-                    retData[sl] = {}
-
-                ac = platform["AtcoCode"]
-                if platform["AtcoCode"] not in retData[sl]:
-                    retData[sl][ac] = []
+            return self.decodeBody(body, perf_counter() - startTime)
 
-                retData[sl][ac].append(platform)
+        except Exception as e:
+            logging.error("{}".format(e))
+            return None
 
-            return retData
+    def getHTTPClient(self):
+        # The curl client keeps connections alive between polls so we don't
+        # pay for a TLS handshake every second. Tornado's simple client
+        # closes the connection after each request so we only fall back to it
+        # if pycurl isn't available
+        if self.httpClient is None:
+            if pycurl is not None:
+                AsyncHTTPClient.configure(
+                    "tornado.curl_httpclient.CurlAsyncHTTPClient")
+            self.httpClient = AsyncHTTPClient()
+        return self.httpClient
+
+    def getURL(self):
+        host = self.host
+        if self.port is not None:
+            host = "{}:{}".format(host, self.port)
+        return "{}://{}{}".format(self.scheme, host, self.path)
+
+    async def getDataAsync(self):
+        try:
+            request = HTTPRequest(
+                self.getURL(),
+                headers=self.getHeaders(),
+                connect_timeout=self.connectTimeout,
+                request_timeout=self.requestTimeout)
+            startTime = perf_counter()
+            response = await self.getHTTPClient().fetch(request)
+
+            return self.decodeBody(response.body, perf_counter() - startTime)
 
         except Exception as e:
             logging.error("{}".format(e))
@@ -1,23 +1,210 @@
 #!/usr/bin/env python3
 
+import bisect
+import heapq
+import itertools
 import json
 import operator
+from collections import Counter, OrderedDict, defaultdict, deque
 import networkx as nx
 import matplotlib.pyplot as plt
-from datetime import datetime, timedelta
+from datetime import datetime
 import logging
 import os
-from copy import deepcopy
+
+from metrolinkTimes.batchPredictor import BatchPredictor
+from metrolinkTimes.epoch import fromEpoch, toEpoch
+from metrolinkTimes.pidDecoder import PIDDecoder
+from metrolinkTimes.rollingMean import RollingMean
+from metrolinkTimes.snapshot import Snapshot
+
+# While updating, platforms are referred to by their index in nodeIDs,
+# stations by their index in stationNames & times are seconds since the epoch.
+# The networkx graph only holds the static topology
+
+# Lists of trams we keep track of between updates
+trackedStatuses = [
+    "tramsHere", "tramsHereDeb", "tramsApproaching", "tramsApproachingDeb",
+    "tramsDeparted"]
+
+# Lists of trams we know the location of
+locatedStatuses = ["tramsHere", "tramsHereDeb", "tramsDeparted"]
+
+# How trams in each list are described to clients
+shortStatuses = {
+    "tramsHere": "here",
+    "tramsDeparted": "departed",
+    "tramsApproaching": "dueStartsHere"
+}
+
+
+def tramKey(tram):
+    # Trams are matched between lists by where they're going & how long
+    # they are
+    return (tram.dest, tram.carriages)
+
+
+def arrivalKey(pTram):
+    # Predicted arrivals that look the same are matched as one tram. The
+    # same tram can be listed more than once
+    tram = pTram.tram
+    return (
+        tram.dest, pTram.via, tram.carriages, pTram.platform, pTram.status,
+        tram.wait, pTram.predictedArriveTime,
+        tuple(sorted(tram.predictions.items())))
+
+
+def indexTrams(trams):
+    # Trams with each key, in the order they're listed
+    index = defaultdict(deque)
+    for tram in trams:
+        index[tramKey(tram)].append(tram)
+    return index
+
+
+class Platform:
+    __slots__ = (
+        "station", "platformID", "pidTrams", "message", "updateTime",
+        "tramsDeparting", "tramsArrived", "tramsDue", "tramsApproaching",
+        "tramsApproachingDeb", "prevTramsHere", "tramsHere", "tramsHereDeb",
+        "tramsDeparted", "predictedArrivals", "dwellTimes", "preds", "succs",
+        "succWeights", "siblings", "approachingIDs")
+
+    def __init__(self, station, platformID, dwellTimes):
+        self.station = station
+        self.platformID = platformID
+        self.pidTrams = []
+        self.message = None
+        self.updateTime = toEpoch(datetime.min)
+
+        self.tramsDeparting = []
+        self.tramsArrived = []
+        self.tramsDue = []
+
+        self.tramsApproaching = []
+        self.tramsApproachingDeb = []
+        self.prevTramsHere = []
+        self.tramsHere = []
+        self.tramsHereDeb = []
+        self.tramsDeparted = []
+
+        self.predictedArrivals = []
+        self.dwellTimes = dwellTimes
+
+        # (platform, edge) pairs for platforms before this one
+        self.preds = []
+        self.succs = []
+        # (platform, weight) pairs for platforms after this one
+        self.succWeights = []
+        # Other platforms at the same station
+        self.siblings = []
+
+        # IDs of trams last found starting here, by tramKey
+        self.approachingIDs = {}
+
+
+class Tram:
+    __slots__ = (
+        "dest", "via", "carriages", "wait", "located", "arriveTime",
+        "departTime", "dwellTime", "averageDwell", "predictions",
+        "startsHere", "debCount", "tramID")
+
+    def __init__(self, dest, via, carriages, wait):
+        self.dest = dest
+        self.via = via
+        self.carriages = carriages
+        # None once the tram has departed
+        self.wait = wait
+        # Whether the tram has been seen at a platform. arriveTime is None if
+        # it was already there when we started
+        self.located = False
+        self.arriveTime = None
+        # Only set once the tram has departed
+        self.departTime = None
+        self.dwellTime = None
+        self.averageDwell = None
+        # {platform: time} or None if not predicted
+        self.predictions = None
+        self.startsHere = False
+        self.debCount = 0
+        # Stays the same as the tram moves between platforms. None until the
+        # tram has been located
+        self.tramID = None
+
+
+class Trajectory:
+    # Where a tram has been recently. events are (platform, event, time)
+    # with only the most recent kept. version is unique to each state a
+    # trajectory has been in
+    __slots__ = (
+        "tramID", "dest", "via", "carriages", "events", "predictions",
+        "lastSeen", "location", "version")
+
+    def __init__(self, tram, length):
+        self.tramID = tram.tramID
+        self.dest = tram.dest
+        self.via = tram.via
+        self.carriages = tram.carriages
+        self.events = deque(maxlen=length)
+        self.predictions = None
+        self.lastSeen = None
+        # (platform, status) or None if the tram isn't shown anywhere
+        self.location = None
+        self.version = None
+
+
+class PredictedArrival:
+    # A reference to a tram predicted to arrive at a platform. The tram's
+    # predictions for every platform are kept with the tram, not copied here
+    __slots__ = ("tram", "via", "platform", "status", "predictedArriveTime")
+
+    def __init__(self, tram, via, platform, status, predictedArriveTime):
+        self.tram = tram
+        self.via = via
+        self.platform = platform
+        self.status = status
+        self.predictedArriveTime = predictedArriveTime
 
 
 class TramGraph:
-    def __init__(self):
+    def __init__(self, incremental=True, batchPredictions=True,
+                 statsWindow=5, statsDecay=None):
         self.DG = nx.DiGraph()
         self.pos = {}
         self.stations = []
         self.firstRun = True
         self.debounceCount = 2
         self.localUpdateTime = None
+        self.newestUpdateTime = None
+
+        # Trajectories of the trams seen most recently, least recently seen
+        # first
+        self.nextTramID = 1
+        self.trajectoryLength = 20
+        self.maxTrajectories = 1000
+        self.trajectories = OrderedDict()
+        self.trajectoryVersions = itertools.count()
+        # IDs of trams we currently know the location of
+        self.locatedTramIDs = set()
+        # {tram ID: ids of the trams with it} for trams we know the location
+        # of, while trams are being located
+        self.tramIDHolders = defaultdict(set)
+
+        # In incremental mode only platforms whose PIDs have changed (and
+        # their sibling platforms) are decoded & located each update, and
+        # only trams whose routes touch changed platforms are re-predicted
+        self.incremental = incremental
+        self.dirtyNodes = set()
+        self.activeNodes = []
+        self.activeStations = set()
+        self.staleStations = set()
+        self.repredictAll = True
+        # Changes whenever dwell or transit times are added
+        self.statsVersion = 0
+        # How many recent dwell & transit times to average over, or how
+        # much weight to give each new one if decay is set
+        self.statsWindow = statsWindow
+        self.statsDecay = statsDecay
 
         data = json.load(open("{}/data/stations.json".format(
             os.path.dirname(__file__))))
@@ -28,27 +215,6 @@ class TramGraph:
                 self.DG.add_node(nodeID)
                 self.DG.nodes[nodeID]["stationName"] = s
                 self.DG.nodes[nodeID]["platformID"] = p
-                self.DG.nodes[nodeID]["pidTrams"] = []
-                self.DG.nodes[nodeID]["message"] = None
-                self.DG.nodes[nodeID]["updateTime"] = datetime.min
-
-                self.DG.nodes[nodeID]["tramsDeparting"] = []
-                self.DG.nodes[nodeID]["tramsArrived"] = []
-                self.DG.nodes[nodeID]["tramsDue"] = []
-
-                self.DG.nodes[nodeID]["tramsApproaching"] = []
-                self.DG.nodes[nodeID]["tramsApproachingDeb"] = []
-                self.DG.nodes[nodeID]["prevTramsHere"] = []
-                self.DG.nodes[nodeID]["tramsHere"] = []
-                self.DG.nodes[nodeID]["tramsHereDeb"] = []
-                self.DG.nodes[nodeID]["tramsDeparted"] = []
-
-                self.DG.nodes[nodeID]["fTramsHere"] = []
-                self.DG.nodes[nodeID]["fTramsDeparted"] = []
-                self.DG.nodes[nodeID]["fTramsApproaching"] = []
-
-                self.DG.nodes[nodeID]["predictedArrivals"] = []
-                self.DG.nodes[nodeID]["dwellTimes"] = []
 
                 self.pos[nodeID] = [
                     data[s][p]["map"]["x"], data[s][p]["map"]["y"]]
@@ -61,8 +227,6 @@ class TramGraph:
                             inS = thisInS
 
                     self.DG.add_edge("{}_{}".format(inS, inSP), nodeID)
-                    self.DG.edges[
-                        "{}_{}".format(inS, inSP), nodeID]["transitTimes"] = []
 
                     if data[s][p].get("terminating", False):
                         self.DG.edges[
@@ -71,131 +235,275 @@ class TramGraph:
                         self.DG.edges[
                             "{}_{}".format(inS, inSP), nodeID]["weight"] = 1
 
-    def updatePlatformPID(self, nodeID, PIDTramData, message, updateTime):
-        self.DG.nodes[nodeID]["pidTrams"] = PIDTramData
-        self.DG.nodes[nodeID]["message"] = message
-        self.DG.nodes[nodeID]["updateTime"] = updateTime
+        self.stationNames = list(self.stations)
+        self.stationIndex = {}
+        self.stationNodes = []
+        for station, stationName in enumerate(self.stationNames):
+            self.stationIndex[stationName] = station
+            self.stationNodes.append([])
+
+        # Nodes are numbered in graph order so updates visit them in the same
+        # order as the graph would
+        self.nodeIDs = list(self.DG.nodes)
+        self.nodeIndex = {}
+        self.platformIndex = {}
+        self.platforms = []
+        self.stationPlatforms = {
+            stationName: [] for stationName in self.stationNames}
+        for node, nodeID in enumerate(self.nodeIDs):
+            stationName = self.DG.nodes[nodeID]["stationName"]
+            platformID = self.DG.nodes[nodeID]["platformID"]
+            station = self.stationIndex[stationName]
+            self.nodeIndex[nodeID] = node
+            self.platformIndex[stationName, platformID] = node
+            self.platforms.append(Platform(
+                station, platformID, self.newRollingMean()))
+            self.stationNodes[station].append(node)
+            self.stationPlatforms[stationName].append(platformID)
+
+        for node, platform in enumerate(self.platforms):
+            platform.siblings = [
+                otherNode for otherNode in self.stationNodes[platform.station]
+                if otherNode != node]
+
+        self.edges = []
+        self.edgeIndex = {}
+        self.transitTimes = []
+        for startID, endID in self.DG.edges:
+            start = self.nodeIndex[startID]
+            end = self.nodeIndex[endID]
+            self.edgeIndex[start, end] = len(self.edges)
+            self.edges.append((start, end))
+            self.transitTimes.append(self.newRollingMean())
+
+        self.fallbackEdges = [
+            self.findFallbackEdges(start, end) for start, end in self.edges]
+
+        for node, nodeID in enumerate(self.nodeIDs):
+            for pNodeID in self.DG.pred[nodeID]:
+                pNode = self.nodeIndex[pNodeID]
+                self.platforms[node].preds.append(
+                    (pNode, self.edgeIndex[pNode, node]))
+            for sNodeID in self.DG.succ[nodeID]:
+                self.platforms[node].succs.append(self.nodeIndex[sNodeID])
+                self.platforms[node].succWeights.append((
+                    self.nodeIndex[sNodeID],
+                    self.DG.edges[nodeID, sNodeID]["weight"]))
+
+        # The network doesn't change so we find routes between every pair of
+        # platforms up front. Edges into terminating stops weigh more so
+        # routes avoid passing through them where there's a choice
+        self.distances = []
+        self.parents = []
+        for node in range(len(self.platforms)):
+            distances, parents = self.findRoutes(node)
+            self.distances.append(distances)
+            self.parents.append(parents)
+
+        self.destPlatforms = []
+        for node in range(len(self.platforms)):
+            self.destPlatforms.append([
+                self.findDestPlatform(node, station)
+                for station in range(len(self.stationNames))])
+
+        # Filled as routes are used
+        self.paths = {}
+        self.routes = {}
+
+        self.exchangeSquare = self.stationIndex.get("Exchange Square")
+        self.marketStreet = self.stationIndex.get("Market Street")
+        self.stPetersSquare2 = self.nodeIndex.get(
+            "St Peters Square_9400ZZMASTP2")
+        self.stPetersSquare3 = self.nodeIndex.get(
+            "St Peters Square_9400ZZMASTP3")
+
+        self.pidDecoder = PIDDecoder(self.stationIndex)
+
+        # Predicting trams in batches needs numpy. Without it trams are
+        # predicted one at a time
+        self.batchPredictor = None
+        if batchPredictions and BatchPredictor.isAvailable():
+            self.batchPredictor = BatchPredictor(self)
+
+        self.generation = 0
+        self.snapshot = Snapshot(self, self.generation)
+
+    def updatePlatformPID(self, node, PIDTramData, message, updateTime):
+        platform = self.platforms[node]
+        if platform.updateTime != updateTime:
+            self.dirtyNodes.add(node)
+        if ((self.newestUpdateTime is None)
+           or (updateTime > self.newestUpdateTime)):
+            self.newestUpdateTime = updateTime
+        platform.pidTrams = PIDTramData
+        platform.message = message
+        platform.updateTime = updateTime
 
     def decodePID(self, node):
         # Locate trams & seperate by PID state
-        self.DG.nodes[node]["tramsDeparting"] = []
-        self.DG.nodes[node]["tramsArrived"] = []
-        self.DG.nodes[node]["tramsApproaching"] = []
-        self.DG.nodes[node]["tramsDue"] = []
-        self.DG.nodes[node]["prevTramsHere"] = self.DG.nodes[node][
-            "tramsHere"]
-        self.DG.nodes[node]["tramsHere"] = []
-
-        for tram in self.DG.nodes[node]["pidTrams"]:
-            if tram["dest"] in [
-              "Terminates Here",
-              "See Tram Front",
-              "Not in Service"]:
+        platform = self.platforms[node]
+        platform.tramsDeparting = []
+        platform.tramsArrived = []
+        platform.tramsApproaching = []
+        platform.tramsDue = []
+        platform.prevTramsHere = platform.tramsHere
+        platform.tramsHere = []
+
+        # We'll remove exact duplicates at the same time here
+        # Can happen on stops with multiple PIDs or with bugs in the
+        # data
+        seen = set()
+        for pidTram in platform.pidTrams:
+            if pidTram in seen:
                 continue
+            seen.add(pidTram)
 
-            status = tram["status"]
-            del(tram["status"])
-            # We'll remove exact duplicates at the same time here
-            # Can happen on stops with multiple PIDs or with bugs in the
-            # data
+            dest, via, carriages, status, wait = pidTram
+            # New trams so the PID data can be decoded again if a sibling
+            # platform changes but this one doesn't
+            tram = Tram(dest, via, carriages, wait)
             if status == "Departing":
-                if tram not in self.DG.nodes[node]["tramsDeparting"]:
-                    self.DG.nodes[node]["tramsDeparting"].append(tram)
+                platform.tramsDeparting.append(tram)
             elif status == "Arrived":
-                if tram not in self.DG.nodes[node]["tramsArrived"]:
-                    self.DG.nodes[node]["tramsArrived"].append(tram)
+                platform.tramsArrived.append(tram)
             elif status == "Due":
-                if tram not in self.DG.nodes[node]["tramsDue"]:
-                    self.DG.nodes[node]["tramsDue"].append(tram)
+                platform.tramsDue.append(tram)
             else:
                 logging.error("Unknown tram status: {}".format(status))
 
     def calcTramDwell(self, tramsDeparted, node):
         # Calculate dwell times for departed trams
         if tramsDeparted != []:
+            platform = self.platforms[node]
             for tram in tramsDeparted:
-                if "status" in tram:
-                    del(tram["status"])
-                if "wait" in tram:
-                    del(tram["wait"])
-                tram["departTime"] = self.DG.nodes[node]["updateTime"]
-
-                if tram["arriveTime"] is None:
-                    tram["dwellTime"] = None
+                tram.wait = None
+                # Predictions were based on the tram being here
+                tram.predictions = None
+                tram.departTime = platform.updateTime
+                self.recordTramEvent(tram, node, "departed", tram.departTime)
+
+                if tram.arriveTime is None:
+                    tram.dwellTime = None
                 else:
-                    tram["dwellTime"] = tram["departTime"] - tram["arriveTime"]
-                    if tram["dwellTime"] != timedelta():
-                        self.DG.nodes[node]["dwellTimes"].append(
-                            tram["dwellTime"])
-                        # Only keep track of 5 most recent dwell times
-                        self.DG.nodes[node]["dwellTimes"] = self.DG.nodes[
-                            node]["dwellTimes"][-5:]
+                    tram.dwellTime = tram.departTime - tram.arriveTime
+                    if tram.dwellTime != 0:
+                        if len(platform.dwellTimes) == 0:
+                            self.repredictAll = True
+                        self.markStale(node)
+                        platform.dwellTimes.add(tram.dwellTime)
+                        self.statsVersion += 1
 
             averageDwell, isDirectAverage = self.getAverageDwell(node)
             for tram in tramsDeparted:
-                tram["averageDwell"] = averageDwell
-
-    def locateApproaching(self, node):
-        pTramsMatched = []  # Only match pTrams once
-
-        for tram in self.DG.nodes[node]["tramsDue"]:
+                tram.averageDwell = averageDwell
+
+    def indexPredictedArrivals(self, node):
+        # Trams predicted to arrive from elsewhere with each key, sorted by
+        # when they're predicted to arrive. Each is kept with its position
+        # in predictedArrivals as the earliest listed is matched first
+        pTrams = defaultdict(list)
+        for i, pTram in enumerate(self.platforms[node].predictedArrivals):
+            if pTram.platform != node:
+                pTrams[tramKey(pTram.tram)].append(
+                    (pTram.predictedArriveTime, i))
+
+        index = {}
+        for key, arrivals in pTrams.items():
+            arrivals.sort()
+            index[key] = (
+                [arriveTime for arriveTime, i in arrivals],
+                [i for arriveTime, i in arrivals])
+        return index
+
+    def locateApproaching(self, node, identify=False):
+        platform = self.platforms[node]
+        # Trams starting here keep the IDs they were given the last time
+        # they were found
+        approachingIDs = platform.approachingIDs
+        platform.approachingIDs = {}
+        if not platform.tramsDue:
+            return
+
+        if not identify:
+            # Due trams are kept between updates if the PIDs haven't
+            # changed, but are found afresh each update as if they'd just
+            # been decoded
+            for tram in platform.tramsDue:
+                tram.startsHere = False
+                tram.tramID = None
+
+        knownIDs = set(tram.tramID for tram in platform.tramsDue)
+        pTramIndex = self.indexPredictedArrivals(node)
+        pTramsMatched = set()  # Only match pTrams once
+
+        for tram in platform.tramsDue:
             tramStartsHere = True
-            wait = tram["wait"] if "wait" in tram else 0
+            wait = tram.wait if tram.wait is not None else 0
+            tramTime = platform.updateTime + wait * 60
 
-            for pTram in self.DG.nodes[node]["predictedArrivals"]:
-                if pTram in pTramsMatched:
-                    continue
+            if tramKey(tram) in pTramIndex:
+                arriveTimes, positions = pTramIndex[tramKey(tram)]
                 # Delta allows for variance between our predictions & TfGM's
-                tramTime = (self.DG.nodes[node]["updateTime"] +
-                            timedelta(minutes=wait))
-                tramDelta = abs(pTram["predictedArriveTime"] - tramTime)
-                if (
-                   (pTram["curLoc"]["platform"] != node)
-                   and (tram["dest"] == pTram["dest"])
-                   and (tram["carriages"] == pTram["carriages"])
-                   and tramDelta < timedelta(minutes=2)):
+                start = bisect.bisect_right(arriveTimes, tramTime - 120)
+                end = bisect.bisect_left(arriveTimes, tramTime + 120)
+                candidates = [
+                    arrivalKey(platform.predictedArrivals[i])
+                    for i in sorted(positions[start:end])]
+                candidates = [
+                    key for key in candidates if key not in pTramsMatched]
+                if candidates:
                     tramStartsHere = False
-                    pTramsMatched.append(pTram)
-                    break
+                    pTramsMatched.add(candidates[0])
 
             if tramStartsHere:
-                tram["startsHere"] = tramStartsHere
-                self.DG.nodes[node]["tramsApproaching"].append(tram)
+                tram.startsHere = tramStartsHere
+                platform.tramsApproaching.append(tram)
+
+                if tram.tramID is None:
+                    ids = approachingIDs.get(tramKey(tram), [])
+                    while ids and ((ids[0] in knownIDs)
+                                   or self.tramIDHolders[ids[0]]):
+                        ids.popleft()
+                    if ids:
+                        tram.tramID = ids.popleft()
+                    elif identify:
+                        # Only trams still starting here once every other
+                        # tram has been predicted are new
+                        self.identifyTram(tram)
+                if tram.tramID is not None:
+                    platform.approachingIDs.setdefault(
+                        tramKey(tram), deque()).append(tram.tramID)
 
     def locateDeparting(self, node):
         # Locate departing trams
-        tramsAt = self.DG.nodes[node]["tramsDeparting"] + self.DG.nodes[node][
-            "tramsArrived"]
+        platform = self.platforms[node]
+        tramsAt = Counter(
+            tramKey(tram)
+            for tram in platform.tramsDeparting + platform.tramsArrived)
         tramsDeparted = []
 
         # Reverse to make sure newer trams matched first
-        for prevTramHere in reversed(self.DG.nodes[node]["prevTramsHere"]):
+        for prevTramHere in reversed(platform.prevTramsHere):
             tramFound = False
-            for tram in tramsAt:
-                if ((prevTramHere["dest"] == tram["dest"])
-                   and (prevTramHere["carriages"] == tram["carriages"])
-                   and "matched" not in tram):
-                    tramFound = True
-                    tram["matched"] = True
-                    break
+            if tramsAt[tramKey(prevTramHere)] > 0:
+                tramFound = True
+                tramsAt[tramKey(prevTramHere)] -= 1
             if not tramFound:
                 # if in other platform at this station, copy to there
-                statName = self.DG.nodes[node]["stationName"]
-                platIDs = self.getStationPlatforms(statName)
-                nodeIDs = ["{}_{}".format(statName, p) for p in platIDs]
-                nodeIDs.remove(node)
-                tramFound = False
-                for otherNode in nodeIDs:
-                    for state in ["tramsDeparting", "tramsArrived"]:
-                        for tram in self.DG.nodes[otherNode][state]:
-                            if ((prevTramHere["dest"] == tram["dest"])
-                               and (prevTramHere["carriages"]
-                                    == tram["carriages"])):
+                for otherNode in self.stationNodes[platform.station]:
+                    if otherNode == node:
+                        continue
+                    otherPlatform = self.platforms[otherNode]
+                    for state in [otherPlatform.tramsDeparting,
+                                  otherPlatform.tramsArrived]:
+                        for tram in state:
+                            if ((prevTramHere.dest == tram.dest)
+                               and (prevTramHere.carriages
+                                    == tram.carriages)):
                                 tramFound = True
-                                self.DG.nodes[otherNode][state].remove(
-                                    tram)
-                                self.DG.nodes[otherNode][state].append(
-                                    prevTramHere)
+                                state.remove(tram)
+                                prevTramHere.predictions = None
+                                state.append(prevTramHere)
                                 break
                         if tramFound:
                             break
@@ -207,221 +515,247 @@ class TramGraph:
 
         self.calcTramDwell(tramsDeparted, node)
 
-        for tram in tramsAt:
-            if "matched" in tram:
-                del(tram["matched"])
-
         for tram in tramsDeparted:
             destIsNext = False
-            for successor in self.DG.succ[node]:
-                if self.DG.nodes[successor]["stationName"] == tram["dest"]:
+            for successor in platform.succs:
+                if self.platforms[successor].station == tram.dest:
                     destIsNext = True
 
             if not destIsNext:
-                self.DG.nodes[node]["tramsDeparted"].append(tram)
+                platform.tramsDeparted.append(tram)
 
     def calcTramTransit(self, node, tram):
-        for pNode in self.DG.pred[node]:
+        for pNode, edge in self.platforms[node].preds:
+            pTramsDeparted = self.platforms[pNode].tramsDeparted
             foundPTram = None
-            for i in range(len(self.DG.nodes[pNode]["tramsDeparted"])):
-                pTram = self.DG.nodes[pNode]["tramsDeparted"][i]
-                if ((pTram["dest"] == tram["dest"])
-                   and (pTram["carriages"] == tram["carriages"])):
+            for i in range(len(pTramsDeparted)):
+                pTram = pTramsDeparted[i]
+                if ((pTram.dest == tram.dest)
+                   and (pTram.carriages == tram.carriages)):
                     foundPTram = i
+                    self.moveTramID(pTram, tram)
 
-                    timeBetweenStops = tram["arriveTime"] - pTram["departTime"]
-                    if timeBetweenStops != timedelta():
-                        self.DG.edges[pNode, node]["transitTimes"].append(
-                            timeBetweenStops)
-                        self.DG.edges[pNode, node][
-                            "transitTimes"] = self.DG.edges[pNode, node][
-                                "transitTimes"][-5:]
+                    timeBetweenStops = tram.arriveTime - pTram.departTime
+                    if timeBetweenStops != 0:
+                        if len(self.transitTimes[edge]) == 0:
+                            self.repredictAll = True
+                        self.markStale(pNode)
+                        self.markStale(node)
+                        self.transitTimes[edge].add(timeBetweenStops)
+                        self.statsVersion += 1
 
                         (averageTransitTime,
                             isDirectAverage) = self.getAverageTransit(
                             pNode, node)
 
                         logging.info("Time between stops {} and {} {}".format(
-                            pNode, node, timeBetweenStops))
+                            self.nodeIDs[pNode], self.nodeIDs[node],
+                            timeBetweenStops))
                         logging.info(
                             "Average time between stops {} and {} {}".format(
-                                pNode, node, averageTransitTime))
+                                self.nodeIDs[pNode], self.nodeIDs[node],
+                                averageTransitTime))
                     break
 
             if foundPTram is not None:
                 # Delete found tram and any before it. Trams can't overtake so
                 # we'll assume it doesn't actually exist here
                 for i in range(foundPTram+1):
-                    self.DG.nodes[pNode]["tramsDeparted"].pop(0)
+                    pTramsDeparted.pop(0)
                     if i != foundPTram:
                         logging.warning("Deleting overtaken tram from {} "
-                                        "departed trams".format(pNode))
+                                        "departed trams".format(
+                                            self.nodeIDs[pNode]))
                 break
         else:
             logging.warning("No matching departed tram for tram arrived at "
-                            "{}".format(node))
+                            "{}".format(self.nodeIDs[node]))
             return False
         return True
 
     def locateAt(self, node):
         # Locate arriving trams & update "tramsHere" array and transit times
-        tramsAt = self.DG.nodes[node]["tramsDeparting"] + self.DG.nodes[node][
-            "tramsArrived"]
+        platform = self.platforms[node]
+        tramsAt = platform.tramsDeparting + platform.tramsArrived
         newTramsHere = []
+        prevTramsHere = indexTrams(platform.prevTramsHere)
 
         for tram in tramsAt:
             tramFound = False
-            for tramHere in self.DG.nodes[node]["prevTramsHere"]:
-                if ((tramHere["dest"] == tram["dest"])
-                   and (tramHere["carriages"] == tram["carriages"])
-                   and ("matched" not in tramHere)):
-                    tramFound = True
-                    newTramsHere.append(tramHere)
-                    tramHere["matched"] = True
-                    break
+            if prevTramsHere[tramKey(tram)]:
+                tramFound = True
+                newTramsHere.append(prevTramsHere[tramKey(tram)].popleft())
             if not tramFound:
                 # Check if tram was moved from another platform
-                if "arriveTime" not in tram:
+                if not tram.located:
+                    tram.located = True
                     if self.firstRun:
-                        tram["arriveTime"] = None
+                        tram.arriveTime = None
                     else:
-                        tram["arriveTime"] = self.DG.nodes[node]["updateTime"]
+                        tram.arriveTime = platform.updateTime
                         self.calcTramTransit(node, tram)
 
+                    # Trams that weren't seen leaving somewhere else may
+                    # have been seen waiting to start here
+                    if tram.tramID is None:
+                        ids = platform.approachingIDs.get(tramKey(tram))
+                        self.identifyTram(tram, ids.popleft() if ids else None)
+                    if tram.arriveTime is not None:
+                        self.recordTramEvent(
+                            tram, node, "arrived", tram.arriveTime)
+
                 newTramsHere.append(tram)
 
-        for tram in newTramsHere:
-            if "matched" in tram:
-                del(tram["matched"])
+        platform.tramsHere = newTramsHere
 
-        self.DG.nodes[node]["tramsHere"] = newTramsHere
+    def markStale(self, node):
+        # Averages fall back to sibling platforms so a change to one affects
+        # predictions through any platform at the same station
+        self.staleStations.add(self.platforms[node].station)
+
+    def startUpdate(self):
+        if not self.dirtyNodes:
+            return False
+
+        self.activeStations = set(
+            self.platforms[node].station for node in self.dirtyNodes)
+
+        if self.incremental:
+            # Trams can move between platforms at a station so siblings of
+            # changed platforms need locating too
+            self.activeNodes = sorted(
+                node for station in self.activeStations
+                for node in self.stationNodes[station])
+            self.repredictAll = False
+        else:
+            self.activeNodes = list(range(len(self.platforms)))
+            self.repredictAll = True
+
+        self.staleStations = set()
+        # Whether trams are routed via Exchange Square or Market Street
+        # depends on the Exchange Square PIDs
+        if self.exchangeSquare in self.activeStations:
+            self.staleStations.update([self.exchangeSquare, self.marketStreet])
+
+        self.dirtyNodes = set()
+        return True
+
+    def needsPrediction(self, node, tram):
+        # Trams that have moved have their predictions removed
+        if self.repredictAll or tram.predictions is None:
+            return True
+        # Trams are predicted from the averages where they are, as well as
+        # those along their path
+        if self.platforms[node].station in self.staleStations:
+            return True
+        for plat, time in tram.predictions.items():
+            platform = self.platforms[plat]
+            if platform.station in self.staleStations:
+                return True
+            # Predictions are moved forward to a platform's update time if
+            # they've fallen behind it
+            if time < platform.updateTime:
+                return True
+        return False
 
     def decodePIDs(self):
-        for node in nx.nodes(self.DG):
+        for node in self.activeNodes:
             self.decodePID(node)
 
-    def locateApproachingTrams(self):
-        for node in nx.nodes(self.DG):
-            self.DG.nodes[node]["tramsApproaching"].clear()
-            self.locateApproaching(node)
+    def locateApproachingTrams(self, identify=False):
+        self.findTramIDHolders()
+        for node in range(len(self.platforms)):
+            self.platforms[node].tramsApproaching.clear()
+            self.locateApproaching(node, identify)
 
     def locateDepartingTrams(self):
-        for node in nx.nodes(self.DG):
+        for node in self.activeNodes:
             self.locateDeparting(node)
 
     def locateTramsAt(self):
-        for node in nx.nodes(self.DG):
+        self.findTramIDHolders()
+        for node in self.activeNodes:
             self.locateAt(node)
         self.firstRun = False
 
-    def getAverageDwell(self, platform):
-        dwellTimes = self.DG.nodes[platform]["dwellTimes"]
-        if len(dwellTimes) > 0:
-            return sum(dwellTimes, timedelta())/len(dwellTimes), True
+    def getAverageDwell(self, node):
+        averageDwell = self.platforms[node].dwellTimes.mean()
+        if averageDwell is not None:
+            return averageDwell, True
         else:
-            station = self.DG.nodes[platform]["stationName"]
-            for node in nx.nodes(self.DG):
-                if node == platform:
-                    continue
-                if self.DG.nodes[node]["stationName"] == station:
-                    dwellTimes = self.DG.nodes[node]["dwellTimes"]
-                    if len(dwellTimes) > 0:
-                        return (
-                            sum(dwellTimes, timedelta())/len(dwellTimes),
-                            False)
+            for otherNode in self.platforms[node].siblings:
+                averageDwell = self.platforms[otherNode].dwellTimes.mean()
+                if averageDwell is not None:
+                    return averageDwell, False
         return None, False
 
-    def getAverageTransit(self, start, end):
+    def newRollingMean(self):
+        return RollingMean(window=self.statsWindow, decay=self.statsDecay)
 
-        def getTransit(_start, _end):
-            transitTimes = self.DG.edges[_start, _end]["transitTimes"]
-            if len(transitTimes) > 0:
-                return sum(transitTimes, timedelta())/len(transitTimes)
-            else:
-                return None
+    def findFallbackEdges(self, start, end):
+        # Edges between other platforms at the same stations, in the order
+        # we'll use them if an edge has no transit times of its own
+        startNodes = self.platforms[start].siblings
+        endNodes = []
+        if self.platforms[end].station != self.platforms[start].station:
+            endNodes = self.platforms[end].siblings
+        startNodes = [node for node in startNodes if node != end]
 
-        transitTime = getTransit(start, end)
+        fallbackEdges = []
+        for startNode in startNodes:
+            for endNode in endNodes + [end]:
+                if (startNode, endNode) in self.edgeIndex:
+                    fallbackEdges.append(self.edgeIndex[startNode, endNode])
+
+        for endNode in endNodes + [end]:
+            for startNode in startNodes + [start]:
+                if (endNode, startNode) in self.edgeIndex:
+                    fallbackEdges.append(self.edgeIndex[endNode, startNode])
+
+        return fallbackEdges
+
+    def getAverageTransit(self, start, end):
+        edge = self.edgeIndex[start, end]
+        transitTime = self.transitTimes[edge].mean()
         if transitTime is not None:
             return transitTime, True
-        else:
-            startStation = self.DG.nodes[start]["stationName"]
-            endStation = self.DG.nodes[end]["stationName"]
 
-            startNodes = []
-            endNodes = []
-            for node in nx.nodes(self.DG):
-                if node in [start, end]:
-                    continue
-                if self.DG.nodes[node]["stationName"] == startStation:
-                    startNodes.append(node)
-                elif self.DG.nodes[node]["stationName"] == endStation:
-                    endNodes.append(node)
-
-            for startNode in startNodes:
-                for endNode in endNodes + [end]:
-                    if self.DG.has_edge(startNode, endNode):
-                        transitTime = getTransit(startNode, endNode)
-                        if transitTime is not None:
-                            return transitTime, False
-
-            for endNode in endNodes + [end]:
-                for startNode in startNodes + [start]:
-                    if self.DG.has_edge(endNode, startNode):
-                        transitTime = getTransit(endNode, startNode)
-                        if transitTime is not None:
-                            return transitTime, False
+        for fallbackEdge in self.fallbackEdges[edge]:
+            transitTime = self.transitTimes[fallbackEdge].mean()
+            if transitTime is not None:
+                return transitTime, False
 
         return None, False
 
     def predictTram(self, start, end, startDepartTime):
         predictions = {}
-        # TODO: Use function to get weight accounting for terminating
-        # stop/pass through
-        path = nx.astar_path(self.DG, source=start, target=end)
+        path = self.getPath(start, end)
+        if path is None:
+            return predictions, False
 
         if len(path) < 2:
             return predictions, True
 
-        if ((self.DG.nodes[start]["stationName"] != "Exchange Square")
-           and (start != "St Peters Square_9400ZZMASTP2")
-           and (self.DG.nodes[end]["stationName"] != "Exchange Square")
-           and (end != "St Peters Square_9400ZZMASTP3")):
-            for platform in path:
-                if self.DG.nodes[platform]["stationName"] == "Exchange Square":
-                    if ((self.DG.nodes[start][
-                        "stationName"] == "Market Street")
-                       or (self.DG.nodes[end][
-                            "stationName"] == "Market Street")):
-                        logging.error("When finding shortest path start was {}"
-                                      ", end was {}, and path passed through "
-                                      "Exchange Square".format(start, end))
-                        return {}, False
-                    destFound = False
-                    endStaName = self.DG.nodes[end]["stationName"]
-                    for tram in self.DG.nodes[platform]["pidTrams"]:
-                        if tram["dest"] == endStaName:
-                            destFound = True
-
-                    if not destFound:
-                        marketSt = self.getDestPlatform(start, "Market Street")
-                        predicted, cont = self.predictTram(
-                            start, marketSt, startDepartTime)
-                        predictions.update(predicted)
-                        if cont:
-                            arriveMarketSt = max(predictions.values())
-
-                            averageDwell, isDirectAverage = (
-                                self.getAverageDwell(marketSt))
-                            if averageDwell is None:
-                                return predictions, False
-
-                            leaveMarketSt = arriveMarketSt + averageDwell
-                            predicted, cont = self.predictTram(
-                                marketSt, end, leaveMarketSt)
-                            predictions.update(predicted)
-                        return predictions, cont
-
-                    break
+        valid, marketSt = self.getDetour(start, end, path)
+        if not valid:
+            return predictions, False
+        if marketSt is not None:
+            predicted, cont = self.predictTram(
+                start, marketSt, startDepartTime)
+            predictions.update(predicted)
+            if cont:
+                arriveMarketSt = max(predictions.values())
+
+                averageDwell, isDirectAverage = (
+                    self.getAverageDwell(marketSt))
+                if averageDwell is None:
+                    return predictions, False
+
+                leaveMarketSt = arriveMarketSt + averageDwell
+                predicted, cont = self.predictTram(
+                    marketSt, end, leaveMarketSt)
+                predictions.update(predicted)
+            return predictions, cont
 
         workingTramTime = startDepartTime
 
@@ -438,9 +772,10 @@ class TramGraph:
 
             # If next stop's predicted arrival is < now, base later "
             # predictions off of now
+            updateTime = self.platforms[curPlat].updateTime
             if ((platformNum == 0)
-               and (workingTramTime < self.DG.nodes[curPlat]["updateTime"])):
-                workingTramTime = self.DG.nodes[curPlat]["updateTime"]
+               and (workingTramTime < updateTime)):
+                workingTramTime = updateTime
             predictions[curPlat] = workingTramTime
 
             averageDwell, isDirectAverage = self.getAverageDwell(curPlat)
@@ -450,273 +785,575 @@ class TramGraph:
             workingTramTime = workingTramTime + averageDwell
         return predictions, True
 
-    def getDestPlatform(self, startPlatform, dest):
+    def getDetour(self, start, end, path):
+        # Trams for destinations not shown on the Exchange Square PIDs go
+        # via Market Street instead. Returns whether the path can be used &
+        # the Market Street platform to go via, if any
+        startStation = self.platforms[start].station
+        endStation = self.platforms[end].station
+        if ((startStation != self.exchangeSquare)
+           and (start != self.stPetersSquare2)
+           and (endStation != self.exchangeSquare)
+           and (end != self.stPetersSquare3)):
+            for platform in path:
+                if self.platforms[platform].station == self.exchangeSquare:
+                    if ((startStation == self.marketStreet)
+                       or (endStation == self.marketStreet)):
+                        logging.error("When finding shortest path start was {}"
+                                      ", end was {}, and path passed through "
+                                      "Exchange Square".format(
+                                          self.nodeIDs[start],
+                                          self.nodeIDs[end]))
+                        return False, None
+                    destFound = False
+                    for tram in self.platforms[platform].pidTrams:
+                        if tram[0] == endStation:
+                            destFound = True
+
+                    if not destFound:
+                        marketSt = self.getDestPlatform(
+                            start, self.marketStreet)
+                        if marketSt is None:
+                            return False, None
+                        return True, marketSt
+
+                    break
+
+        return True, None
+
+    def findRoutes(self, source):
+        # Dijkstra's algorithm, exploring platforms in the same order as
+        # networkx's A* search so we pick the same route when there's a tie
+        distances = [None] * len(self.platforms)
+        parents = [None] * len(self.platforms)
+        counter = itertools.count()
+        queue = [(0, next(counter), source, None)]
+        enqueued = {}
+
+        while queue:
+            distance, _, node, parent = heapq.heappop(queue)
+            if distances[node] is not None:
+                if (node == source) or (enqueued[node] < distance):
+                    continue
+
+            distances[node] = distance
+            parents[node] = parent
+
+            for succ, weight in self.platforms[node].succWeights:
+                succDistance = distance + weight
+                if (succ in enqueued) and (enqueued[succ] <= succDistance):
+                    continue
+                enqueued[succ] = succDistance
+                heapq.heappush(
+                    queue, (succDistance, next(counter), succ, node))
+
+        return distances, parents
+
+    def findDestPlatform(self, startPlatform, dest):
         closestPlatform = None
         distance = None
-        destPlatforms = []
-
-        for node in nx.nodes(self.DG):
-            if self.DG.nodes[node]['stationName'] == dest:
-                destPlatforms.append(node)
 
-        for platformID in destPlatforms:
-            try:
-                # TODO: Use function to get weight accounting for terminating "
-                # stop/pass through
-                length = nx.astar_path_length(
-                    self.DG, source=startPlatform, target=platformID)
-                if ((distance is None) or length < distance):
-                    closestPlatform = platformID
-                    distance = length
-            except nx.NetworkXNoPath:
-                pass
+        for platform in self.stationNodes[dest]:
+            length = self.distances[startPlatform][platform]
+            if length is None:
+                continue
+            if ((distance is None) or length < distance):
+                closestPlatform = platform
+                distance = length
 
         return closestPlatform
 
-    def predictTramTimes(self, statuses):
-        def getTramPredictions(startPlatform, departTime, tram):
-            destPlatform = self.getDestPlatform(startPlatform, tram["dest"])
-            predicted = None
-            if tram["via"] is not None:
-                viaPlatform = self.getDestPlatform(startPlatform, tram["via"])
-                predicted, cont = self.predictTram(
-                    startPlatform, viaPlatform, departTime)
-                if cont:
-                    averageDwell, isDirectAverage = self.getAverageDwell(
-                        viaPlatform)
-                    if averageDwell is None:
-                        averageDwell = timedelta()
-
-                    departVia = predicted[viaPlatform] + averageDwell
-                    predicted.update(self.predictTram(
-                        viaPlatform, destPlatform, departVia)[0])
-            else:
-                try:
-                    predicted = self.predictTram(
-                        startPlatform, destPlatform, departTime)[0]
-                except RecursionError:
-                    logging.error("Max recursion {}, dest: {}".format(
-                        startPlatform, destPlatform))
-                    return None
+    def getDestPlatform(self, startPlatform, dest):
+        return self.destPlatforms[startPlatform][dest]
+
+    def getPath(self, start, end):
+        if (start, end) not in self.paths:
+            path = None
+            if self.distances[start][end] is not None:
+                path = [end]
+                while path[-1] != start:
+                    path.append(self.parents[start][path[-1]])
+                path.reverse()
+            self.paths[start, end] = path
+        return self.paths[start, end]
+
+    def getRoute(self, startPlatform, dest, via):
+        # Returns the platforms a tram will stop at for its destination &
+        # via station, or None if it can't get there
+        if (startPlatform, dest, via) not in self.routes:
+            destPlatform = self.getDestPlatform(startPlatform, dest)
+            viaPlatform = None
+            if via is not None:
+                viaPlatform = self.getDestPlatform(startPlatform, via)
+
+            route = None
+            if ((destPlatform is not None)
+               and ((via is None) or (viaPlatform is not None))):
+                route = (destPlatform, viaPlatform)
+            self.routes[startPlatform, dest, via] = route
+        return self.routes[startPlatform, dest, via]
+
+    def getTramPredictions(self, startPlatform, departTime, tram):
+        route = self.getRoute(startPlatform, tram.dest, tram.via)
+        if route is None:
+            return None
+        destPlatform, viaPlatform = route
+
+        predicted = None
+        if viaPlatform is not None:
+            predicted, cont = self.predictTram(
+                startPlatform, viaPlatform, departTime)
+            if cont:
+                averageDwell, isDirectAverage = self.getAverageDwell(
+                    viaPlatform)
+                if averageDwell is None:
+                    averageDwell = 0
+
+                departVia = predicted.get(
+                    viaPlatform, departTime) + averageDwell
+                predicted.update(self.predictTram(
+                    viaPlatform, destPlatform, departVia)[0])
+        else:
+            try:
+                predicted = self.predictTram(
+                    startPlatform, destPlatform, departTime)[0]
+            except RecursionError:
+                logging.error("Max recursion {}, dest: {}".format(
+                    self.nodeIDs[startPlatform],
+                    self.nodeIDs[destPlatform]))
+                return None
 
-            return predicted
+        return predicted
 
-        for node in nx.nodes(self.DG):
+    def predictTramTimes(self, statuses):
+        requests = []
+        approaching = []
+        for node in range(len(self.platforms)):
+            platform = self.platforms[node]
             if "tramsHere" in statuses:
                 averageDwell, isDirectAverage = self.getAverageDwell(node)
                 if averageDwell is not None:
-                    for tram in self.DG.nodes[node]["tramsHere"]:
-                        if tram["arriveTime"] is not None:
-                            tram["predictions"] = getTramPredictions(
-                                node, tram["arriveTime"] + averageDwell, tram)
+                    for tram in platform.tramsHere:
+                        if ((tram.arriveTime is not None)
+                           and self.needsPrediction(node, tram)):
+                            requests.append(
+                                (node, tram.arriveTime + averageDwell, tram))
 
             if "tramsDeparted" in statuses:
-                for tram in self.DG.nodes[node]["tramsDeparted"]:
-                    tram["predictions"] = getTramPredictions(
-                        node, tram["departTime"], tram)
+                for tram in platform.tramsDeparted:
+                    if not self.needsPrediction(node, tram):
+                        continue
+                    requests.append((node, tram.departTime, tram))
 
             if "tramsApproaching" in statuses:
-                for tram in self.DG.nodes[node]["tramsApproaching"]:
-                    departTime = (self.DG.nodes[node]["updateTime"] +
-                                  timedelta(minutes=tram["wait"]))
-                    tram["predictions"] = getTramPredictions(
-                        node, departTime, tram)
-                    tram["predictions"][node] = departTime
+                for tram in platform.tramsApproaching:
+                    if not self.needsPrediction(node, tram):
+                        continue
+                    departTime = platform.updateTime + tram.wait * 60
+                    requests.append((node, departTime, tram))
+                    approaching.append((node, departTime, tram))
+
+        if self.batchPredictor is not None:
+            predictions = self.batchPredictor.predict(requests)
+        else:
+            predictions = [
+                self.getTramPredictions(node, departTime, tram)
+                for node, departTime, tram in requests]
+
+        for (node, departTime, tram), predicted in zip(
+                requests, predictions):
+            tram.predictions = predicted
+
+        # Trams starting here are predicted to be here when they're due
+        for node, departTime, tram in approaching:
+            if tram.predictions is not None:
+                tram.predictions[node] = departTime
 
     def debounceNewApproaching(self, node):
+        platform = self.platforms[node]
         newDeb = []
         newAppr = []
+        matched = set()
 
-        self.DG.nodes[node]["tramsApproaching"].sort(
-            key=lambda x: x["wait"]
-            )
-        self.DG.nodes[node]["tramsApproachingDeb"].sort(
-            key=lambda x: x["wait"]
-            )
+        platform.tramsApproaching.sort(key=operator.attrgetter("wait"))
+        platform.tramsApproachingDeb.sort(key=operator.attrgetter("wait"))
+        dTrams = indexTrams(platform.tramsApproachingDeb)
 
-        for tram in self.DG.nodes[node]["tramsApproaching"]:
+        for tram in platform.tramsApproaching:
             found = False
-            for dTram in self.DG.nodes[node]["tramsApproachingDeb"]:
-                if (
-                   (tram["dest"] == dTram["dest"])
-                   and (tram["carriages"] == dTram["carriages"])
-                   and (tram["wait"]
-                        <= dTram["wait"])
-                   and (not dTram.get("matched", False))
-                   ):
-                    found = True
-                    dTram["matched"] = True
-
-                    if dTram["debCount"] >= self.debounceCount:
-                        newAppr.append(tram)
-
-                    tram["debCount"] = dTram["debCount"] + 1
-                    newDeb.append(tram)
-
-                    break
+            # Trams are in order of wait so debounced trams due sooner than
+            # this one can't match any of the rest either
+            sameTrams = dTrams[tramKey(tram)]
+            while sameTrams and (sameTrams[0].wait < tram.wait):
+                sameTrams.popleft()
+            if sameTrams:
+                dTram = sameTrams.popleft()
+                found = True
+                matched.add(id(dTram))
+
+                if dTram.debCount >= self.debounceCount:
+                    newAppr.append(tram)
+
+                tram.debCount = dTram.debCount + 1
+                newDeb.append(tram)
 
             if not found:
-                tram["debCount"] = 1
+                tram.debCount = 1
                 newDeb.append(tram)
 
-        for tram in self.DG.nodes[node]["tramsApproachingDeb"]:
-            if not tram.get("matched", False):
+        for tram in platform.tramsApproachingDeb:
+            if id(tram) not in matched:
                 logging.info(
-                    "Dropping debounced tram approaching {}".format(node))
+                    "Dropping debounced tram approaching {}".format(
+                        self.nodeIDs[node]))
 
-        self.DG.nodes[node]["tramsApproaching"] = newAppr
-        self.DG.nodes[node]["tramsApproachingDeb"] = newDeb
+        platform.tramsApproaching = newAppr
+        platform.tramsApproachingDeb = newDeb
 
     def debounceNewHere(self, node):
+        platform = self.platforms[node]
         newDeb = []
         newHere = []
+        matched = set()
+        dTrams = indexTrams(platform.tramsHereDeb)
 
-        for tram in self.DG.nodes[node]["tramsHere"]:
-            if tram.get("startsHere", False):
+        for tram in platform.tramsHere:
+            if tram.startsHere:
                 found = False
-                for dTram in self.DG.nodes[node]["tramsHereDeb"]:
-                    if (
-                       (tram["dest"] == dTram["dest"])
-                       and (tram["carriages"] == dTram["carriages"])
-                       and (not dTram.get("matched", False))
-                       ):
-                        found = True
-                        dTram["matched"] = True
-
-                        if dTram["debCount"] >= self.debounceCount:
-                            newHere.append(tram)
+                if dTrams[tramKey(tram)]:
+                    dTram = dTrams[tramKey(tram)].popleft()
+                    found = True
+                    matched.add(id(dTram))
 
-                        tram["debCount"] = dTram["debCount"] + 1
-                        newDeb.append(tram)
+                    if dTram.debCount >= self.debounceCount:
+                        newHere.append(tram)
 
-                        break
+                    tram.debCount = dTram.debCount + 1
+                    newDeb.append(tram)
 
                 if not found:
-                    tram["debCount"] = 1
+                    tram.debCount = 1
                     newDeb.append(tram)
             else:
                 newHere.append(tram)
 
-        for tram in self.DG.nodes[node]["tramsHereDeb"]:
-            if not tram.get("matched", False):
-                logging.info("Dropping debounced tram at {}".format(node))
+        for tram in platform.tramsHereDeb:
+            if id(tram) not in matched:
+                logging.info("Dropping debounced tram at {}".format(
+                    self.nodeIDs[node]))
 
-        self.DG.nodes[node]["tramsHere"] = newHere
-        self.DG.nodes[node]["tramsHereDeb"] = newDeb
+        platform.tramsHere = newHere
+        platform.tramsHereDeb = newDeb
 
     def debounceNew(self):
-        for node in nx.nodes(self.DG):
+        for node in self.activeNodes:
             self.debounceNewApproaching(node)
             self.debounceNewHere(node)
 
     def gatherTramPredictions(self, statuses):
-        for node in nx.nodes(self.DG):
+        for node in range(len(self.platforms)):
             for status in statuses:
-                trams = self.DG.nodes[node][status]
-
-                shortStatus = "here"
-                if status == "tramsDeparted":
-                    shortStatus = "departed"
-                elif status == "tramsApproaching":
-                    shortStatus = "dueStartsHere"
+                trams = getattr(self.platforms[node], status)
+                shortStatus = shortStatuses[status]
 
                 for tram in trams:
-                    if "predictions" not in tram:
+                    if tram.predictions is None:
                         continue
                     seenVia = False
                     for plat, time in sorted(
-                       tram["predictions"].items(),
+                       tram.predictions.items(),
                        key=operator.itemgetter(1)):
-                        if tram["via"] == self.DG.nodes[plat]["stationName"]:
+                        platform = self.platforms[plat]
+                        if tram.via == platform.station:
                             seenVia = True
-                        via = tram["via"]
+                        via = tram.via
                         if seenVia:
                             via = None
-                        if tram["dest"] != self.DG.nodes[plat]["stationName"]:
-                            predTram = {
-                                "dest": tram["dest"],
-                                "via": via,
-                                "carriages": tram["carriages"],
-                                "curLoc": {
-                                    "platform": node,
-                                    "status": shortStatus
-                                    },
-                                "predictedArriveTime": time,
-                                "predictions": tram["predictions"]
-                                }
-
-                            if "wait" in tram:
-                                predTram["curLoc"]["pidWait"] = tram["wait"]
-                            self.DG.nodes[plat]["predictedArrivals"].append(
-                                predTram)
+                        if tram.dest != platform.station:
+                            platform.predictedArrivals.append(
+                                PredictedArrival(
+                                    tram, via, node, shortStatus, time))
 
     def clearOldDeparted(self):
         # Attempt at fixing ghost trams hanging around in departed lists
-        for node in nx.nodes(self.DG):
-            delTrams = []
-            for i in range(len(self.DG.nodes[node]["tramsDeparted"])):
-                tram = self.DG.nodes[node]["tramsDeparted"][i]
-                maxTransit = timedelta(minutes=6)
-                if ((tram["departTime"] + maxTransit)
-                   < self.DG.nodes[node]["updateTime"]):
-                    delTrams.append(i)
-
-            offset = 0
-            for delTram in delTrams:
-                logging.warning(
-                    "Deleting stale tram from {} departed trams".format(node))
-                del(self.DG.nodes[node]["tramsDeparted"][delTram - offset])
-                offset = offset + 1
+        maxTransit = 6 * 60
+        for node in self.activeNodes:
+            platform = self.platforms[node]
+            tramsDeparted = []
+            for tram in platform.tramsDeparted:
+                if (tram.departTime + maxTransit) < platform.updateTime:
+                    logging.warning(
+                        "Deleting stale tram from {} departed trams".format(
+                            self.nodeIDs[node]))
+                else:
+                    tramsDeparted.append(tram)
+            platform.tramsDeparted = tramsDeparted
+
+    def findTramIDHolders(self):
+        self.tramIDHolders = defaultdict(set)
+        for platform in self.platforms:
+            for status in locatedStatuses:
+                for tram in getattr(platform, status):
+                    if tram.tramID is not None:
+                        self.tramIDHolders[tram.tramID].add(id(tram))
+
+    def identifyTram(self, tram, tramID=None):
+        # Gives a tram the ID it was seen with before, unless another tram
+        # has it now, or a new one
+        if (tramID is not None) and (
+           self.tramIDHolders[tramID] - {id(tram)}):
+            tramID = None
+        if tramID is None:
+            tramID = self.nextTramID
+            self.nextTramID += 1
+        tram.tramID = tramID
+        self.tramIDHolders[tramID].add(id(tram))
+        self.getTrajectory(tram)
+
+    def moveTramID(self, fromTram, toTram):
+        # A tram seen arriving takes the ID of the tram seen leaving the
+        # platform before. The tram it's taken from may still be listed
+        # somewhere, so it no longer has the ID
+        tramID = fromTram.tramID
+        fromTram.tramID = None
+        if tramID is None:
+            return
+        self.tramIDHolders[tramID].discard(id(fromTram))
+        if not self.tramIDHolders[tramID]:
+            toTram.tramID = tramID
+            self.tramIDHolders[tramID].add(id(toTram))
+
+    def getTrajectory(self, tram):
+        if tram.tramID not in self.trajectories:
+            self.trajectories[tram.tramID] = Trajectory(
+                tram, self.trajectoryLength)
+            self.trajectories[tram.tramID].version = next(
+                self.trajectoryVersions)
+            if len(self.trajectories) > self.maxTrajectories:
+                self.trajectories.popitem(last=False)
+        return self.trajectories[tram.tramID]
+
+    def recordTramEvent(self, tram, node, event, time):
+        if tram.tramID is not None:
+            trajectory = self.getTrajectory(tram)
+            trajectory.events.append((node, event, time))
+            trajectory.version = next(self.trajectoryVersions)
+
+    def updateTrajectories(self):
+        locatedTramIDs = set()
+        for node, platform in enumerate(self.platforms):
+            for status, shortStatus in shortStatuses.items():
+                for tram in getattr(platform, status):
+                    if tram.tramID is None:
+                        continue
+                    locatedTramIDs.add(tram.tramID)
+                    trajectory = self.getTrajectory(tram)
+                    location = (node, shortStatus)
+                    if ((trajectory.predictions is not tram.predictions)
+                       or (trajectory.lastSeen != platform.updateTime)
+                       or (trajectory.location != location)):
+                        trajectory.predictions = tram.predictions
+                        trajectory.lastSeen = platform.updateTime
+                        trajectory.location = location
+                        trajectory.version = next(self.trajectoryVersions)
+                    self.trajectories.move_to_end(tram.tramID)
+
+        for tramID in self.locatedTramIDs - locatedTramIDs:
+            if tramID in self.trajectories:
+                self.trajectories[tramID].location = None
+                self.trajectories[tramID].version = next(
+                    self.trajectoryVersions)
+        self.locatedTramIDs = locatedTramIDs
 
     def finalisePredictions(self):
-        for node in nx.nodes(self.DG):
-            self.DG.nodes[node]["fPredictedArrivals"] = deepcopy(
-                self.DG.nodes[node]["predictedArrivals"])
-            self.DG.nodes[node]["fTramsHere"] = deepcopy(
-                self.DG.nodes[node]["tramsHere"])
-            self.DG.nodes[node]["fTramsDeparted"] = deepcopy(
-                self.DG.nodes[node]["tramsDeparted"])
-            self.DG.nodes[node]["fTramsApproaching"] = deepcopy(
-                self.DG.nodes[node]["tramsApproaching"])
-
-    def clearNodePredictions(self):
-        for node in nx.nodes(self.DG):
-            self.DG.nodes[node]["predictedArrivals"].clear()
-
-    def getPIDs(self):
-        return nx.get_node_attributes(self.DG, "pidTrams")
-
-    def getLastUpdateTime(self, nodeID):
-        return self.DG.nodes[nodeID].get("updateTime", datetime.min)
-
-    def getLastUpdateTimes(self):
-        return nx.get_node_attributes(self.DG, "updateTime")
-
-    def getMessage(self, nodeID):
-        return self.DG.nodes[nodeID].get("message")
+        self.updateTrajectories()
 
-    def getTramsStarting(self):
-        tramsApproachings = deepcopy(
-            nx.get_node_attributes(self.DG, "fTramsApproaching"))
+        # Replacing the snapshot is atomic so handlers see either the old
+        # snapshot or the new one, never a partially updated graph
+        self.generation += 1
+        self.snapshot = Snapshot(self, self.generation, self.snapshot)
 
-        return tramsApproachings
+    def getSnapshot(self):
+        return self.snapshot
 
-    def getTramsHeres(self):
-        tramsHere = deepcopy(nx.get_node_attributes(self.DG, "fTramsHere"))
-        for node in tramsHere:
-            for tram in tramsHere[node]:
-                if "wait" in tram:
-                    del(tram["wait"])
-        return tramsHere
+    def setSnapshot(self, snapshot):
+        # For processes serving snapshots made by another process
+        self.snapshot = snapshot
 
-    def getTramsDeparteds(self):
-        return nx.get_node_attributes(self.DG, "fTramsDeparted")
-
-    def getNodePredictions(self):
-        return nx.get_node_attributes(self.DG, "fPredictedArrivals")
-
-    def getDwellTimes(self):
-        return nx.get_node_attributes(self.DG, "dwellTimes")
+    def clearNodePredictions(self):
+        for platform in self.platforms:
+            platform.predictedArrivals.clear()
+
+    def getState(self):
+        # What we've learned & where trams are, as plain data that doesn't
+        # depend on the order platforms were loaded in. Predictions aren't
+        # included as they're remade on the next update
+        def stationName(station):
+            if station is None:
+                return None
+            return self.stationNames[station]
+
+        trams = []
+        tramIndexes = {}
+
+        def tramIndex(tram):
+            # Trams can be in more than one list at once
+            if id(tram) not in tramIndexes:
+                tramIndexes[id(tram)] = len(trams)
+                trams.append((
+                    stationName(tram.dest), stationName(tram.via),
+                    tram.carriages, tram.wait, tram.located, tram.arriveTime,
+                    tram.departTime, tram.dwellTime, tram.averageDwell,
+                    tram.startsHere, tram.debCount, tram.tramID))
+            return tramIndexes[id(tram)]
+
+        platforms = {}
+        for node, platform in enumerate(self.platforms):
+            platformState = {
+                "updateTime": platform.updateTime,
+                "message": platform.message,
+                "pidTrams": [
+                    (stationName(dest), stationName(via), carriages, status,
+                     wait)
+                    for dest, via, carriages, status, wait
+                    in platform.pidTrams],
+                "dwellTimes": (
+                    platform.dwellTimes.getTimes(),
+                    platform.dwellTimes.average)
+            }
+            for status in trackedStatuses:
+                platformState[status] = [
+                    tramIndex(tram) for tram in getattr(platform, status)]
+            platforms[self.nodeIDs[node]] = platformState
+
+        transitTimes = {}
+        for edge, (start, end) in enumerate(self.edges):
+            transitTimes[self.nodeIDs[start], self.nodeIDs[end]] = (
+                self.transitTimes[edge].getTimes(),
+                self.transitTimes[edge].average)
+
+        trajectories = []
+        for trajectory in self.trajectories.values():
+            trajectories.append((
+                trajectory.tramID, stationName(trajectory.dest),
+                stationName(trajectory.via), trajectory.carriages,
+                [(self.nodeIDs[node], event, time)
+                 for node, event, time in trajectory.events],
+                trajectory.lastSeen))
+
+        return {
+            "firstRun": self.firstRun,
+            "newestUpdateTime": self.newestUpdateTime,
+            "nextTramID": self.nextTramID,
+            "trams": trams,
+            "trajectories": trajectories,
+            "platforms": platforms,
+            "transitTimes": transitTimes
+        }
+
+    def setState(self, state, tracking=True):
+        # Restores the averages from getState & if tracking is set, where
+        # trams were
+        def restoreRollingMean(times, average):
+            rollingMean = self.newRollingMean()
+            for time in times:
+                rollingMean.add(time)
+            if (rollingMean.decay is not None) and (average is not None):
+                rollingMean.average = average
+            return rollingMean
+
+        for nodeID, platformState in state["platforms"].items():
+            if nodeID in self.nodeIndex:
+                self.platforms[self.nodeIndex[nodeID]].dwellTimes = (
+                    restoreRollingMean(*platformState["dwellTimes"]))
+
+        for (startID, endID), transitState in state["transitTimes"].items():
+            start = self.nodeIndex.get(startID)
+            end = self.nodeIndex.get(endID)
+            if (start, end) in self.edgeIndex:
+                self.transitTimes[self.edgeIndex[start, end]] = (
+                    restoreRollingMean(*transitState))
+
+        self.statsVersion += 1
+
+        if not tracking:
+            return
+
+        trams = []
+        for (dest, via, carriages, wait, located, arriveTime, departTime,
+             dwellTime, averageDwell, startsHere, debCount,
+             tramID) in state["trams"]:
+            if ((dest not in self.stationIndex)
+               or ((via is not None) and (via not in self.stationIndex))):
+                trams.append(None)
+                continue
+            tram = Tram(
+                self.stationIndex[dest], self.stationIndex.get(via),
+                carriages, wait)
+            tram.located = located
+            tram.arriveTime = arriveTime
+            tram.departTime = departTime
+            tram.dwellTime = dwellTime
+            tram.averageDwell = averageDwell
+            tram.startsHere = startsHere
+            tram.debCount = debCount
+            tram.tramID = tramID
+            trams.append(tram)
+
+        for nodeID, platformState in state["platforms"].items():
+            if nodeID not in self.nodeIndex:
+                continue
+            platform = self.platforms[self.nodeIndex[nodeID]]
+            platform.updateTime = platformState["updateTime"]
+            platform.message = platformState["message"]
+            platform.pidTrams = [
+                (self.stationIndex[dest], self.stationIndex.get(via),
+                 carriages, status, wait)
+                for dest, via, carriages, status, wait
+                in platformState["pidTrams"]
+                if (dest in self.stationIndex)
+                and ((via is None) or (via in self.stationIndex))]
+            for status in trackedStatuses:
+                setattr(platform, status, [
+                    trams[i] for i in platformState[status]
+                    if trams[i] is not None])
+            platform.approachingIDs = {}
+            for tram in platform.tramsApproaching:
+                platform.approachingIDs.setdefault(
+                    tramKey(tram), deque()).append(tram.tramID)
+
+        self.trajectories = OrderedDict()
+        for (tramID, dest, via, carriages, events,
+             lastSeen) in state["trajectories"]:
+            if ((dest not in self.stationIndex)
+               or ((via is not None) and (via not in self.stationIndex))):
+                continue
+            tram = Tram(
+                self.stationIndex[dest], self.stationIndex.get(via),
+                carriages, None)
+            tram.tramID = tramID
+            trajectory = self.getTrajectory(tram)
+            trajectory.events.extend(
+                (self.nodeIndex[nodeID], event, time)
+                for nodeID, event, time in events
+                if nodeID in self.nodeIndex)
+            trajectory.lastSeen = lastSeen
+
+        self.firstRun = state["firstRun"]
+        self.newestUpdateTime = state["newestUpdateTime"]
+        self.nextTramID = state["nextTramID"]
+        # Decode every platform on the next update so trams due at
+        # platforms that haven't changed are found
+        self.dirtyNodes = set(range(len(self.platforms)))
+
+    def getPIDDecoder(self):
+        return self.pidDecoder
+
+    def getPlatformIndex(self, stationName, platformID):
+        return self.platformIndex.get((stationName, platformID))
+
+    def getLastUpdateTime(self, node):
+        return self.platforms[node].updateTime
 
     def getNodes(self):
         return nx.nodes(self.DG)
@@ -724,36 +1361,56 @@ class TramGraph:
     def getStations(self):
         return self.stations
 
+    def getStationName(self, station):
+        return self.stationNames[station]
+
     def getStationPlatforms(self, statName):
-        platIDs = []
-        for node in nx.nodes(self.DG):
-            if self.DG.nodes[node]["stationName"] == statName:
-                platIDs.append(self.DG.nodes[node]["platformID"])
-        return platIDs
+        return self.stationPlatforms[statName]
+
+    def getPlatformIDs(self, stations, platforms):
+        # The sorted IDs of the given platforms & the platforms at the given
+        # stations
+        nodeIDs = set()
+        for stationName in stations:
+            if stationName not in self.stations:
+                raise ValueError("Unknown station {}".format(stationName))
+            for platID in self.stationPlatforms[stationName]:
+                nodeIDs.add("{}_{}".format(stationName, platID))
+
+        for nodeID in platforms:
+            if nodeID not in self.DG:
+                raise ValueError("Unknown platform {}".format(nodeID))
+            nodeIDs.add(nodeID)
+
+        if len(nodeIDs) == 0:
+            raise ValueError("No stations or platforms given")
+
+        return tuple(sorted(nodeIDs))
 
     def getNodePreds(self, node):
         return self.DG.pred[node]
 
-    def getTransit(self, inNode, outNode):
-        return self.DG.edges[inNode, outNode]["transitTimes"]
-
     def getMapPos(self, node):
         return self.pos[node]
 
     def nodesNoAvDwell(self):
         nodes = []
-        for node in nx.nodes(self.DG):
-            if len(self.DG.nodes[node]["dwellTimes"]) == 0:
-                nodes.append(node)
+        for node in range(len(self.platforms)):
+            if len(self.platforms[node].dwellTimes) == 0:
+                nodes.append(self.nodeIDs[node])
         return nodes
 
     def edgesNoAvTrans(self):
         edges = []
-        for edge in self.DG.edges:
-            if len(self.DG.edges[edge]["transitTimes"]) == 0:
-                edges.append(edge)
+        for edge in range(len(self.edges)):
+            if len(self.transitTimes[edge]) == 0:
+                start, end = self.edges[edge]
+                edges.append((self.nodeIDs[start], self.nodeIDs[end]))
         return edges
 
+    def getNewestUpdateTime(self):
+        return fromEpoch(self.newestUpdateTime)
+
     def setLocalUpdateTime(self, time):
         self.localUpdateTime = time
 
@@ -763,7 +1420,7 @@ class TramGraph:
 
 def main():
     graph = TramGraph()
-    plt.figure(3,figsize=(100,12)) 
+    plt.figure(3,figsize=(100,12))
     # plt.subplot(121)
     nx.draw_networkx(
         graph.DG, pos=graph.pos, with_labels=True, node_size=20, font_size=6)
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+
+from collections import deque
+
+
+class UpdateStatus:
+    # How the update loop is getting on, for the health endpoints. Kept
+    # apart from the graph so it can tell a stuck update from TfGM being
+    # unavailable
+    def __init__(self, startTime, cyclesKept=100):
+        self.startTime = startTime
+        # When the current cycle started & the last one finished
+        self.cycleStartTime = None
+        self.lastCycleTime = None
+        self.lastFetchTime = None
+        self.lastErrorTime = None
+        # Consecutive polls of TfGM that have failed
+        self.errorStreak = 0
+        self.cycleDurations = deque(maxlen=cyclesKept)
+
+    def startCycle(self, now):
+        self.cycleStartTime = now
+
+    def recordFetch(self, now, success):
+        if success:
+            self.lastFetchTime = now
+            self.errorStreak = 0
+        else:
+            self.lastErrorTime = now
+            self.errorStreak += 1
+
+    def finishCycle(self, now):
+        self.lastCycleTime = now
+        self.cycleDurations.append(
+            (now - self.cycleStartTime).total_seconds())
+
+    def getCycleDurationPercentiles(self, percentiles=(50, 90, 99)):
+        durations = sorted(self.cycleDurations)
+        ret = {}
+        for percentile in percentiles:
+            key = "p{}".format(percentile)
+            if len(durations) == 0:
+                ret[key] = None
+                continue
+            # Nearest rank
+            rank = max(0, -(-percentile * len(durations) // 100) - 1)
+            ret[key] = durations[rank]
+        return ret
+
+    def copyFrom(self, other):
+        # For processes showing the status of an update loop running in
+        # another process
+        self.__dict__.update(other.__dict__)
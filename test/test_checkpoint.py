@@ -0,0 +1,41 @@
+import json
+from datetime import datetime, timedelta
+
+import metrolinkTimes.fakeTfgmAPI as fakeTfgmAPI
+from metrolinkTimes.checkpoint import Checkpointer
+from metrolinkTimes.fakeTfgmAPI import SimulatedFeed
+from metrolinkTimes.metrolinkTimes import GraphUpdater
+from metrolinkTimes.tfgmMetrolinksAPI import parseData
+from metrolinkTimes.tramGraph import TramGraph
+from test.test_incremental import FeedClock, dumpSnapshot
+
+
+def test_round_trip(monkeypatch, tmp_path):
+    monkeypatch.setattr(fakeTfgmAPI, "datetime", FeedClock)
+    monkeypatch.setattr(FeedClock, "now_", datetime(2024, 1, 1, 8))
+    feed = SimulatedFeed(seed=1)
+    path = str(tmp_path / "checkpoint")
+
+    graph = TramGraph()
+    updater = GraphUpdater(graph, None, clock=FeedClock.utcnow)
+    for cycle in range(30):
+        updater.update(parseData(json.loads(feed.getPayload())))
+        FeedClock.now_ += timedelta(seconds=10)
+
+    Checkpointer(path, clock=FeedClock.utcnow).save(graph)
+    assert not (tmp_path / "checkpoint.tmp").exists()
+
+    restoredGraph = TramGraph()
+    assert Checkpointer(path, clock=FeedClock.utcnow).load(restoredGraph)
+    assert restoredGraph.getState() == graph.getState()
+
+    # Predictions are remade on the next update
+    updaters = [
+        updater, GraphUpdater(restoredGraph, None, clock=FeedClock.utcnow)]
+    for cycle in range(5):
+        payload = feed.getPayload()
+        for graphUpdater in updaters:
+            graphUpdater.update(parseData(json.loads(payload)))
+        assert dumpSnapshot(restoredGraph) == dumpSnapshot(graph), \
+            "cycle {}".format(cycle)
+        FeedClock.now_ += timedelta(seconds=10)
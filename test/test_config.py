@@ -0,0 +1,82 @@
+import itertools
+import json
+import os
+
+import pytest
+
+from metrolinkTimes.config import Config
+
+validConf = {"Ocp-Apim-Subscription-Key": "key", "port": 5000}
+# Every write gets a later time, however coarse the file system's times are
+writeTimes = itertools.count(10 ** 18, 10 ** 9)
+
+
+def writeConf(path, conf):
+    with open(path, "w") as conf_file:
+        if isinstance(conf, str):
+            conf_file.write(conf)
+        else:
+            json.dump(conf, conf_file)
+    writeTime = next(writeTimes)
+    os.utime(path, ns=(writeTime, writeTime))
+
+
+@pytest.fixture
+def confPath(tmp_path):
+    path = str(tmp_path / "metrolinkTimes.conf")
+    writeConf(path, validConf)
+    return path
+
+
+def test_loads(confPath):
+    config = Config(confPath)
+    assert config["port"] == 5000
+    assert config.get("apiHost", "api.tfgm.com") == "api.tfgm.com"
+    assert "Ocp-Apim-Subscription-Key" in config
+
+
+def test_missing_key_rejected(tmp_path):
+    path = str(tmp_path / "metrolinkTimes.conf")
+    writeConf(path, {"port": 5000})
+    with pytest.raises(ValueError, match="Ocp-Apim-Subscription-Key"):
+        Config(path)
+
+
+def test_invalid_reload_keeps_config(confPath):
+    config = Config(confPath)
+    reloaded = []
+    config.onReload(reloaded.append)
+
+    for conf in [
+            {"port": 5001},
+            {"Ocp-Apim-Subscription-Key": "key", "port": "5001"},
+            "{\"port\": "]:
+        writeConf(confPath, conf)
+        assert config.reload() is False
+        assert config["port"] == 5000
+    os.remove(confPath)
+    assert config.reload() is False
+    assert config["port"] == 5000
+    assert reloaded == []
+
+
+def test_change_detected(confPath):
+    config = Config(confPath)
+    reloaded = []
+    config.onReload(reloaded.append)
+    assert config.checkForChanges() is False
+
+    writeConf(confPath, dict(validConf, port=5001))
+    assert config.checkForChanges() is True
+    assert config["port"] == 5001
+    assert reloaded == [config]
+    # Only reloaded once for each change
+    assert config.checkForChanges() is False
+
+    # A bad change is only tried once too
+    writeConf(confPath, {"port": 5002})
+    assert config.checkForChanges() is False
+    assert config["port"] == 5001
+    writeConf(confPath, dict(validConf, port=5003))
+    assert config.checkForChanges() is True
+    assert config["port"] == 5003
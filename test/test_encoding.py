@@ -0,0 +1,80 @@
+import gzip
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+from metrolinkTimes.encoding import (
+    codings, compress, contentType, encode, minCompressSize, msgpack,
+    negotiateCoding, negotiateRepresentation)
+
+value = {
+    "b": [1, "é"],
+    "a": datetime(2024, 1, 1, 8),
+    "c": timedelta(seconds=90)
+}
+
+
+def test_json_is_pretty():
+    for accept in [None, "application/json", "*/*", "text/html, */*;q=0.8"]:
+        assert negotiateRepresentation(accept) == "json"
+    body = encode(value, "json")
+    assert body.decode("utf-8") == (
+        '{\n  "a": "2024-01-01T08:00:00",\n  "b": [\n    1,\n    "é"\n'
+        '  ],\n  "c": 90.0\n}')
+    assert contentType("json") == "application/json; charset=UTF-8"
+
+
+def test_indent_0_is_compact():
+    for accept in ["application/json; indent=0",
+                   "application/json;indent=\"0\""]:
+        assert negotiateRepresentation(accept) == "compactJSON"
+    assert negotiateRepresentation("application/json; indent=2") == "json"
+    body = encode(value, "compactJSON")
+    assert b"\n" not in body and b" " not in body
+    assert json.loads(body) == json.loads(encode(value, "json"))
+
+
+def test_q_values_ordered():
+    assert negotiateRepresentation(
+        "application/json; indent=0; q=0.5, application/json; q=0.9"
+    ) == "json"
+    assert negotiateRepresentation(
+        "application/json, application/json; indent=0; q=0"
+    ) == "json"
+    assert negotiateRepresentation("application/json; q=0") == "json"
+
+
+@pytest.mark.skipif(msgpack is None, reason="msgpack isn't installed")
+def test_msgpack():
+    assert negotiateRepresentation(
+        "application/json; q=0.5, application/msgpack") == "msgpack"
+    assert negotiateRepresentation(
+        "application/json, application/msgpack") == "json"
+    body = encode(value, "msgpack")
+    assert msgpack.unpackb(body) == {
+        "a": "2024-01-01T08:00:00", "b": [1, "é"], "c": 90.0}
+
+
+def test_coding():
+    assert negotiateCoding(None) is None
+    assert negotiateCoding("gzip") == "gzip"
+    assert negotiateCoding("identity") is None
+    assert negotiateCoding("gzip;q=0") is None
+    # Anything but gzip
+    assert negotiateCoding("gzip;q=0, *") == (
+        "br" if "br" in codings else None)
+    assert negotiateCoding("gzip, br;q=0.5") == "gzip"
+    assert negotiateCoding("gzip, *") == codings[0]
+
+
+def test_small_bodies_not_compressed():
+    body = b"x" * (minCompressSize - 1)
+    assert compress(body, "gzip") == (None, body)
+    assert compress(body, None) == (None, body)
+
+    body = b"x" * minCompressSize
+    coding, compressed = compress(body, "gzip")
+    assert coding == "gzip"
+    assert gzip.decompress(compressed) == body
+    assert compress(body, None) == (None, body)
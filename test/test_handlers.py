@@ -0,0 +1,222 @@
+import json
+from datetime import datetime, timedelta
+from urllib.parse import urlencode
+
+from tornado import testing
+
+import metrolinkTimes.fakeTfgmAPI as fakeTfgmAPI
+from metrolinkTimes.fakeTfgmAPI import SimulatedFeed
+from metrolinkTimes.metrics import Metrics
+from metrolinkTimes.metrolinkTimes import (
+    Application, GraphUpdater, parseFields, projectFields)
+from metrolinkTimes.responseCache import ResponseCache
+from metrolinkTimes.subscriptions import Subscriptions
+from metrolinkTimes.tfgmMetrolinksAPI import parseData
+from metrolinkTimes.tramGraph import TramGraph
+from metrolinkTimes.updateStatus import UpdateStatus
+from test.test_incremental import FeedClock
+
+
+def replayedGraph(cycles):
+    # A graph updated from the simulated feed
+    original = fakeTfgmAPI.datetime
+    fakeTfgmAPI.datetime = FeedClock
+    FeedClock.now_ = datetime(2024, 1, 1, 8)
+    try:
+        feed = SimulatedFeed(seed=1)
+        graph = TramGraph()
+        updater = GraphUpdater(graph, None, clock=FeedClock.utcnow)
+        for cycle in range(cycles):
+            updater.update(parseData(json.loads(feed.getPayload())))
+            FeedClock.now_ += timedelta(seconds=10)
+    finally:
+        fakeTfgmAPI.datetime = original
+    return graph
+
+
+class HandlerTestCase(testing.AsyncHTTPTestCase):
+    # Handlers served from a graph that's only updated by the test, with
+    # the time they see set by it
+    __test__ = False
+    # How many updates from the simulated feed the graph has had
+    cycles = 0
+
+    def runTest(self):
+        # pytest makes a test case for runTest to find the tests in a class,
+        # which tornado 6.1 only allows if there is one
+        pass
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.graph = replayedGraph(cls.cycles)
+
+    def get_app(self):
+        self.now = datetime(2024, 1, 1, 8)
+        self.status = UpdateStatus(self.now)
+        return Application.makeApplication({
+            "graph": self.graph,
+            "clock": lambda: self.now,
+            "metrics": Metrics(),
+            "responseCache": ResponseCache(),
+            "config": {},
+            "subscriptions": Subscriptions(self.graph),
+            "status": self.status
+        })
+
+    def getJSON(self, path, **args):
+        response = self.fetch("{}?{}".format(path, urlencode(args)))
+        body = None
+        if response.code in [200, 503]:
+            body = json.loads(response.body)
+        return response.code, body
+
+
+def test_parse_fields():
+    assert parseFields(["a.b", "a.c", "d"]) == {
+        "a": {"b": None, "c": None}, "d": None}
+    # All of a field covers any part of it
+    assert parseFields(["a", "a.b"]) == {"a": None}
+    assert parseFields(["a.b", "a"]) == {"a": None}
+    assert parseFields(["a.b.c", "a.b.d"]) == {
+        "a": {"b": {"c": None, "d": None}}}
+
+
+def test_project_fields():
+    value = {"a": [{"b": 1, "c": 2}, {"b": 3}], "d": {"e": 4}, "f": 5}
+    assert projectFields(value, None) == value
+    assert projectFields(value, {"a": {"b": None}, "f": None}) == {
+        "a": [{"b": 1}, {"b": 3}], "f": 5}
+    # Fields a value doesn't have are left out
+    assert projectFields(value, {"d": {"x": None}, "x": None}) == {"d": {}}
+
+
+class TestBatch(HandlerTestCase):
+    __test__ = True
+    cycles = 20
+
+    def busiestPlatform(self):
+        predictions = self.graph.getSnapshot().getNodePredictions()
+        return max(predictions, key=lambda nodeID: len(predictions[nodeID]))
+
+    def test_unknown_fields_rejected(self):
+        for fields in ["bogus", "updateTime,bogus", "bogus.dest"]:
+            code, body = self.getJSON(
+                "/batch/", station="Altrincham", fields=fields)
+            assert code == 400, fields
+
+    def test_unknown_platforms_rejected(self):
+        for args in [
+                {"station": "Nowhere"},
+                {"platform": "Nowhere_9400ZZMANOW1"},
+                {"station": "Altrincham", "platform": "Nowhere"},
+                {}]:
+            code, body = self.getJSON("/batch/", **args)
+            assert code == 400, args
+
+    def test_default_fields(self):
+        code, body = self.getJSON(
+            "/batch/", station="Altrincham", platform="Cornbrook_9400ZZMACRN2")
+        assert code == 200
+        nodeIDs = self.graph.getPlatformIDs(
+            ["Altrincham"], ["Cornbrook_9400ZZMACRN2"])
+        assert sorted(body["platforms"]) == list(nodeIDs)
+        for platform in body["platforms"].values():
+            assert sorted(platform) == [
+                "here", "message", "predictions", "updateTime"]
+
+    def test_projection(self):
+        nodeID = self.busiestPlatform()
+        code, body = self.getJSON(
+            "/batch/", platform=nodeID,
+            fields="updateTime,predictions.dest,predictions.curLoc.platform")
+        assert code == 200
+        platform = body["platforms"][nodeID]
+        assert sorted(platform) == ["predictions", "updateTime"]
+        assert len(platform["predictions"]) > 0
+        for pTram in platform["predictions"]:
+            assert sorted(pTram) == ["curLoc", "dest"]
+            assert sorted(pTram["curLoc"]) == ["platform"]
+
+        # Trams' predictions are only there if they're asked for
+        code, body = self.getJSON(
+            "/batch/", platform=nodeID, fields="predictions")
+        for pTram in body["platforms"][nodeID]["predictions"]:
+            assert nodeID in pTram["predictions"]
+        code, body = self.getJSON(
+            "/batch/", platform=nodeID, fields="predictions.predictions")
+        for pTram in body["platforms"][nodeID]["predictions"]:
+            assert sorted(pTram) == ["predictions"]
+
+
+class TestHealthNoUpdate(HandlerTestCase):
+    __test__ = True
+
+    def test_ready_until_limits(self):
+        self.now += timedelta(seconds=10)
+        code, body = self.getJSON("/health/ready/")
+        assert code == 200
+        assert body["status"] == "ok"
+        assert body["lastUpdateTime"] is None
+
+    def test_no_update_yet(self):
+        # Ages are from when we started until there's been an update
+        self.now += timedelta(seconds=31)
+        code, body = self.getJSON("/health/ready/")
+        assert code == 503
+        assert body["status"] == "failing"
+        checks = body["checks"]
+        assert checks["fetchAge"] == {"value": 31, "limit": 30, "ok": False}
+        assert checks["updateAge"]["ok"] is False
+        assert checks["cycleAge"]["ok"] is True
+
+        code, body = self.getJSON("/health/live/")
+        assert code == 200
+        assert list(body["checks"]) == ["cycleAge"]
+
+        self.now += timedelta(seconds=90)
+        code, body = self.getJSON("/health/live/")
+        assert code == 503
+        assert body["checks"]["cycleAge"]["value"] == 121
+
+
+class TestHealthStale(HandlerTestCase):
+    __test__ = True
+    cycles = 5
+
+    def setUp(self):
+        super().setUp()
+        self.updateTime = self.graph.getSnapshot().getLocalUpdateTime()
+        self.runCycle(self.updateTime)
+
+    def runCycle(self, time, success=True):
+        self.status.startCycle(time)
+        self.status.recordFetch(time, success)
+        self.status.finishCycle(time)
+        self.now = time + timedelta(seconds=1)
+
+    def test_fresh(self):
+        code, body = self.getJSON("/health/")
+        assert code == 200
+        assert all(check["ok"] for check in body["checks"].values())
+
+    def test_stale_update(self):
+        # Still fetching from TfGM but the graph's not been updated
+        self.runCycle(self.updateTime + timedelta(seconds=40))
+        code, body = self.getJSON("/health/ready/")
+        assert code == 503
+        failing = [
+            name for name, check in body["checks"].items() if not check["ok"]]
+        assert failing == ["updateAge"]
+        assert body["checks"]["updateAge"]["value"] == 41
+
+        code, body = self.getJSON("/health/live/")
+        assert code == 200
+
+    def test_error_streak(self):
+        for i in range(6):
+            self.runCycle(self.now, success=False)
+        code, body = self.getJSON("/health/ready/")
+        assert code == 503
+        assert body["checks"]["errorStreak"] == {
+            "value": 6, "limit": 5, "ok": False}
@@ -0,0 +1,88 @@
+import json
+from datetime import datetime, timedelta
+
+import metrolinkTimes.fakeTfgmAPI as fakeTfgmAPI
+from metrolinkTimes.encoding import json_encode
+from metrolinkTimes.fakeTfgmAPI import SimulatedFeed
+from metrolinkTimes.metrolinkTimes import GraphUpdater
+from metrolinkTimes.tfgmMetrolinksAPI import parseData
+from metrolinkTimes.tramGraph import TramGraph, shortStatuses
+
+
+class FeedClock(datetime):
+    # Lets the simulated feed be stepped through time rather than run in
+    # real time
+    now_ = None
+
+    @classmethod
+    def utcnow(cls):
+        return cls.now_
+
+
+def dumpSnapshot(graph):
+    snapshot = graph.getSnapshot()
+    return json_encode([
+        snapshot.getNodePredictions(),
+        snapshot.getTramsHeres(),
+        snapshot.getTramsDeparteds(),
+        snapshot.getTramsStarting()])
+
+
+def test_incremental_matches_full(monkeypatch):
+    monkeypatch.setattr(fakeTfgmAPI, "datetime", FeedClock)
+    monkeypatch.setattr(FeedClock, "now_", datetime(2024, 1, 1, 8))
+    feed = SimulatedFeed(seed=1)
+
+    incrementalGraph = TramGraph(incremental=True)
+    fullGraph = TramGraph(incremental=False)
+    updaters = [
+        GraphUpdater(incrementalGraph, None, clock=FeedClock.utcnow),
+        GraphUpdater(fullGraph, None, clock=FeedClock.utcnow)]
+
+    for cycle in range(150):
+        payload = feed.getPayload()
+        for updater in updaters:
+            updater.update(parseData(json.loads(payload)))
+        assert dumpSnapshot(incrementalGraph) == dumpSnapshot(fullGraph), \
+            "cycle {}".format(cycle)
+        FeedClock.now_ += timedelta(seconds=10)
+
+
+def test_located_trams_have_distinct_ids(monkeypatch):
+    monkeypatch.setattr(fakeTfgmAPI, "datetime", FeedClock)
+    monkeypatch.setattr(FeedClock, "now_", datetime(2024, 1, 1, 8))
+    feed = SimulatedFeed(seed=1)
+
+    graph = TramGraph()
+    updater = GraphUpdater(graph, None, clock=FeedClock.utcnow)
+
+    for cycle in range(100):
+        updater.update(parseData(json.loads(feed.getPayload())))
+        # The same tram can be listed more than once
+        trams = {
+            id(tram): tram for platform in graph.platforms
+            for status in shortStatuses
+            for tram in getattr(platform, status)}
+        tramIDs = [
+            tram.tramID for tram in trams.values()
+            if tram.tramID is not None]
+        assert len(tramIDs) == len(set(tramIDs)), "cycle {}".format(cycle)
+        FeedClock.now_ += timedelta(seconds=10)
+
+
+def test_arrivals_have_their_own_predictions(monkeypatch):
+    monkeypatch.setattr(fakeTfgmAPI, "datetime", FeedClock)
+    monkeypatch.setattr(FeedClock, "now_", datetime(2024, 1, 1, 8))
+    feed = SimulatedFeed(seed=1)
+
+    graph = TramGraph()
+    updater = GraphUpdater(graph, None, clock=FeedClock.utcnow)
+
+    for cycle in range(100):
+        updater.update(parseData(json.loads(feed.getPayload())))
+        predictions = graph.getSnapshot().getNodePredictions()
+        for nodeID, pTrams in predictions.items():
+            for pTram in pTrams:
+                assert pTram["predictions"][nodeID] == (
+                    pTram["predictedArriveTime"]), "cycle {}".format(cycle)
+        FeedClock.now_ += timedelta(seconds=10)
@@ -0,0 +1,143 @@
+import random
+
+import pytest
+
+from metrolinkTimes.tramGraph import PredictedArrival, Tram, TramGraph
+
+updateTime = 1704096000
+
+
+@pytest.fixture(scope="module")
+def graph():
+    return TramGraph()
+
+
+def arrivalDict(pTram):
+    # Predicted arrivals as they used to be kept, & compared
+    tram = pTram.tram
+    curLoc = {"platform": pTram.platform, "status": pTram.status}
+    if tram.wait is not None:
+        curLoc["pidWait"] = tram.wait
+    return {
+        "dest": tram.dest,
+        "via": pTram.via,
+        "carriages": tram.carriages,
+        "curLoc": curLoc,
+        "predictedArriveTime": pTram.predictedArriveTime,
+        "predictions": dict(tram.predictions)
+    }
+
+
+def linearScan(platform, node):
+    # The trams starting at a platform, found the way they were before
+    # predicted arrivals were indexed
+    pTramsMatched = []
+    tramsStarting = []
+    for tram in platform.tramsDue:
+        tramStartsHere = True
+        tramTime = platform.updateTime + tram.wait * 60
+        for pTram in platform.predictedArrivals:
+            pDict = arrivalDict(pTram)
+            if pDict in pTramsMatched:
+                continue
+            if ((pTram.platform != node)
+               and (tram.dest == pTram.tram.dest)
+               and (tram.carriages == pTram.tram.carriages)
+               and abs(pTram.predictedArriveTime - tramTime) < 120):
+                tramStartsHere = False
+                pTramsMatched.append(pDict)
+                break
+        if tramStartsHere:
+            tramsStarting.append(tram)
+    return tramsStarting
+
+
+def setUpPlatform(graph, node, tramsDue, predictedArrivals):
+    platform = graph.platforms[node]
+    platform.updateTime = updateTime
+    platform.tramsDue = tramsDue
+    platform.tramsApproaching = []
+    platform.approachingIDs = {}
+    platform.predictedArrivals = predictedArrivals
+    return platform
+
+
+def predictedTram(dest, carriages, wait, node, time):
+    tram = Tram(dest, None, carriages, wait)
+    tram.predictions = {node: time}
+    return tram
+
+
+def test_duplicate_arrivals_match_once(graph):
+    node = graph.nodeIndex["Firswood_9400ZZMAFIR1"]
+    fromNode = graph.nodeIndex["St Werburgh’s Road_9400ZZMASTW1"]
+    eccles = graph.stationIndex["Eccles"]
+    altrincham = graph.stationIndex["Altrincham"]
+
+    tramsDue = [
+        Tram(eccles, None, "Single", 2),
+        Tram(eccles, None, "Single", 3),
+        Tram(eccles, None, "Single", 3),
+        Tram(eccles, None, "Single", 5),
+        Tram(altrincham, None, "Double", 4)]
+
+    # The same tram listed twice
+    listedTwice = predictedTram(eccles, "Single", None, node, updateTime + 150)
+    # Two trams that look the same
+    lookAlikes = [
+        predictedTram(eccles, "Single", None, node, updateTime + 190.5)
+        for i in range(2)]
+    # Just inside & just outside of the window
+    inside = predictedTram(
+        eccles, "Single", None, node, updateTime + 5 * 60 + 119.6)
+    outside = predictedTram(
+        altrincham, "Double", None, node, updateTime + 4 * 60 + 120)
+
+    predictedArrivals = [
+        PredictedArrival(tram, None, fromNode, "departed",
+                         tram.predictions[node])
+        for tram in [listedTwice, listedTwice] + lookAlikes
+        + [inside, outside]]
+    platform = setUpPlatform(graph, node, tramsDue, predictedArrivals)
+
+    expected = linearScan(platform, node)
+    graph.locateApproaching(node)
+    assert platform.tramsApproaching == expected
+    assert platform.tramsApproaching == [tramsDue[2], tramsDue[4]]
+
+
+def test_index_matches_linear_scan(graph):
+    rng = random.Random(1)
+    node = graph.nodeIndex["Firswood_9400ZZMAFIR1"]
+    otherNodes = [
+        graph.nodeIndex["St Werburgh’s Road_9400ZZMASTW1"],
+        graph.nodeIndex["Chorlton_9400ZZMACHO2"],
+        node]
+    dests = [graph.stationIndex["Eccles"], graph.stationIndex["Altrincham"]]
+    carriages = ["Single", "Double"]
+
+    for i in range(200):
+        tramsDue = [
+            Tram(rng.choice(dests), None, rng.choice(carriages),
+                 rng.randrange(8))
+            for j in range(rng.randrange(1, 5))]
+
+        predictedArrivals = []
+        for j in range(rng.randrange(8)):
+            tram = predictedTram(
+                rng.choice(dests), rng.choice(carriages),
+                rng.choice([None, 1]), node,
+                updateTime + rng.choice([0, 0.5, 60, 119.5]) * rng.choice(
+                    [-1, 1]) + rng.randrange(8) * 60)
+            pTram = PredictedArrival(
+                tram, None, rng.choice(otherNodes),
+                rng.choice(["here", "departed"]), tram.predictions[node])
+            predictedArrivals.append(pTram)
+            if rng.random() < 0.3:
+                predictedArrivals.append(pTram)
+        rng.shuffle(predictedArrivals)
+
+        platform = setUpPlatform(graph, node, tramsDue, predictedArrivals)
+        expected = linearScan(platform, node)
+        graph.locateApproaching(node)
+        assert platform.tramsApproaching == expected
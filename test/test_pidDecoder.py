@@ -0,0 +1,75 @@
+from datetime import datetime
+
+import pytest
+
+from metrolinkTimes.epoch import toEpoch
+from metrolinkTimes.pidDecoder import (
+    PIDDecoder, notInServiceDests, stationMappings)
+
+stationNames = sorted(
+    set(stationMappings.values()) | {"Altrincham", "Piccadilly", "Bury"})
+stationIndex = {name: i for i, name in enumerate(stationNames)}
+
+
+@pytest.fixture
+def decoder():
+    return PIDDecoder(stationIndex)
+
+
+def apiPID(*trams):
+    pid = {}
+    for i in range(4):
+        dest, carriages, status, wait = ("", "", "", "")
+        if i < len(trams):
+            dest, carriages, status, wait = trams[i]
+        pid["Dest{}".format(i)] = dest
+        pid["Carriages{}".format(i)] = carriages
+        pid["Status{}".format(i)] = status
+        pid["Wait{}".format(i)] = wait
+    return pid
+
+
+def test_dest_aliases(decoder):
+    for name, station in stationMappings.items():
+        assert decoder.decodeDest(name) == (stationIndex[station], None)
+    assert decoder.decodeDest("Altrincham") == (
+        stationIndex["Altrincham"], None)
+    assert decoder.decodeDest("Piccadilly via MCUK") == (
+        stationIndex["Piccadilly"], stationIndex["MediaCityUK"])
+
+
+def test_not_in_service_dests(decoder):
+    for dest in notInServiceDests:
+        assert decoder.decodeDest(dest) is None
+    # Unknown stations are dropped too
+    assert decoder.decodeDest("Nowhere") is None
+    # An unknown via doesn't lose the destination
+    assert decoder.decodeDest("Bury via Nowhere") == (
+        stationIndex["Bury"], None)
+
+
+def test_cache_cleared_at_max_size():
+    decoder = PIDDecoder(stationIndex, maxCacheSize=3)
+    for name in ["Altrincham", "Bury", "Piccadilly"]:
+        decoder.decodeDest(name)
+    assert len(decoder.destCache) == 3
+    assert decoder.decodeDest("MCUK") == (stationIndex["MediaCityUK"], None)
+    assert list(decoder.destCache) == ["MCUK"]
+
+    for time in ["2024-01-01T08:00:0{}Z".format(i) for i in range(4)]:
+        decoder.decodeTime(time)
+    assert list(decoder.timeCache) == ["2024-01-01T08:00:03Z"]
+    assert decoder.decodeTime("2024-01-01T08:00:03Z") == toEpoch(
+        datetime(2024, 1, 1, 8, 0, 3))
+
+
+def test_decode_trams(decoder):
+    trams = decoder.decodeTrams(apiPID(
+        ("Altrincham", "Single", "Due", "3"),
+        ("Not in Service", "Single", "Departing", "0"),
+        ("Piccadilly via MCUK", "Double", "Arrived", "0")))
+    assert trams == [
+        (stationIndex["Altrincham"], None, "Single", "Due", 3),
+        (stationIndex["Piccadilly"], stationIndex["MediaCityUK"], "Double",
+         "Arrived", 0)]
+    assert decoder.decodeTrams(apiPID()) == []
@@ -0,0 +1,112 @@
+import logging
+from datetime import datetime, timedelta
+
+import pytest
+
+from metrolinkTimes.pollScheduler import PollScheduler
+
+start = datetime(2024, 1, 1, 8)
+
+
+class FakeClock:
+    # Times the scheduler is given, stepped through rather than waited for
+    def __init__(self):
+        self.now = start
+
+    def advance(self, seconds):
+        self.now += timedelta(seconds=seconds)
+        return self.now
+
+
+def seconds(s):
+    return timedelta(seconds=s)
+
+
+def test_no_cadence_polls_at_min_interval():
+    scheduler = PollScheduler(minInterval=1)
+    assert scheduler.getCadence() is None
+    assert scheduler.nextDelay(start, seconds(0.25)) == 0.75
+    assert scheduler.nextDelay(start, seconds(3)) == 0
+
+
+def test_cadence_is_median_of_changes():
+    clock = FakeClock()
+    scheduler = PollScheduler()
+    # Unchanged & older update times aren't changes
+    for updateTime in [0, 10, 10, 20, 15, 50, 60]:
+        scheduler.recordPoll(
+            clock.advance(5), True, start + seconds(updateTime))
+    assert list(scheduler.cadences) == [
+        seconds(10), seconds(10), seconds(30), seconds(10)]
+    assert scheduler.getCadence() == seconds(10)
+    assert scheduler.newestUpdateTime == start + seconds(60)
+
+    # Only the last 20 changes count
+    for i in range(20):
+        scheduler.recordPoll(
+            clock.advance(5), True, start + seconds(60 + 12 * (i + 1)))
+    assert scheduler.getCadence() == seconds(12)
+
+
+def test_polls_after_smallest_lag():
+    clock = FakeClock()
+    scheduler = PollScheduler(minInterval=1, freshOffset=0.5)
+    # Seen 3s, 1s & then 2s after they were updated
+    for updateTime, lag in [(0, 3), (10, 1), (20, 2)]:
+        clock.now = start + seconds(updateTime + lag)
+        scheduler.recordPoll(clock.now, True, start + seconds(updateTime))
+    assert min(scheduler.lags) == seconds(1)
+
+    # The next update's expected at 30s & to be visible from 31s
+    delay = scheduler.nextDelay(clock.now, seconds(0.1))
+    assert delay == pytest.approx(31.5 - 22)
+
+
+def test_late_data_polls_at_min_interval():
+    clock = FakeClock()
+    scheduler = PollScheduler(minInterval=1, freshOffset=0.5)
+    for updateTime in [0, 10]:
+        clock.now = start + seconds(updateTime + 1)
+        scheduler.recordPoll(clock.now, True, start + seconds(updateTime))
+
+    clock.now = start + seconds(25)
+    assert scheduler.nextDelay(clock.now, seconds(0.25)) == 0.75
+
+
+def test_backoff_is_jittered_within_bounds():
+    scheduler = PollScheduler(minInterval=1, maxBackoff=60)
+    for failures in range(1, 10):
+        scheduler.recordPoll(start, False, None)
+        assert scheduler.failures == failures
+        delay = min(60, 2 ** failures)
+        delays = [
+            scheduler.nextDelay(start, seconds(0)) for i in range(200)]
+        assert all(delay / 2 <= d <= delay for d in delays)
+        # Not always the same
+        assert len(set(delays)) > 1
+
+    scheduler.recordPoll(start, True, None)
+    assert scheduler.failures == 0
+
+
+def test_overrun_polls_for_latest(caplog):
+    clock = FakeClock()
+    scheduler = PollScheduler(minInterval=1, freshOffset=0.5)
+    for updateTime in [0, 10, 20]:
+        clock.now = start + seconds(updateTime + 1)
+        scheduler.recordPoll(clock.now, True, start + seconds(updateTime))
+
+    # The next update was visible from 31.5s, & a few more since
+    clock.now = start + seconds(75)
+    with caplog.at_level(logging.WARNING):
+        delay = scheduler.nextDelay(clock.now, seconds(8))
+    assert delay == 0
+    assert "overran by 4 update(s)" in caplog.text
+
+    # Not overrun if it's only the next update we've missed
+    caplog.clear()
+    clock.now = start + seconds(35)
+    with caplog.at_level(logging.WARNING):
+        delay = scheduler.nextDelay(clock.now, seconds(0.5))
+    assert delay == 0.5
+    assert "overran" not in caplog.text
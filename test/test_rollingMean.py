@@ -0,0 +1,51 @@
+import random
+
+import pytest
+
+from metrolinkTimes.rollingMean import RollingMean
+
+
+def test_empty():
+    mean = RollingMean()
+    assert mean.mean() is None
+    assert mean.getTimes() == []
+    assert len(mean) == 0
+
+
+def test_times_oldest_first():
+    mean = RollingMean(window=3)
+    mean.add(1)
+    mean.add(2)
+    assert mean.getTimes() == [1, 2]
+    assert len(mean) == 2
+
+    for time in [3, 4, 5, 6, 7]:
+        mean.add(time)
+    assert mean.getTimes() == [5, 6, 7]
+    assert len(mean) == 3
+
+
+def test_wrap_keeps_running_total():
+    rng = random.Random(1)
+    mean = RollingMean(window=5)
+    times = []
+    for i in range(53):
+        time = rng.randrange(300)
+        mean.add(time)
+        times.append(time)
+        assert mean.getTimes() == times[-5:]
+        assert mean.total == sum(times[-5:])
+        assert mean.mean() == sum(times[-5:]) / len(times[-5:])
+
+
+def test_decay():
+    mean = RollingMean(window=2, decay=0.25)
+    mean.add(100)
+    assert mean.mean() == 100
+    mean.add(200)
+    assert mean.mean() == 125
+    mean.add(0)
+    assert mean.mean() == pytest.approx(93.75)
+    # Older times still count after they've left the window
+    assert mean.getTimes() == [200, 0]
+    assert mean.mean() != 100
@@ -0,0 +1,127 @@
+import struct
+
+from metrolinkTimes.sharedSnapshot import (
+    SharedSnapshotReader, SharedSnapshotWriter, createSharedFile,
+    headerFormat, minCapacity)
+
+# Called whenever a snapshot's unpickled, so tests can publish part way
+# through a read
+onUnpickle = []
+
+
+class FakeSnapshot:
+    def __init__(self, generation, size=100):
+        self.generation = generation
+        self.data = bytes(size)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        for hook in onUnpickle:
+            hook()
+
+
+def readHeader(writer):
+    return struct.unpack_from(headerFormat, writer.map, 0)
+
+
+def test_publish_read():
+    sharedFile = createSharedFile()
+    writer = SharedSnapshotWriter(sharedFile)
+    reader = SharedSnapshotReader(sharedFile)
+    assert reader.read() is False
+
+    writer.publish(FakeSnapshot(1), "a")
+    assert reader.read() is True
+    assert reader.snapshot.generation == 1
+    assert reader.extra == "a"
+    assert reader.read() is False
+
+    writer.publish(FakeSnapshot(2), "b")
+    assert reader.read() is True
+    assert (reader.snapshot.generation, reader.extra) == (2, "b")
+
+
+def test_extra_written_in_place():
+    sharedFile = createSharedFile()
+    writer = SharedSnapshotWriter(sharedFile)
+    reader = SharedSnapshotReader(sharedFile)
+    snapshot = FakeSnapshot(1)
+
+    writer.publish(snapshot, "a")
+    sequence, version, offset, snapshotLength, extraLength = readHeader(writer)
+    assert reader.read() is True
+    readSnapshot = reader.snapshot
+
+    writer.publish(snapshot, "a longer extra")
+    header = readHeader(writer)
+    assert header[:4] == (sequence + 2, version, offset, snapshotLength)
+    assert reader.read() is True
+    assert reader.extra == "a longer extra"
+    # The snapshot isn't read again
+    assert reader.snapshot is readSnapshot
+
+    # A new snapshot goes in the other slot
+    writer.publish(FakeSnapshot(2), "b")
+    assert readHeader(writer)[2] != offset
+    assert reader.read() is True
+    assert (reader.snapshot.generation, reader.extra) == (2, "b")
+
+
+def test_growth_remapped():
+    sharedFile = createSharedFile()
+    writer = SharedSnapshotWriter(sharedFile)
+    reader = SharedSnapshotReader(sharedFile)
+    snapshot = FakeSnapshot(1)
+    writer.publish(snapshot, "a")
+    assert reader.read() is True
+    mapSize = len(reader.map)
+
+    writer.publish(FakeSnapshot(2, size=3 * minCapacity), "b")
+    assert writer.getCapacity() > 3 * minCapacity
+    assert reader.read() is True
+    assert len(reader.map) > mapSize
+    assert len(reader.snapshot.data) == 3 * minCapacity
+    assert reader.extra == "b"
+
+    # Extra too big to fit after the snapshot grows the file again, with
+    # the snapshot written out with it
+    capacity = writer.getCapacity()
+    writer.publish(FakeSnapshot(2), bytes(capacity))
+    assert writer.getCapacity() > capacity
+    assert reader.read() is True
+    assert len(reader.snapshot.data) == 3 * minCapacity
+    assert reader.extra == bytes(capacity)
+
+
+def test_torn_read_retried():
+    sharedFile = createSharedFile()
+    writer = SharedSnapshotWriter(sharedFile)
+    reader = SharedSnapshotReader(sharedFile, retries=3)
+    snapshot = FakeSnapshot(1)
+    writer.publish(snapshot, "a")
+
+    # The extra changes after the reader's read the header
+    published = []
+
+    def publish():
+        published.append("extra {}".format(len(published)))
+        writer.publish(snapshot, published[-1])
+
+    onUnpickle.append(publish)
+    try:
+        # Changed on every attempt
+        assert reader.read() is False
+        assert len(published) == 3
+        assert reader.snapshot is None
+        # Changed on the first attempt only
+        onUnpickle[:] = [lambda: (onUnpickle.clear(), publish())]
+        assert reader.read() is True
+        assert len(published) == 4
+        assert reader.extra == published[-1]
+    finally:
+        onUnpickle.clear()
+
+    assert reader.read() is False
+    writer.publish(snapshot, "e")
+    assert reader.read() is True
+    assert reader.extra == "e"